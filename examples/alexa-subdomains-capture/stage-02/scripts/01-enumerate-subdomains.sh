@@ -1,10 +1,10 @@
 #!/bin/bash 
 
 # Pop domain from pipeline
-DOMAIN=$(curl -s "http://plumber/$STAGE/pop?format=plain") || { exit; }
+DOMAIN=$(curl -s "http://plumber/$STAGE/pop?format=plain&wait=30") || { exit; }
 
-# Wait if pipe is empty
-test -z "$DOMAIN" && { sleep 10; exit; }
+# Exit if pipe is still empty after waiting
+test -z "$DOMAIN" && { exit; }
 
 # Query crt.sh
 CERT_DATA=$(curl --max-time 20 -s "https://crt.sh?q=%.$DOMAIN&output=json") || { exit; }
@@ -1,10 +1,10 @@
 #!/bin/bash
 
 # Pop subdomain from pipeline
-SUBDOMAIN=$(curl -s "http://plumber/$STAGE/pop?format=plain") || { exit; } 
+SUBDOMAIN=$(curl -s "http://plumber/$STAGE/pop?format=plain&wait=30") || { exit; } 
 
-# Wait if pipe is empty
-test -z "$SUBDOMAIN" && { sleep 10; exit; }
+# Exit if pipe is still empty after waiting
+test -z "$SUBDOMAIN" && { exit; }
 
 # Check if site responds, and get a screenshot
 curl --max-time 20 -s "https://$SUBDOMAIN" -o /dev/null && \
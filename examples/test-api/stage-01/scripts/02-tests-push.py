@@ -1,6 +1,9 @@
 #!/usr/bin/env python3
 import unittest
 import requests
+import gzip
+import msgpack
+import json
 
 URL='http://plumber'
 
@@ -221,5 +224,200 @@ class TestPushwithJSONHTTPAPIs(unittest.TestCase):
                     URL + '/1/pop?quantity=3'
                 ).json()
             )
+class TestPushwithNDJSONHTTPAPIs(unittest.TestCase):
+
+    def test_ndjson_push_and_pop(self):
+
+        data_list = [ { 'entry': i } for i in range(3) ]
+
+        self.assertEqual(
+                3,
+                requests.post(
+                        URL + '/1/push?format=ndjson',
+                        data = '\n'.join(json.dumps(data) for data in data_list)
+                        ).json()
+        )
+
+        self.assertEqual(
+                data_list,
+                requests.get(
+                    URL + '/1/pop?quantity=3'
+                ).json()
+            )
+
+    def test_ndjson_push_skips_blank_lines(self):
+
+        self.assertEqual(
+                2,
+                requests.post(
+                        URL + '/1/push?format=ndjson',
+                        data = '1\n\n2\n'
+                        ).json()
+        )
+
+        self.assertEqual(
+                [ 1, 2 ],
+                requests.get(
+                    URL + '/1/pop?quantity=3'
+                ).json()
+            )
+
+    def test_ndjson_push_wrong_line(self):
+
+        self.assertEqual(
+                400,
+                requests.post(
+                        URL + '/1/push?format=ndjson',
+                        data = '1\nWRONG\n'
+                        ).status_code
+        )
+
+class TestPushwithMsgpackHTTPAPIs(unittest.TestCase):
+
+    def test_msgpack_push_and_pop(self):
+
+        data_list = [ { 'entry': i } for i in range(3) ]
+
+        self.assertEqual(
+                3,
+                requests.post(
+                        URL + '/1/push?format=msgpack',
+                        data = msgpack.packb(data_list)
+                        ).json()
+        )
+
+        self.assertEqual(
+                data_list,
+                msgpack.unpackb(
+                    requests.get(
+                        URL + '/1/pop?quantity=3&format=msgpack'
+                    ).content
+                )
+            )
+
+    def test_msgpack_negotiated_by_headers(self):
+
+        data_list = [ 'a', 'b' ]
+
+        self.assertEqual(
+                2,
+                requests.post(
+                        URL + '/1/push',
+                        data = msgpack.packb(data_list),
+                        headers = { 'Content-Type': 'application/msgpack' }
+                        ).json()
+        )
+
+        response = requests.get(
+                URL + '/1/pop?quantity=3',
+                headers = { 'Accept': 'application/msgpack' }
+                )
+
+        self.assertEqual('application/msgpack', response.headers['Content-Type'].split(';')[0])
+        self.assertEqual(data_list, msgpack.unpackb(response.content))
+
+    def test_msgpack_push_wrong_body(self):
+
+        self.assertEqual(
+                400,
+                requests.post(
+                        URL + '/1/push?format=msgpack',
+                        data = b'\xc1'
+                        ).status_code
+        )
+
+class TestPushwithCompressedHTTPAPIs(unittest.TestCase):
+
+    def test_gzip_push_and_pop(self):
+
+        data_list = [ 'sub%d.example.com' % i for i in range(300) ]
+
+        self.assertEqual(
+                300,
+                requests.post(
+                        URL + '/1/push?format=plain',
+                        data = gzip.compress('\n'.join(data_list).encode('utf-8')),
+                        headers = { 'Content-Encoding': 'gzip' }
+                        ).json()
+        )
+
+        response = requests.get(
+                URL + '/1/pop?format=plain&quantity=300',
+                headers = { 'Accept-Encoding': 'gzip' }
+                )
+
+        self.assertEqual('gzip', response.headers.get('Content-Encoding'))
+        self.assertEqual(data_list, response.text.split('\n'))
+
+    def test_unsupported_encoding(self):
+
+        self.assertEqual(
+                415,
+                requests.post(
+                        URL + '/1/push',
+                        data = b'[1]',
+                        headers = { 'Content-Encoding': 'compress' }
+                        ).status_code
+        )
+
+    def test_corrupted_gzip_push(self):
+
+        for format_, body in [
+                ('plain', b'not gzip'),
+                ('json', b'not gzip'),
+                ('ndjson', gzip.compress(b'"a"\n"b"\n')[:-10])
+                ]:
+            self.assertEqual(
+                    400,
+                    requests.post(
+                            URL + '/1/push?format=%s' % format_,
+                            data = body,
+                            headers = { 'Content-Encoding': 'gzip' }
+                            ).status_code
+            )
+
+    def test_oversized_gzip_push_and_store(self):
+
+        # A few kilobytes inflating beyond the maximum body size
+        body = gzip.compress(json.dumps([ 'x' * 2**21 ]).encode('utf-8'))
+
+        for path in [ '/1/push', '/1/store' ]:
+            self.assertEqual(
+                    413,
+                    requests.post(
+                            URL + path,
+                            data = body,
+                            headers = { 'Content-Encoding': 'gzip', 'Content-Type': 'application/json' }
+                            ).status_code
+            )
+
+    def test_oversized_gzip_line(self):
+
+        requests.post(URL + '/1/flush')
+
+        # A line without newlines inflating beyond the maximum body size
+        body = gzip.compress(b'short\n' + b'x' * 2**21)
+
+        self.assertEqual(
+                413,
+                requests.post(
+                        URL + '/1/push?format=plain',
+                        data = body,
+                        headers = { 'Content-Encoding': 'gzip' }
+                        ).status_code
+        )
+
+        # Short lines are streamed whatever their total size
+        body = gzip.compress((b'x' * 1023 + b'\n') * 1100)
+
+        self.assertEqual(
+                1100,
+                requests.post(
+                        URL + '/1/push?format=plain',
+                        data = body,
+                        headers = { 'Content-Encoding': 'gzip' }
+                        ).json()
+        )
+
 if __name__ == '__main__':
     unittest.main()
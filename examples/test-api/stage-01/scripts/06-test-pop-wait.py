@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import unittest
+import threading
+import requests
+import time
+
+URL='http://plumber'
+
+class TestPopWaitwithHTTPAPIs(unittest.TestCase):
+
+    def test_pop_wait_on_empty_queue(self):
+
+        requests.post(URL + '/1/flush')
+
+        start = time.time()
+
+        self.assertFalse(
+                requests.get(
+                    URL + '/1/pop?format=plain&wait=2'
+                ).text
+            )
+
+        self.assertGreaterEqual(
+                time.time() - start,
+                2
+            )
+
+    def test_pop_wait_wakes_up_on_push(self):
+
+        requests.post(URL + '/1/flush')
+
+        pusher = threading.Timer(
+                1,
+                requests.post,
+                args = ( URL + '/1/push?format=plain', ),
+                kwargs = { 'data': 'WAITED' }
+            )
+        pusher.start()
+
+        start = time.time()
+
+        self.assertEqual(
+                'WAITED',
+                requests.get(
+                    URL + '/1/pop?format=plain&wait=30'
+                ).text
+            )
+
+        self.assertLess(
+                time.time() - start,
+                30
+            )
+
+        pusher.join()
+
+    def test_pop_wait_with_entries(self):
+
+        requests.post(URL + '/1/flush')
+
+        self.assertEqual(
+                1,
+                requests.post(
+                        URL + '/1/push',
+                        json = [ 1 ]
+                        ).json()
+        )
+
+        self.assertEqual(
+                [ 1 ],
+                requests.get(
+                    URL + '/1/pop?wait=30'
+                ).json()
+            )
+
+if __name__ == '__main__':
+    unittest.main()
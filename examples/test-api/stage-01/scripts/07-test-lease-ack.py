@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+import unittest
+import requests
+import time
+
+URL='http://plumber'
+
+class TestLeaseAndAckwithHTTPAPIs(unittest.TestCase):
+
+    def test_expired_lease_is_popped_again(self):
+
+        requests.post(URL + '/1/flush')
+
+        self.assertEqual(
+                1,
+                requests.post(
+                        URL + '/1/push',
+                        json = [ 'LEASED' ]
+                        ).json()
+        )
+
+        self.assertEqual(
+                [ 'LEASED' ],
+                requests.get(
+                    URL + '/1/pop?lease=1'
+                ).json()
+            )
+
+        self.assertFalse(
+                requests.get(
+                    URL + '/1/pop'
+                ).json()
+            )
+
+        # Returned to the queue once the lease has been reaped
+        self.assertEqual(
+                [ 'LEASED' ],
+                requests.get(
+                    URL + '/1/pop?wait=30'
+                ).json()
+            )
+
+    def test_acked_lease_is_not_popped_again(self):
+
+        requests.post(URL + '/1/flush')
+
+        self.assertEqual(
+                "2",
+                requests.post(
+                        URL + '/1/push?format=plain',
+                        data = 'ACKED\nACKED'
+                        ).text
+        )
+
+        response = requests.get(
+                URL + '/1/pop?format=plain&quantity=2&lease=1'
+            )
+
+        self.assertEqual(
+                'ACKED\nACKED',
+                response.text
+            )
+
+        self.assertEqual(
+                2,
+                requests.post(
+                        URL + '/1/ack',
+                        json = [ response.headers['X-Plumber-Claim'] ]
+                        ).json()
+        )
+
+        time.sleep(3)
+
+        self.assertFalse(
+                requests.get(
+                    URL + '/1/pop?format=plain&wait=10'
+                ).text
+            )
+
+    def test_ack_many_claims(self):
+
+        requests.post(URL + '/1/flush')
+        requests.post(URL + '/1/push', json = [ 'A', 'B' ])
+
+        claims = [
+                requests.get(URL + '/1/pop?lease=60').headers['X-Plumber-Claim']
+                for i in range(2)
+            ]
+
+        # More claim tokens than the variables of a database statement
+        unknown = [ 'unknown-%d' % i for i in range(2000) ]
+
+        self.assertEqual(
+                2,
+                requests.post(
+                        URL + '/1/ack',
+                        json = claims[:1] + unknown + claims[1:]
+                        ).json()
+        )
+        self.assertEqual(0, requests.get(URL + '/1/stats').json()['in_flight'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+import unittest
+import requests
+import asyncio
+import time
+import plumber
+import plumber.aio
+
+class TestPythonLibrary(unittest.TestCase):
+
+    def setUp(self):
+
+        plumber.flush(1)
+
+    def test_push_and_pop(self):
+
+        data_list = [ { 'entry': i } for i in range(3) ]
+
+        self.assertEqual(3, plumber.push(1, data_list))
+        self.assertEqual(data_list, plumber.pop(1, 5))
+        self.assertEqual([], plumber.pop(1))
+
+    def test_depth(self):
+
+        plumber.push(1, [ 1, 2, 3 ])
+        plumber.pop(1)
+
+        self.assertEqual(2, plumber.depth(1))
+
+    def test_stats(self):
+
+        plumber.push(1, [ 1, 2, 3 ])
+        plumber.pop(1, 1, lease = 60)
+        plumber.pop(1, 1, lease = 0)
+
+        stats = plumber.stats(1)
+
+        self.assertEqual(1, stats['ready'])
+        self.assertEqual(1, stats['in_flight'])
+        self.assertEqual(1, stats['consumed'])
+        self.assertGreaterEqual(stats['oldest_age'], 0)
+        self.assertGreater(stats['push_rate'], 0)
+
+    def test_push_if_new(self):
+
+        self.assertEqual(2, plumber.push(1, [ 'a', 'b' ], push_if_new = True))
+        self.assertEqual(1, plumber.push(1, [ 'a', 'c' ], push_if_new = True))
+        self.assertEqual([ 'a', 'b', 'c' ], plumber.pop(1, 5))
+
+    def test_pusher(self):
+
+        with plumber.Pusher(1, max_entries = 2, interval = 60) as pusher:
+            for i in range(5):
+                pusher.push(i)
+
+        self.assertEqual(5, pusher.pushed)
+        self.assertEqual([ 0, 1, 2, 3, 4 ], plumber.pop(1, 10))
+
+    def test_pusher_if_new(self):
+
+        with plumber.Pusher(1, push_if_new = True) as pusher:
+            for entry in [ 'a', 'b', 'a' ]:
+                pusher.push(entry)
+
+        self.assertEqual(2, pusher.pushed)
+
+    def test_pusher_backs_off_after_failures(self):
+
+        calls = []
+        def failing_push(*args):
+            calls.append(args)
+            raise requests.ConnectionError('unreachable')
+
+        push = plumber.push
+        plumber.push = failing_push
+        try:
+            pusher = plumber.Pusher(1, max_entries = 1, interval = 0.2)
+            pusher.push('a')
+            time.sleep(1)
+        finally:
+            plumber.push = push
+
+        # Retried after 0.2, 0.4, 0.8 seconds instead of right away
+        self.assertLessEqual(len(calls), 4)
+
+        # The failed batch is kept and pushed on close
+        pusher.close()
+        self.assertEqual(1, pusher.pushed)
+        self.assertEqual([ 'a' ], plumber.pop(1, 10))
+
+    def test_pusher_drops_rejected_batches(self):
+
+        # Pushes to a wrong stage number are rejected
+        pusher = plumber.Pusher(999, interval = 0.1)
+        pusher.push('a')
+        time.sleep(1)
+
+        self.assertEqual(1, pusher.dropped)
+
+        pusher.push('b')
+        with self.assertRaises(requests.HTTPError):
+            pusher.flush()
+
+        pusher.close()
+        self.assertEqual(2, pusher.dropped)
+        self.assertEqual(0, pusher.pushed)
+
+    def test_consume(self):
+
+        plumber.push(1, list(range(25)))
+
+        self.assertEqual(
+                list(range(25)), 
+                list(plumber.consume(1, batch = 10, prefetch = 2, lease = 60))
+                )
+        self.assertEqual([], plumber.pop(1))
+
+    def test_consume_without_lease(self):
+
+        plumber.push(1, list(range(5)))
+
+        # Nothing to acknowledge with the default lease of the test API, disabled
+        acked = []
+        ack = plumber.ack
+        plumber.ack = lambda stage, claims: acked.append(claims)
+        try:
+            self.assertEqual(list(range(5)), list(plumber.consume(1, batch = 2)))
+        finally:
+            plumber.ack = ack
+
+        self.assertEqual([], acked)
+
+    def test_claim_and_ack(self):
+
+        plumber.push(1, [ 1, 2 ])
+
+        token, data_list = plumber.claim(1, 2, lease = 60)
+
+        self.assertEqual([ 1, 2 ], data_list)
+        self.assertEqual(2, plumber.ack(1, [ token ]))
+
+    def test_store_and_load(self):
+
+        id_result = plumber.store(1, { 'key': 'value' })
+
+        self.assertEqual(
+                { '_id': id_result, 'data': { 'key': 'value' } }, 
+                plumber.load(1, { '_id': id_result }, True)
+            )
+        self.assertIsNone(plumber.load(1, { '_id': id_result }, False))
+
+    def test_store_and_load_empty(self):
+
+        id_result = plumber.store(1, {})
+
+        self.assertEqual({}, plumber.load(1, { '_id': id_result }, True)['data'])
+        self.assertIsNone(plumber.load(1, { '_id': id_result }, False))
+
+class TestPythonAsyncioLibrary(unittest.TestCase):
+
+    def setUp(self):
+
+        plumber.flush(1)
+
+    def test_push_and_consume(self):
+
+        async def push_and_consume():
+
+            pushed = await asyncio.gather(*[ plumber.aio.push(1, [ i ]) for i in range(20) ])
+            consumed = [ entry async for entry in plumber.aio.consume(1, batch = 5, lease = 60) ]
+            await plumber.aio.close()
+
+            return sum(pushed), consumed
+
+        pushed, consumed = asyncio.run(push_and_consume())
+
+        self.assertEqual(20, pushed)
+        self.assertEqual(list(range(20)), sorted(consumed))
+
+    def test_store_and_load(self):
+
+        async def store_and_load():
+
+            id_result = await plumber.aio.store(1, [])
+            loaded = await plumber.aio.load(1, { '_id': id_result }, True)
+            missing = await plumber.aio.load(1, { '_id': id_result }, False)
+            await plumber.aio.close()
+
+            return id_result, loaded, missing
+
+        id_result, loaded, missing = asyncio.run(store_and_load())
+
+        self.assertEqual({ '_id': id_result, 'data': [] }, loaded)
+        self.assertIsNone(missing)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+import unittest
+import requests
+import re
+
+URL='http://plumber'
+
+def metric(text, name, **labels):
+    """Get the value of a metric sample, 0 if missing."""
+
+    for line in text.splitlines():
+        match = re.match(r'^%s(\{.*\})? (\S+)$' % re.escape(name), line)
+        if not match:
+            continue
+
+        sample_labels = dict(re.findall(r'(\w+)="([^"]*)"', match.group(1) or ''))
+        if all(sample_labels.get(key) == str(value) for key, value in labels.items()):
+            return float(match.group(2))
+
+    return 0
+
+class TestMetricswithHTTPAPIs(unittest.TestCase):
+
+    def test_metrics_count_entries_and_requests(self):
+
+        requests.post(URL + '/1/flush')
+
+        before = requests.get(URL + '/_metrics').text
+
+        requests.post(URL + '/1/push?push_if_new=true', json = [ 'a', 'b' ])
+        requests.post(URL + '/1/push?push_if_new=true', json = [ 'a', 'c' ])
+        requests.get(URL + '/1/pop?quantity=5')
+
+        response = requests.get(URL + '/_metrics')
+        after = response.text
+
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain'))
+
+        for name, increase in [
+                ('plumber_entries_pushed_total', 3),
+                ('plumber_entries_deduplicated_total', 1),
+                ('plumber_entries_popped_total', 3)
+                ]:
+            self.assertEqual(
+                    increase,
+                    metric(after, name, stage = 1) - metric(before, name, stage = 1)
+                )
+
+        self.assertEqual(
+                2,
+                metric(after, 'plumber_http_request_duration_seconds_count', route = '/{stage}/push', stage = 1) -
+                metric(before, 'plumber_http_request_duration_seconds_count', route = '/{stage}/push', stage = 1)
+            )
+
+        self.assertIn('plumber_event_loop_lag_seconds', after)
+
+    def test_metrics_bound_the_stage_labels(self):
+
+        requests.get(URL + '/999999/pop')
+
+        text = requests.get(URL + '/_metrics').text
+
+        self.assertNotIn('stage="999999"', text)
+        self.assertNotEqual(
+                0,
+                metric(text, 'plumber_http_requests_total', route = '/{stage}/pop', stage = 'invalid', status = 400)
+            )
+
+if __name__ == '__main__':
+    unittest.main()
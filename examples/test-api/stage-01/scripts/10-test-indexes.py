@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+import unittest
+import requests
+import time
+import os
+
+URL='http://plumber'
+
+# Storage engine of the API, whose indexes are checked
+PLUMBER_ENGINE = os.getenv('PLUMBER_ENGINE', 'mongo').lower()
+
+# Indexes every engine creates, by collection
+EXPECTED_INDEXES = {
+    'mongo': {
+        'incoming': [ 'hash_if_new', 'hash_time', 'leased', 'ready' ],
+        'storage': [ 'data_hash', 'lists' ]
+    },
+    'memory': {
+        'incoming': [ 'leases', 'pushed', 'queued', 'ready' ],
+        'storage': [ 'by_hash', 'entries', 'lists' ]
+    },
+    'sqlite': {
+        'incoming': [ 'hash_time', 'leased', 'ready' ],
+        'storage': [ 'data', 'lists' ]
+    }
+}
+
+def index_names(indexes):
+    """Get the index names of every collection."""
+
+    return { collection: sorted(info) for collection, info in indexes.items() }
+
+class TestIndexeswithHTTPAPIs(unittest.TestCase):
+
+    def test_indexes_are_recreated_after_flush(self):
+
+        response = requests.get(URL + '/1/indexes')
+        self.assertEqual(200, response.status_code)
+
+        before = response.json()
+        self.assertTrue(before.get('incoming'))
+        self.assertIn('storage', before)
+
+        # The stored content is looked up by hash, not by a whole-content index
+        for info in before['storage'].values():
+            self.assertNotEqual([['data', 1]], info.get('key'))
+
+        requests.post(URL + '/1/push', json = [ 'a' ])
+        requests.post(URL + '/1/flush')
+
+        self.assertEqual(
+                index_names(before),
+                index_names(requests.get(URL + '/1/indexes').json())
+            )
+
+    def test_expected_indexes(self):
+
+        if PLUMBER_ENGINE not in EXPECTED_INDEXES:
+            self.skipTest('no indexes expected from the %s engine' % PLUMBER_ENGINE)
+
+        indexes = index_names(requests.get(URL + '/1/indexes').json())
+
+        for collection, names in EXPECTED_INDEXES[PLUMBER_ENGINE].items():
+            for name in names:
+                self.assertIn(name, indexes.get(collection, []))
+
+    def test_memory_structures(self):
+
+        if PLUMBER_ENGINE != 'memory':
+            self.skipTest('memory structures')
+
+        requests.post(URL + '/1/flush')
+        requests.post(URL + '/1/push', json = [ 'a', 'b', 'a' ])
+        requests.get(URL + '/1/pop?lease=60')
+        self.addCleanup(requests.post, URL + '/1/flush')
+
+        incoming = requests.get(URL + '/1/indexes').json()['incoming']
+
+        self.assertEqual(2, incoming['ready']['size'])
+        self.assertEqual(1, incoming['leases']['size'])
+        self.assertEqual(2, incoming['pushed']['size'])
+
+    def test_ready_index_is_not_partial_on_id(self):
+
+        if PLUMBER_ENGINE != 'mongo':
+            self.skipTest('mongo index')
+
+        indexes = requests.get(URL + '/1/indexes').json()
+        ready = indexes['incoming']['ready']
+
+        self.assertEqual([ [ '_consumed', 1 ], [ '_id', 1 ] ], ready['key'])
+        self.assertNotIn('partialFilterExpression', ready)
+
+        # Merged in the ready index
+        self.assertNotIn('consumed', indexes['incoming'])
+
+    def test_depth_on_the_ready_index(self):
+
+        requests.post(URL + '/1/flush')
+        requests.post(URL + '/1/push', json = [ 'a', 'b', 'c' ])
+        requests.get(URL + '/1/pop?lease=60')
+        self.addCleanup(requests.post, URL + '/1/flush')
+
+        response = requests.get(URL + '/1/depth')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, response.json())
+
+    def test_stats_are_reconciled(self):
+
+        # Reconciled every 10 seconds by default
+        for i in range(30):
+            stats = requests.get(URL + '/1/stats').json()
+            if stats['reconciled_age'] is not None:
+                break
+
+            time.sleep(1)
+
+        self.assertIsNotNone(stats['reconciled_age'])
+        self.assertLess(stats['reconciled_age'], 30)
+
+    def test_indexes_wrong_stage(self):
+
+        self.assertEqual(400, requests.get(URL + '/999/indexes').status_code)
+
+    def test_load_by_content(self):
+
+        requests.post(URL + '/1/store', json = { 'indexed': [ 1, 2 ] })
+        requests.post(URL + '/1/store', json = [ 'indexed-item', 'other' ])
+
+        self.assertEqual(
+                { 'indexed': [ 1, 2 ] },
+                requests.get(
+                    URL + '/1/load?delete=true&filter={"data":{"indexed":[1,2]}}'
+                ).json()
+            )
+
+        # A stored list matches the equality on one of its items
+        self.assertEqual(
+                [ 'indexed-item', 'other' ],
+                requests.get(
+                    URL + '/1/load?delete=true&filter={"data":"indexed-item"}'
+                ).json()
+            )
+
+        self.assertEqual(
+                {},
+                requests.get(
+                    URL + '/1/load?filter={"data":"indexed-item"}'
+                ).json()
+            )
+
+if __name__ == '__main__':
+    unittest.main()
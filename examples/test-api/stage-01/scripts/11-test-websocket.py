@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+import unittest
+import requests
+import aiohttp
+import asyncio
+
+URL='http://plumber'
+
+# Seconds to wait for a message that must arrive
+TIMEOUT = 10
+
+def run(coroutine):
+
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+async def session(test):
+    """Run a test coroutine with a WebSocket session to the first stage."""
+
+    async with aiohttp.ClientSession() as client:
+        async with client.ws_connect(URL + '/1/ws') as websocket:
+            return await test(Messages(websocket))
+
+class Messages:
+    """Receive the messages of a WebSocket session by op, in any order."""
+
+    def __init__(self, websocket):
+
+        self.websocket = websocket
+        self.received = []
+
+    async def send(self, message):
+
+        await self.websocket.send_json(message)
+
+    async def receive(self, op, timeout = TIMEOUT):
+
+        while True:
+            for message in self.received:
+                if message['op'] == op:
+                    self.received.remove(message)
+                    return message
+
+            self.received.append(
+                    await asyncio.wait_for(self.websocket.receive_json(), timeout)
+                )
+
+    async def entries(self, quantity):
+        """Receive entries messages until a number of entries, returning the entries and their claims."""
+
+        entries, claims = [], []
+        while len(entries) < quantity:
+            message = await self.receive('entries')
+            entries += message['entries']
+            claims.append(message['claim'])
+
+        return entries, claims
+
+class TestWebSocketwithHTTPAPIs(unittest.TestCase):
+
+    def setUp(self):
+
+        requests.post(URL + '/1/flush')
+
+    def test_push_and_pop_within_credit(self):
+
+        async def test(messages):
+
+            await messages.send({ 'op': 'pop', 'credit': 3, 'lease': 60 })
+            await messages.send({ 'op': 'push', 'entries': [ 'a', 'b', 'c', 'd', 'e' ] })
+
+            self.assertEqual(5, (await messages.receive('pushed'))['count'])
+
+            # No more entries than the credit
+            entries, claims = await messages.entries(3)
+            self.assertEqual([ 'a', 'b', 'c' ], entries)
+            with self.assertRaises(asyncio.TimeoutError):
+                await messages.receive('entries', timeout = 2)
+
+            await messages.send({ 'op': 'ack', 'claims': claims })
+            self.assertEqual(3, (await messages.receive('acked'))['count'])
+
+            # Acknowledging again counts nothing
+            await messages.send({ 'op': 'ack', 'claims': claims })
+            self.assertEqual(0, (await messages.receive('acked'))['count'])
+
+            await messages.send({ 'op': 'pop', 'credit': 5 })
+            entries, claims = await messages.entries(2)
+            self.assertEqual([ 'd', 'e' ], entries)
+
+        run(session(test))
+
+    def test_push_if_new(self):
+
+        async def test(messages):
+
+            await messages.send({ 'op': 'push', 'entries': [ 'a', 'b' ], 'push_if_new': True })
+            self.assertEqual(2, (await messages.receive('pushed'))['count'])
+
+            await messages.send({ 'op': 'push', 'entries': [ 'a', 'c' ], 'push_if_new': True })
+            self.assertEqual(1, (await messages.receive('pushed'))['count'])
+
+        run(session(test))
+
+    def test_pushed_entries_are_popped_over_http(self):
+
+        async def test(messages):
+
+            await messages.send({ 'op': 'push', 'entries': [ 'a', 'b' ] })
+            await messages.receive('pushed')
+
+        run(session(test))
+
+        self.assertEqual(
+                [ 'a', 'b' ],
+                requests.get(URL + '/1/pop?quantity=5').json()
+            )
+
+    def test_wrong_messages(self):
+
+        async def test(messages):
+
+            for message in [
+                    { 'op': 'bogus' },
+                    { 'entries': [ 'a' ] },
+                    { 'op': 'push', 'entries': 'a' },
+                    { 'op': 'push', 'entries': [ 'a' ], 'push_if_older_than': -1 },
+                    { 'op': 'pop', 'credit': -1 },
+                    { 'op': 'pop', 'credit': 1, 'lease': -1 },
+                    { 'op': 'ack' }
+                    ]:
+                await messages.send(message)
+                self.assertTrue((await messages.receive('error'))['error'].startswith('Error:'))
+
+            # The session survives the wrong messages
+            await messages.send({ 'op': 'push', 'entries': [ 'a' ] })
+            self.assertEqual(1, (await messages.receive('pushed'))['count'])
+
+        run(session(test))
+
+    def test_wrong_stage(self):
+
+        async def test():
+
+            async with aiohttp.ClientSession() as client:
+                with self.assertRaises(aiohttp.WSServerHandshakeError):
+                    await client.ws_connect(URL + '/999/ws')
+
+        run(test())
+
+if __name__ == '__main__':
+    unittest.main()
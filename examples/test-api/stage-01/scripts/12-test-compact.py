@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+import unittest
+import requests
+import time
+
+URL='http://plumber'
+
+class TestCompactionwithHTTPAPIs(unittest.TestCase):
+
+    def setUp(self):
+
+        requests.post(URL + '/1/flush')
+
+    def test_compaction_keeps_the_queue(self):
+
+        requests.post(URL + '/1/push', json = [ 'a', 'b', 'c' ])
+        requests.get(URL + '/1/pop?quantity=2')
+
+        response = requests.post(URL + '/1/compact')
+        self.assertEqual(200, response.status_code)
+        self.assertIsInstance(response.json(), int)
+
+        # Nothing left to compact
+        self.assertEqual(0, requests.post(URL + '/1/compact').json())
+
+        self.assertEqual(1, requests.get(URL + '/1/depth').json())
+        self.assertEqual([ 'c' ], requests.get(URL + '/1/pop?quantity=5').json())
+
+    def test_push_if_new_after_compaction(self):
+
+        requests.post(URL + '/1/push?push_if_new=true', json = [ 'a', 'b' ])
+        requests.get(URL + '/1/pop?quantity=2')
+        requests.post(URL + '/1/compact')
+
+        self.assertEqual(
+                1,
+                requests.post(URL + '/1/push?push_if_new=true', json = [ 'a', 'b', 'c' ]).json()
+            )
+        self.assertEqual([ 'c' ], requests.get(URL + '/1/pop?quantity=5').json())
+
+    def test_push_if_older_than_after_compaction(self):
+
+        requests.post(URL + '/1/push', json = [ 'a' ])
+        requests.get(URL + '/1/pop')
+        requests.post(URL + '/1/compact')
+
+        self.assertEqual(
+                0,
+                requests.post(URL + '/1/push?push_if_older_than=60', json = [ 'a' ]).json()
+            )
+
+        time.sleep(2)
+
+        self.assertEqual(
+                1,
+                requests.post(URL + '/1/push?push_if_older_than=1', json = [ 'a' ]).json()
+            )
+
+    def test_leased_entries_are_not_compacted(self):
+
+        requests.post(URL + '/1/push', json = [ 'LEASED' ])
+        self.assertEqual([ 'LEASED' ], requests.get(URL + '/1/pop?lease=1').json())
+
+        requests.post(URL + '/1/compact')
+
+        # Returned to the queue once the lease has been reaped
+        self.assertEqual(
+                [ 'LEASED' ],
+                requests.get(URL + '/1/pop?wait=30').json()
+            )
+
+    def test_compact_wrong_stage(self):
+
+        self.assertEqual(400, requests.post(URL + '/999/compact').status_code)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+import unittest
+import requests
+
+URL='http://plumber'
+
+def push_if_new(entries):
+
+    return requests.post(URL + '/1/push?push_if_new=true', json = entries).json()
+
+def seen():
+
+    return requests.get(URL + '/1/seen').json()
+
+class TestSeenCachewithHTTPAPIs(unittest.TestCase):
+
+    def setUp(self):
+
+        requests.post(URL + '/1/flush')
+
+        if not seen():
+            self.skipTest('seen-set cache disabled')
+
+    def assertAnswers(self, before, **increases):
+
+        after = seen()
+        self.assertEqual(
+                increases,
+                { answer: after[answer] - before[answer] for answer in increases }
+            )
+
+    def test_flush_resets_the_cache(self):
+
+        push_if_new([ 'a', 'b' ])
+        requests.post(URL + '/1/flush')
+
+        stats = seen()
+        self.assertTrue(stats['ready'])
+        self.assertEqual(0, stats['bloom_entries'])
+        self.assertEqual(0, stats['recent'])
+
+        # Pushed again once flushed
+        self.assertEqual(2, push_if_new([ 'a', 'b' ]))
+        self.assertAnswers(stats, new = 2, known = 0, maybe = 0)
+
+    def test_new_and_known_entries(self):
+
+        stats = seen()
+        self.assertEqual(2, push_if_new([ 'a', 'b' ]))
+        self.assertAnswers(stats, new = 2, known = 0, maybe = 0)
+
+        stats = seen()
+        self.assertEqual(0, push_if_new([ 'a', 'b' ]))
+        self.assertAnswers(stats, new = 0, known = 2, maybe = 0)
+
+    def test_maybe_entries_out_of_the_recent_ones(self):
+
+        recent_size = seen()['recent_size']
+        entries = [ 'entry-%d' % i for i in range(recent_size + 1) ]
+        self.assertEqual(len(entries), push_if_new(entries))
+
+        # The first entry is only left in the Bloom filter, and looked up
+        stats = seen()
+        self.assertEqual(0, push_if_new(entries[:1]))
+        self.assertAnswers(stats, new = 0, known = 0, maybe = 1)
+
+    def test_duplicates_after_compaction(self):
+
+        push_if_new([ 'a', 'b' ])
+        requests.get(URL + '/1/pop?quantity=2')
+        requests.post(URL + '/1/compact')
+
+        stats = seen()
+        self.assertEqual(0, push_if_new([ 'a', 'b' ]))
+        self.assertAnswers(stats, new = 0, known = 2, maybe = 0)
+
+    def test_warm_from_queue_and_history(self):
+
+        push_if_new([ 'a', 'b', 'c' ])
+        requests.get(URL + '/1/pop?quantity=2')
+        requests.post(URL + '/1/compact')
+
+        stats = requests.post(URL + '/1/seen').json()
+        self.assertTrue(stats['ready'])
+        self.assertEqual(3, stats['bloom_entries'])
+        self.assertEqual(0, stats['recent'])
+
+        # The compacted and the queued entries are looked up, the others are new
+        self.assertEqual(1, push_if_new([ 'a', 'b', 'c', 'd' ]))
+        self.assertAnswers(stats, new = 1, known = 0, maybe = 3)
+
+if __name__ == '__main__':
+    unittest.main()
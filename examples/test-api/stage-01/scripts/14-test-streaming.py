@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+import unittest
+import requests
+import json
+
+URL='http://plumber'
+
+def lines(response):
+    """Decode the entries of a ndjson response."""
+
+    return [ json.loads(line) for line in response.text.splitlines() ]
+
+class TestStreamingwithHTTPAPIs(unittest.TestCase):
+
+    def setUp(self):
+
+        requests.post(URL + '/1/flush')
+
+    def test_streamed_pop_in_batches(self):
+
+        # More entries than the entries claimed at once by a streamed pop
+        entries = [ 'entry-%d' % i for i in range(250) ]
+        self.assertEqual(250, requests.post(URL + '/1/push', json = entries).json())
+
+        response = requests.get(URL + '/1/pop?format=ndjson&quantity=300&lease=60')
+
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.headers['Content-Type'].startswith('application/x-ndjson'))
+        self.assertEqual(entries, lines(response))
+
+        # Every batch shares the claim token, acknowledged at once
+        self.assertEqual(
+                250,
+                requests.post(
+                    URL + '/1/ack',
+                    json = [ response.headers['X-Plumber-Claim'] ]
+                ).json()
+            )
+
+    def test_streamed_pop_quantity(self):
+
+        entries = [ 'entry-%d' % i for i in range(250) ]
+        requests.post(URL + '/1/push', json = entries)
+
+        self.assertEqual(
+                entries[:150],
+                lines(requests.get(URL + '/1/pop?format=ndjson&quantity=150'))
+            )
+        self.assertEqual(100, requests.get(URL + '/1/depth').json())
+
+    def test_streamed_pop_empty_queue(self):
+
+        response = requests.get(URL + '/1/pop?format=ndjson&quantity=10')
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('', response.text)
+
+    def test_streamed_load_and_delete(self):
+
+        # More entries than a batch of deletions
+        for i in range(1100):
+            requests.post(URL + '/1/store', json = { 'streamed': i })
+
+        response = requests.get(
+                URL + '/1/load?format=ndjson&delete=true&filter={"data.streamed":{"$exists":true}}'
+            )
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(
+                list(range(1100)),
+                sorted(entry['streamed'] for entry in lines(response))
+            )
+
+        self.assertEqual(
+                '',
+                requests.get(
+                    URL + '/1/load?format=ndjson&filter={"data.streamed":{"$exists":true}}'
+                ).text
+            )
+
+    def test_streamed_load_wrong_filter(self):
+
+        self.assertEqual(
+                400,
+                requests.get(URL + '/1/load?format=ndjson&filter=[]').status_code
+            )
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+import concurrent.futures.process
+import unittest
+import tempfile
+import requests
+import sys
+import os
+
+# Serve the first stage, pushing the results back to it, with short leases
+os.environ['STAGE'] = '1'
+os.environ['NEXT_STAGE'] = '1'
+os.environ['RUNNER_LEASE'] = '1'
+
+import plumber
+import plumber.runner
+
+URL='http://plumber'
+
+HANDLER = '''
+import os
+
+def handle(entry):
+
+    if entry == 'fail':
+        raise ValueError('failing entry')
+    if entry == 'crash':
+        os._exit(1)
+
+    return [ 'handled-%s' % entry ]
+'''
+
+class TestRunner(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+
+        cls.scripts_dir = tempfile.TemporaryDirectory()
+        with open(os.path.join(cls.scripts_dir.name, 'test_handler.py'), 'w') as handler:
+            handler.write(HANDLER)
+
+        sys.path.insert(0, cls.scripts_dir.name)
+
+    @classmethod
+    def tearDownClass(cls):
+
+        sys.path.remove(cls.scripts_dir.name)
+        cls.scripts_dir.cleanup()
+
+    def setUp(self):
+
+        plumber.flush(1)
+
+    def runner(self, mode):
+
+        runner = plumber.runner.Runner('test_handler', mode, 2)
+        self.addCleanup(runner.close)
+
+        return runner
+
+    def test_find_handlers(self):
+
+        self.assertEqual(
+                [ 'test_handler' ],
+                plumber.runner.find_handlers(self.scripts_dir.name)
+            )
+
+    def test_batch_is_pushed_and_acked(self):
+
+        for mode in [ 'threads', 'processes', 'asyncio' ]:
+            plumber.push(1, [ 'a', 'b' ])
+
+            self.runner(mode).run_batch()
+
+            self.assertEqual([ 'handled-a', 'handled-b' ], plumber.pop(1, 10))
+            self.assertEqual(0, plumber.stats(1)['in_flight'])
+
+    def test_failed_batch_is_handled_again(self):
+
+        plumber.push(1, [ 'a', 'fail' ])
+
+        with self.assertRaises(RuntimeError):
+            self.runner('threads').run_batch()
+
+        # Nothing pushed, the batch is returned once its lease expires
+        self.assertEqual([ 'a', 'fail' ], plumber.pop(1, 10, wait = 30))
+
+    def test_skip_failed_entries(self):
+
+        plumber.push(1, [ 'a', 'fail' ])
+
+        plumber.runner.RUNNER_SKIP_FAILED = True
+        try:
+            self.runner('threads').run_batch()
+        finally:
+            plumber.runner.RUNNER_SKIP_FAILED = False
+
+        self.assertEqual([ 'handled-a' ], plumber.pop(1, 10))
+        self.assertEqual(0, plumber.stats(1)['in_flight'])
+
+    def test_dead_worker_processes_are_restarted(self):
+
+        runner = self.runner('processes')
+
+        plumber.push(1, [ 'crash' ])
+        with self.assertRaises(concurrent.futures.process.BrokenProcessPool):
+            runner.run_batch()
+
+        plumber.flush(1)
+        plumber.push(1, [ 'b' ])
+        runner.run_batch()
+
+        self.assertEqual([ 'handled-b' ], plumber.pop(1, 10))
+
+    def test_failed_push_drops_the_buffered_results(self):
+
+        runner = self.runner('threads')
+
+        def failing_push(*args):
+            raise requests.ConnectionError('unreachable')
+
+        plumber.push(1, [ 'a', 'b' ])
+
+        push = plumber.push
+        plumber.push = failing_push
+        try:
+            with self.assertRaises(requests.ConnectionError):
+                runner.run_batch()
+        finally:
+            plumber.push = push
+
+        self.assertEqual([], runner.pusher.buffer)
+
+        # Handled again once the lease expires, without the former results
+        runner.run_batch()
+        self.assertEqual([ 'handled-a', 'handled-b' ], plumber.pop(1, 10))
+
+if __name__ == '__main__':
+    unittest.main()
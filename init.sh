@@ -5,10 +5,23 @@ set -a
 #Default container settings
 IDLE=60               # Time between scripts execution
 CONCURRENT_SCRIPTS=1  # Concurrency on scripts execution
+ADAPTIVE=false        # Adapt the scripts schedule to the stage queue depth
+MIN_CONCURRENT_SCRIPTS=1  # Lowest adaptive instances of every script
+MAX_CONCURRENT_SCRIPTS=   # Highest adaptive instances of every script, default is CONCURRENT_SCRIPTS
 REPLICAS=1            # Instances in a stage
+PLUMBER_ENGINE=mongo  # Storage engine of the queues: mongo, memory or sqlite
+
+#Default autoscaler settings
+AUTOSCALE_EXECUTOR=dry-run  # Setter of the stage replicas: compose, swarm or dry-run (no autoscaler service)
+AUTOSCALE_MIN_REPLICAS=1    # Fewest instances in a stage
+AUTOSCALE_MAX_REPLICAS=10   # Most instances in a stage
+AUTOSCALE_INTERVAL=30       # Time between scaling decisions
+AUTOSCALE_COOLDOWN=120      # Least time between two scalings of a stage
+AUTOSCALE_DRAIN_TIME=300    # Time to drain the backlog of a stage
 
 BASE_IMAGE=plumber-base-img
 API_IMAGE=plumber-api-img
+AUTOSCALER_IMAGE=plumber-autoscaler-img
 
 function parse_argument() {
 
@@ -110,11 +123,28 @@ function build_api_image() {
 
   echo "OK"
 
+}
+
+function build_autoscaler_image() {
+
+  printf "[+] Autoscaler image $AUTOSCALER_IMAGE.. "
+
+  BUILDLOG="$(mktemp)"
+  docker build $NO_CACHE --tag $AUTOSCALER_IMAGE resources/autoscaler/ &>$BUILDLOG || { 
+    echo -e "ERROR\n    See $BUILDLOG for more info" 
+    exit 1
+  }
+
+  echo "OK"
+
 }
 function check_pipeline_folder() {
 
   test -z "$PIPELINE_NAME" && PIPELINE_NAME="$(basename $PIPELINE_FOLDER)"
 
+  # Compose project of the pipeline, as named by docker-compose
+  AUTOSCALE_PROJECT="$(basename $PIPELINE_FOLDER)"
+
   printf "[+] $PIPELINE_NAME folder pipeline $PIPELINE_FOLDER.. "
     
   # Check pipeline folder presence
@@ -166,6 +196,23 @@ function add_pipeline_compose() {
   echo "OK"
 }
 
+function add_autoscaler_compose() {
+
+  printf "[+] $PIPELINE_NAME autoscaler compose service.. "
+
+  envsubst < resources/pipeline/docker-compose.autoscaler.yml >> "${PIPELINE_COMPOSEFILE}" || {
+   echo -e "ERROR\n    Error creating ${PIPELINE_COMPOSEFILE}" 
+   exit 1
+  }
+  echo "OK"
+}
+
+function autoscaled() {
+
+  # Only the compose and swarm executors run in the pipeline, on the Docker socket
+  [[ "$AUTOSCALE_EXECUTOR" == "compose" || "$AUTOSCALE_EXECUTOR" == "swarm" ]]
+}
+
 function copy_stage_data() {
 
   printf "[+] $STAGE_NAME stage data.. "
@@ -232,11 +279,13 @@ cd "$(dirname "$(realpath "$0")")";
 
 build_base_image
 build_api_image
+autoscaled && build_autoscaler_image
 
 test -z "$BUILD_ONLY" && { 
 
   check_pipeline_folder
   add_pipeline_compose
+  autoscaled && add_autoscaler_compose
 
   STAGE_COMPOSEFILE="$PIPELINE_FOLDER/docker-compose.yml"
 
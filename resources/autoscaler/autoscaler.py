@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""Controller scaling the replicas of the pipeline stages by their backlog.
+
+Every interval, the controller reads the statistics of the stage queues from
+the /_stats endpoint of the Plumber API, and computes the replicas needed by
+every stage to keep up with its push rate and to drain its backlog within the
+drain time, from the pop rate per replica. The targets are bounded by the
+minimum and maximum replicas, and a stage is not scaled again before the
+cooldown since its latest scaling. The replicas are set by an executor:
+
+    compose: docker-compose up --scale, from the pipeline folder.
+    swarm: docker service update --replicas, on the services of a stack.
+    dry-run: only log the scalings, keeping the replicas in memory.
+"""
+import subprocess
+import requests
+import logging
+import math
+import time
+import re
+import os
+
+# Controller settings
+
+PLUMBER_URL = os.getenv('PLUMBER_URL', 'http://plumber')
+STAGES_QTY = int(os.getenv('STAGES_QTY', 0))
+AUTOSCALE_EXECUTOR = os.getenv('AUTOSCALE_EXECUTOR', 'dry-run').lower()  # Setter of the replicas: compose, swarm or dry-run
+AUTOSCALE_INTERVAL = int(os.getenv('AUTOSCALE_INTERVAL', 30))  # Time between scaling decisions, in seconds
+AUTOSCALE_COOLDOWN = int(os.getenv('AUTOSCALE_COOLDOWN', 120))  # Least time between two scalings of a stage, in seconds
+AUTOSCALE_DRAIN_TIME = int(os.getenv('AUTOSCALE_DRAIN_TIME', 300))  # Time to drain the backlog of a stage, in seconds
+AUTOSCALE_MIN_REPLICAS = int(os.getenv('AUTOSCALE_MIN_REPLICAS', 1))  # Fewest replicas of a stage, overridden by AUTOSCALE_MIN_REPLICAS_<stage>
+AUTOSCALE_MAX_REPLICAS = int(os.getenv('AUTOSCALE_MAX_REPLICAS', 10))  # Most replicas of a stage, overridden by AUTOSCALE_MAX_REPLICAS_<stage>
+AUTOSCALE_PROJECT = os.getenv('AUTOSCALE_PROJECT', '')  # Compose project or Swarm stack of the pipeline
+COMPOSE_COMMAND = os.getenv('COMPOSE_COMMAND', 'docker-compose')
+REQUEST_TIMEOUT = 10  # Timeout of the statistics requests, in seconds
+
+# Logging settings
+
+log = logging.getLogger('app')
+log.setLevel(logging.DEBUG)
+
+f = logging.Formatter(
+        '[{levelname[0]}] [{asctime}] {message}',
+        datefmt = '%d-%m-%Y %H:%M:%S',
+        style = '{'
+        )
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(f)
+log.addHandler(ch)
+
+def service_name(stage):
+    """Get the compose service name of a stage."""
+
+    return 'stage-%02d' % stage
+
+def stage_setting(name, stage, default):
+    """Get a per-stage integer setting, e.g. AUTOSCALE_MAX_REPLICAS_03, or its default."""
+
+    return int(os.getenv('%s_%02d' % (name, stage), default))
+
+def project_name(name):
+    """Normalize a project name as docker-compose does."""
+
+    return re.sub(r'[^-_a-z0-9]', '', name.lower())
+
+def target_replicas(stats, current, minimum, maximum, drain_time):
+    """Compute the replicas a stage needs.
+
+    Parameters:
+
+        stats: The statistics of the stage queue, as returned by the API.
+        current: The current replicas of the stage.
+        minimum: The fewest replicas of the stage.
+        maximum: The most replicas of the stage.
+        drain_time: The time to drain the backlog, in seconds.
+
+    Returns: the target replicas, within the bounds.
+    """
+
+    backlog = stats['ready'] + stats['in_flight']
+
+    if not backlog and not stats['push_rate']:
+        target = minimum
+    elif current and stats['pop_rate']:
+        # Keep up with the pushes and drain the backlog in time, at the
+        # throughput of the current replicas
+        per_replica = stats['pop_rate'] / current
+        target = math.ceil((stats['push_rate'] + backlog / drain_time) / per_replica)
+    else:
+        # No throughput to size from yet: grow a replica at a time while
+        # entries are waiting
+        target = current + 1 if stats['ready'] else current
+
+    return min(max(target, minimum), maximum)
+
+class DryRunExecutor:
+    """Log the scalings without applying them, keeping the replicas in memory.
+
+    Parameters:
+
+        initial: The replicas of every stage at start.
+    """
+
+    def __init__(self, initial = AUTOSCALE_MIN_REPLICAS):
+
+        self.initial = initial
+        self.current = {}
+
+    def replicas(self, stage):
+
+        return self.current.get(stage, self.initial)
+
+    def scale(self, stage, replicas):
+
+        self.current[stage] = replicas
+
+class ComposeExecutor:
+    """Scale the services of a docker-compose project.
+
+    Parameters:
+
+        project: The compose project name, by default the one of the current folder.
+        command: The docker-compose command.
+    """
+
+    def __init__(self, project = AUTOSCALE_PROJECT, command = COMPOSE_COMMAND):
+
+        self.command = command.split()
+        if project:
+            self.command += [ '-p', project_name(project) ]
+
+    def replicas(self, stage):
+
+        result = subprocess.run(
+                self.command + [ 'ps', '-q', service_name(stage) ],
+                stdout = subprocess.PIPE,
+                check = True
+            )
+
+        return len(result.stdout.split())
+
+    def scale(self, stage, replicas):
+
+        # Leave the running containers and the other services untouched
+        subprocess.run(
+                self.command + [
+                    'up', '-d', '--no-deps', '--no-recreate',
+                    '--scale', '%s=%d' % (service_name(stage), replicas),
+                    service_name(stage)
+                ],
+                check = True
+            )
+
+class SwarmExecutor:
+    """Scale the services of a Swarm stack.
+
+    Parameters:
+
+        stack: The stack name.
+    """
+
+    def __init__(self, stack = AUTOSCALE_PROJECT):
+
+        if not stack:
+            raise ValueError('the swarm executor needs the AUTOSCALE_PROJECT stack name')
+
+        self.stack = stack
+
+    def service(self, stage):
+
+        return '%s_%s' % (self.stack, service_name(stage))
+
+    def replicas(self, stage):
+
+        result = subprocess.run(
+                [
+                    'docker', 'service', 'inspect',
+                    '--format', '{{.Spec.Mode.Replicated.Replicas}}',
+                    self.service(stage)
+                ],
+                stdout = subprocess.PIPE,
+                check = True
+            )
+
+        return int(result.stdout)
+
+    def scale(self, stage, replicas):
+
+        subprocess.run(
+                [
+                    'docker', 'service', 'update', '--detach',
+                    '--replicas', str(replicas),
+                    self.service(stage)
+                ],
+                check = True
+            )
+
+EXECUTORS = {
+    'compose': ComposeExecutor,
+    'swarm': SwarmExecutor,
+    'dry-run': DryRunExecutor
+}
+
+class Controller:
+    """Scale the stages of a pipeline by the statistics of their queues.
+
+    Parameters:
+
+        executor: The executor setting the replicas.
+        stages_qty: The number of stages.
+    """
+
+    def __init__(self, executor, stages_qty = STAGES_QTY):
+
+        self.executor = executor
+        self.stages_qty = stages_qty
+
+        # Time of the latest scaling, by stage number
+        self.scaled = {}
+
+    def run_once(self, all_stats, now):
+        """Scale the stages out of their cooldown.
+
+        Parameters:
+
+            all_stats: The statistics of the stage queues, by stage number as returned by /_stats.
+            now: The current monotonic time.
+
+        Returns: the applied scalings, as a dictionary of replicas by stage number.
+        """
+
+        scalings = {}
+
+        for stage in range(1, self.stages_qty + 1):
+
+            stats = all_stats.get(str(stage))
+            if not stats:
+                continue
+
+            if stage in self.scaled and now - self.scaled[stage] < AUTOSCALE_COOLDOWN:
+                continue
+
+            current = self.executor.replicas(stage)
+            target = target_replicas(
+                    stats,
+                    current,
+                    stage_setting('AUTOSCALE_MIN_REPLICAS', stage, AUTOSCALE_MIN_REPLICAS),
+                    stage_setting('AUTOSCALE_MAX_REPLICAS', stage, AUTOSCALE_MAX_REPLICAS),
+                    AUTOSCALE_DRAIN_TIME
+                )
+
+            if target == current:
+                continue
+
+            log.info(
+                    'stage-%d scales %d -> %d replicas (ready %d, in flight %d, push %.2f/s, pop %.2f/s)' % (
+                        stage,
+                        current,
+                        target,
+                        stats['ready'],
+                        stats['in_flight'],
+                        stats['push_rate'],
+                        stats['pop_rate']
+                        )
+                    )
+
+            self.executor.scale(stage, target)
+            self.scaled[stage] = now
+            scalings[stage] = target
+
+        return scalings
+
+    def run(self):
+        """Scale the stages every interval, forever."""
+
+        while True:
+            try:
+                response = requests.get(PLUMBER_URL + '/_stats', timeout = REQUEST_TIMEOUT)
+                response.raise_for_status()
+
+                self.run_once(response.json(), time.monotonic())
+            except Exception as e:
+                log.warning('scaling error: %s' % str(e))
+
+            time.sleep(AUTOSCALE_INTERVAL)
+
+def main():
+
+    if AUTOSCALE_EXECUTOR not in EXECUTORS:
+        raise ValueError('wrong autoscale executor %s' % AUTOSCALE_EXECUTOR)
+
+    log.debug('autoscaler started with the %s executor' % AUTOSCALE_EXECUTOR)
+
+    Controller(EXECUTORS[AUTOSCALE_EXECUTOR]()).run()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+import unittest
+import os
+
+import autoscaler
+
+def stats(ready = 0, in_flight = 0, push_rate = 0, pop_rate = 0):
+
+    return {
+        'ready': ready,
+        'in_flight': in_flight,
+        'push_rate': push_rate,
+        'pop_rate': pop_rate
+    }
+
+class TestTargetReplicas(unittest.TestCase):
+
+    def test_idle_stage_scales_to_the_minimum(self):
+
+        self.assertEqual(2, autoscaler.target_replicas(stats(), 5, 2, 10, 300))
+
+    def test_keep_up_with_the_pushes(self):
+
+        # 2 replicas popping 10/s each, 30/s pushed and no backlog
+        self.assertEqual(
+                3,
+                autoscaler.target_replicas(stats(push_rate = 30, pop_rate = 20), 2, 1, 10, 300)
+            )
+
+    def test_drain_the_backlog_in_time(self):
+
+        # 600 entries to drain in 300s at 1/s per replica, on top of 1/s pushed
+        self.assertEqual(
+                3,
+                autoscaler.target_replicas(
+                    stats(ready = 500, in_flight = 100, push_rate = 1, pop_rate = 2),
+                    2, 1, 10, 300
+                )
+            )
+
+        # Rounded up, 601 entries need a 4th replica
+        self.assertEqual(
+                4,
+                autoscaler.target_replicas(
+                    stats(ready = 501, in_flight = 100, push_rate = 1, pop_rate = 2),
+                    2, 1, 10, 300
+                )
+            )
+
+    def test_bounded_by_the_maximum(self):
+
+        self.assertEqual(
+                10,
+                autoscaler.target_replicas(stats(ready = 10 ** 6, pop_rate = 1), 1, 1, 10, 300)
+            )
+
+    def test_bounded_by_the_minimum(self):
+
+        # Popping far faster than needed
+        self.assertEqual(
+                2,
+                autoscaler.target_replicas(stats(ready = 1, push_rate = 1, pop_rate = 100), 5, 2, 10, 300)
+            )
+
+    def test_grow_one_replica_without_throughput(self):
+
+        self.assertEqual(3, autoscaler.target_replicas(stats(ready = 10), 2, 1, 10, 300))
+        self.assertEqual(10, autoscaler.target_replicas(stats(ready = 10), 10, 1, 10, 300))
+
+        # Only in-flight entries, waiting for the current replicas
+        self.assertEqual(2, autoscaler.target_replicas(stats(in_flight = 10), 2, 1, 10, 300))
+
+class TestController(unittest.TestCase):
+
+    def setUp(self):
+
+        self.executor = autoscaler.DryRunExecutor(initial = 1)
+        self.controller = autoscaler.Controller(self.executor, stages_qty = 2)
+
+    def test_scale_the_stages(self):
+
+        all_stats = {
+            '1': stats(ready = 10),
+            '2': stats()
+        }
+
+        self.assertEqual({ 1: 2 }, self.controller.run_once(all_stats, 0))
+        self.assertEqual(2, self.executor.replicas(1))
+        self.assertEqual(1, self.executor.replicas(2))
+
+    def test_cooldown(self):
+
+        all_stats = { '1': stats(ready = 10) }
+
+        self.assertEqual({ 1: 2 }, self.controller.run_once(all_stats, 0))
+
+        # Not scaled again before the cooldown since the latest scaling
+        self.assertEqual({}, self.controller.run_once(all_stats, autoscaler.AUTOSCALE_COOLDOWN - 1))
+        self.assertEqual(
+                { 1: 3 },
+                self.controller.run_once(all_stats, autoscaler.AUTOSCALE_COOLDOWN)
+            )
+
+    def test_unchanged_stage_has_no_cooldown(self):
+
+        self.assertEqual({}, self.controller.run_once({ '1': stats() }, 0))
+        self.assertEqual({ 1: 2 }, self.controller.run_once({ '1': stats(ready = 10) }, 1))
+
+    def test_per_stage_bounds(self):
+
+        all_stats = { '1': stats(ready = 10 ** 6, pop_rate = 1) }
+
+        os.environ['AUTOSCALE_MAX_REPLICAS_01'] = '4'
+        try:
+            self.assertEqual({ 1: 4 }, self.controller.run_once(all_stats, 0))
+        finally:
+            del os.environ['AUTOSCALE_MAX_REPLICAS_01']
+
+    def test_missing_stage_statistics(self):
+
+        self.assertEqual({}, self.controller.run_once({ '3': stats(ready = 10) }, 0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,635 @@
+#!/usr/bin/env python3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import requests
+import os
+import logging
+import json
+import gzip
+import zlib
+import threading
+import queue
+import time
+
+# Optional binary msgpack format
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Optional zstd content encoding
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PLUMBER_URL = os.getenv('PLUMBER_URL', 'http://plumber').rstrip('/')
+
+# Seconds to wait for a connection and for a response, longer than the
+# longest wait of a pop on the API side
+CONNECT_TIMEOUT = float(os.getenv('PLUMBER_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.getenv('PLUMBER_READ_TIMEOUT', 90))
+
+# Attempts to reach the API, with an exponential backoff in seconds
+RETRIES = int(os.getenv('PLUMBER_RETRIES', 3))
+RETRY_BACKOFF = float(os.getenv('PLUMBER_RETRY_BACKOFF', 0.5))
+
+# Most keep-alive connections to the API kept open by a process
+POOL_SIZE = int(os.getenv('PLUMBER_POOL_SIZE', 10))
+
+# Wire format of the request and response bodies, json or msgpack
+FORMAT = os.getenv('PLUMBER_FORMAT', 'json').lower()
+
+# Content encoding of the request bodies, gzip, deflate or zstd. Default
+# is none. The responses are compressed with the encodings that requests
+# can decode, advertised by its Accept-Encoding header.
+COMPRESSION = os.getenv('PLUMBER_COMPRESSION', '').lower()
+
+# Smallest request body compressed, in bytes
+COMPRESS_MIN_SIZE = 1024
+
+# Most seconds a Pusher waits before pushing again after failed pushes
+PUSHER_MAX_BACKOFF = 60
+
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'msgpack': 'application/msgpack'
+}
+
+session = None
+
+log = logging.getLogger('app')
+
+def _lazy_connect():
+    global session
+
+    if not session:
+        # Only the connection errors are retried. The requests which have
+        # reached the API are not, as pops and pushes are not idempotent.
+        retry = Retry(
+                total = RETRIES,
+                connect = RETRIES,
+                read = 0,
+                status = 0,
+                backoff_factor = RETRY_BACKOFF
+            )
+
+        adapter = HTTPAdapter(
+                pool_connections = 1,
+                pool_maxsize = POOL_SIZE,
+                max_retries = retry
+            )
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+
+def _encode(data):
+    """Encode a request body in the configured wire format and content encoding.
+
+    Parameters:
+
+        data: The body object.
+
+    Returns: the body bytes and their headers.
+    """
+
+    if FORMAT == 'msgpack':
+        body = msgpack.packb(data, use_bin_type = True)
+    else:
+        body = json.dumps(data).encode('utf-8')
+
+    headers = { 'Content-Type': CONTENT_TYPES[FORMAT] }
+
+    if COMPRESSION and len(body) >= COMPRESS_MIN_SIZE:
+        if COMPRESSION == 'zstd':
+            body = zstandard.ZstdCompressor().compress(body)
+        elif COMPRESSION == 'gzip':
+            body = gzip.compress(body)
+        else:
+            body = zlib.compress(body)
+
+        headers['Content-Encoding'] = COMPRESSION
+
+    return body, headers
+
+def _decode_body(body, content_type):
+    """Decode a response body, according to its content type."""
+
+    if content_type.startswith(CONTENT_TYPES['msgpack']):
+        return msgpack.unpackb(body, raw = False)
+
+    return json.loads(body)
+
+def _decode(response):
+    """Decode a response body, according to its content type."""
+
+    return _decode_body(response.content, response.headers.get('Content-Type', ''))
+
+def _request(method, stage, endpoint, params = None, data = None, body = None, headers = None):
+    """Send a request to a stage endpoint of the HTTP API.
+
+    Parameters:
+
+        method: The HTTP method.
+        stage: The number of the stage queue.
+        endpoint: The endpoint name.
+        params: The query parameters.
+        data: The body object, encoded in the configured format.
+        body: The raw body, if no body object.
+        headers: The additional headers.
+
+    Returns: the response, raising requests.HTTPError on error statuses.
+    """
+
+    _lazy_connect()
+
+    headers = dict(headers or {})
+    headers['Accept'] = CONTENT_TYPES[FORMAT]
+
+    if data is not None:
+        body, body_headers = _encode(data)
+        headers.update(body_headers)
+
+    response = session.request(
+            method,
+            '%s/%d/%s' % (PLUMBER_URL, stage, endpoint),
+            params = params,
+            data = body,
+            headers = headers,
+            timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+        )
+    response.raise_for_status()
+
+    return response
+
+def _rejected(error):
+    """Tell if a request error is a rejection by the API, which would be rejected again if retried."""
+
+    return (
+            isinstance(error, requests.HTTPError) and 
+            error.response is not None and 
+            400 <= error.response.status_code < 500 and
+            error.response.status_code not in (408, 429)
+        )
+
+def depth(stage):
+    """Count the entries waiting in a stage queue.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+
+    Returns: the number of unconsumed entries.
+    """
+
+    return _decode(_request('GET', stage, 'depth'))
+
+def stats(stage):
+    """Get the statistics of a stage queue.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+
+    Returns: the ready, in-flight and consumed entries, the age of the oldest ready entry and the push and pop rates.
+    """
+
+    return _decode(_request('GET', stage, 'stats'))
+
+def flush(stage):
+    """
+    Flush stage queue.
+    """
+
+    _request('POST', stage, 'flush')
+
+    log.debug('stage-%d delete' % (stage))
+
+
+def pop(stage, quantity = 1, lease = None, wait = 0):
+    """Pop entries from a stage queue.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        quantity: The number of entries to retrieve. Default is 1.
+        lease: Lease the entries for a number of seconds, after which they are returned to the queue if not acknowledged. Default is the LEASE_TIMEOUT setting of the API, 0 (disabled).
+        wait: Wait up to a number of seconds for entries to be pushed, if the queue is empty. Default is 0 (disabled).
+
+    Returns the data objects.
+    """
+
+    token, results = claim(stage, quantity, lease, wait)
+
+    return results
+
+def claim(stage, quantity = 1, lease = None, wait = 0):
+    """Pop entries from a stage queue, along with their claim token.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        quantity: The number of entries to retrieve. Default is 1.
+        lease: Lease the entries for a number of seconds, after which they are returned to the queue if not acknowledged. Default is the LEASE_TIMEOUT setting of the API, 0 (disabled).
+        wait: Wait up to a number of seconds for entries to be pushed, if the queue is empty. Default is 0 (disabled).
+
+    Returns: the claim token and the data objects.
+    """
+
+    token, results, leased = _claim(stage, quantity, lease, wait)
+
+    return token, results
+
+def _claim(stage, quantity, lease, wait):
+    """Pop entries from a stage queue, along with their claim token and their lease.
+
+    Returns: the claim token, the data objects and the lease in seconds, 0 if not leased.
+    """
+
+    params = { 'quantity': quantity, 'wait': wait }
+    if lease is not None:
+        params['lease'] = lease
+
+    response = _request('GET', stage, 'pop', params = params)
+
+    results = _decode(response)
+
+    log.debug(
+            'stage-%d pops %d/%d' % (
+                stage,
+                len(results),
+                quantity
+                )
+            )
+    return (
+            response.headers.get('X-Plumber-Claim'), 
+            results, 
+            int(response.headers.get('X-Plumber-Lease', 0))
+        )
+
+def consume(stage, batch = 100, prefetch = 1, lease = None, wait = 0):
+    """Iterate the entries of a stage queue, popping the next batches in background.
+
+    A background thread keeps popping batches of entries while the caller is
+    processing the current one, up to a number of batches ahead. The iteration 
+    ends when the queue stays empty for the wait time. The leased batches are 
+    acknowledged once the caller moves past their last entry. When the caller 
+    stops iterating early, the prefetched entries are dropped: lease them to 
+    get them back to the queue.
+
+        for entry in plumber.consume(STAGE, batch = 100, lease = 300):
+            process(entry)
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        batch: The number of entries of every pop. Default is 100.
+        prefetch: The number of batches popped ahead of the current one. Default is 1.
+        lease: Lease the entries for a number of seconds, after which they are returned to the queue if not acknowledged. Default is the LEASE_TIMEOUT setting of the API, 0 (disabled, not acknowledged).
+        wait: Wait up to a number of seconds for entries to be pushed, if the queue is empty. Default is 0 (disabled).
+
+    Returns: a generator of the data objects.
+    """
+
+    # Holds the popped batches, bounding the prefetched entries
+    batches = queue.Queue(maxsize = max(prefetch, 1))
+    stopping = threading.Event()
+
+    def fetch():
+
+        try:
+            while not stopping.is_set():
+                token, results, leased = _claim(stage, batch, lease, wait)
+                batches.put((token, results, leased))
+
+                if not results:
+                    return
+        except Exception as e:
+            batches.put((None, e, 0))
+
+    threading.Thread(target = fetch, daemon = True).start()
+
+    try:
+        while True:
+            token, results, leased = batches.get()
+
+            if isinstance(results, Exception):
+                raise results
+            if not results:
+                return
+
+            yield from results
+
+            # Nothing to acknowledge without a lease, e.g. by default with 
+            # the LEASE_TIMEOUT setting of the API disabled
+            if leased:
+                ack(stage, [ token ])
+
+    finally:
+        stopping.set()
+
+        # Unblock the background thread, dropping the prefetched batches
+        while True:
+            try:
+                batches.get_nowait()
+            except queue.Empty:
+                break
+
+def ack(stage, claims):
+    """Acknowledge the processing of leased entries.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        claims: List of claim tokens of the leased entries.
+
+    Returns: the number of acknowledged entries.
+    """
+
+    acked = _decode(_request('POST', stage, 'ack', data = list(claims)))
+
+    log.debug(
+            'stage-%d acks %d' % (
+                stage,
+                acked
+                )
+            )
+    return acked
+
+def push(stage, entry_list, push_if_new = False, push_if_older_than = 0):
+    """Push entries to a stage queue.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        entry_list: List of objects.
+        push_if_new: Push only the entries which haven't been previously pushed. Default is false.
+        push_if_older_than: Push only the entries which haven't been previously pushed or that have been older than a number of seconds. Default is 0 (disabled).
+
+    Returns: the number of pushed entries.
+    """
+
+    # Silently exit on empty lists
+    if not entry_list:
+        return []
+
+    params = {}
+    if push_if_new:
+        params['push_if_new'] = 'true'
+    if push_if_older_than:
+        params['push_if_older_than'] = push_if_older_than
+
+    pushed = _decode(_request('POST', stage, 'push', params = params, data = list(entry_list)))
+
+    log.debug(
+            'pushed to stage-%d %d/%d' % (
+                stage,
+                pushed,
+                len(entry_list)
+                )
+            )
+    return pushed
+
+class Pusher:
+    """Buffer entries and push them to a stage queue in batches.
+
+    The buffered entries are pushed from a background thread when they reach
+    a number of entries or of bytes, or are older than an interval, and when
+    the pusher is closed or exits as context manager. The background pushes 
+    which fail are retried after the interval, doubling the wait at every 
+    failure up to PUSHER_MAX_BACKOFF seconds, while the batches rejected by 
+    the API are dropped and counted. When the background thread falls 
+    behind, pushing blocks until the buffer is drained.
+
+        with plumber.Pusher(NEXT_STAGE, push_if_new = True) as pusher:
+            for result in results:
+                pusher.push(result)
+
+    Parameters:
+
+        stage: The number of stage queue.
+        push_if_new: Push only the entries which haven't been previously pushed. Default is false.
+        push_if_older_than: Push only the entries which haven't been previously pushed or that have been older than a number of seconds. Default is 0 (disabled).
+        max_entries: Push when buffering a number of entries. Default is 1000.
+        max_bytes: Push when buffering a number of bytes of JSON entries. Default is 512KB.
+        interval: Push the entries buffered for a number of seconds. Default is 1.
+    """
+
+    def __init__(self, stage, push_if_new = False, push_if_older_than = 0, 
+            max_entries = 1000, max_bytes = 512*1024, interval = 1):
+
+        self.stage = stage
+        self.push_if_new = push_if_new
+        self.push_if_older_than = push_if_older_than
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.interval = interval
+
+        # Number of entries pushed so far, and of entries rejected by the API
+        self.pushed = 0
+        self.dropped = 0
+
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.closed = False
+
+        # Guards the buffer, signalling when it fills up or is drained
+        self.condition = threading.Condition()
+
+        # Keeps the batches in order, one push at a time
+        self.pushing = threading.Lock()
+
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _full(self):
+        return len(self.buffer) >= self.max_entries or self.buffer_bytes >= self.max_bytes
+
+    def _run(self):
+
+        # Seconds to wait before pushing again after a failed push
+        backoff = 0
+
+        while True:
+
+            with self.condition:
+                deadline = time.monotonic() + (backoff or self.interval)
+
+                # Push as soon as the buffer fills up, unless backing off
+                while not self.closed and (backoff or not self._full()):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+
+                if self.closed:
+                    return
+
+            try:
+                self.flush()
+                backoff = 0
+            except Exception as e:
+                if _rejected(e):
+                    log.warning('stage-%d background push rejected, batch dropped: %s' % (self.stage, str(e)))
+                else:
+                    backoff = min(2 * backoff or self.interval or 1, PUSHER_MAX_BACKOFF)
+                    log.warning(
+                            'stage-%d background push failed, retrying in %.1fs: %s' % (
+                                self.stage, 
+                                backoff, 
+                                str(e)
+                                )
+                            )
+
+    def push(self, entry):
+        """Buffer an entry to be pushed.
+
+        Parameters:
+
+            entry: The entry object.
+        """
+
+        entry_bytes = len(json.dumps(entry)) + 1
+
+        with self.condition:
+            if self.closed:
+                raise ValueError('push to a closed pusher')
+
+            # Apply backpressure when the background pushes fall behind
+            while len(self.buffer) >= 2*self.max_entries or self.buffer_bytes >= 2*self.max_bytes:
+                self.condition.wait()
+
+            self.buffer.append(entry)
+            self.buffer_bytes += entry_bytes
+
+            if self._full():
+                self.condition.notify_all()
+
+    def flush(self):
+        """Push all the buffered entries.
+
+        A batch rejected by the API is dropped, any other failed batch is
+        kept to be pushed again, and the error is raised.
+
+        Returns: the number of pushed entries.
+        """
+
+        with self.pushing:
+
+            with self.condition:
+                batch, batch_bytes = self.buffer, self.buffer_bytes
+                self.buffer, self.buffer_bytes = [], 0
+                self.condition.notify_all()
+
+            if not batch:
+                return 0
+
+            try:
+                pushed = push(self.stage, batch, self.push_if_new, self.push_if_older_than)
+            except Exception as e:
+                if _rejected(e):
+                    self.dropped += len(batch)
+                else:
+                    # Put the batch back in front, to be pushed again
+                    with self.condition:
+                        self.buffer = batch + self.buffer
+                        self.buffer_bytes += batch_bytes
+                raise
+
+            self.pushed += pushed
+            return pushed
+
+    def clear(self):
+        """Drop the buffered entries, without pushing them.
+
+        Returns: the number of dropped entries.
+        """
+
+        with self.pushing:
+            with self.condition:
+                cleared = len(self.buffer)
+                self.buffer, self.buffer_bytes = [], 0
+                self.condition.notify_all()
+
+        return cleared
+
+    def close(self):
+        """Stop the background thread and push all the buffered entries."""
+
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+        self.thread.join()
+        self.flush()
+
+def store(stage, json_data):
+    """Store an entry to the database.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        json_data: The entry object.
+
+    Returns the Mongo ObjectID of the insterted object in string format.
+    """
+
+    # Text entries are stored as plain text, the API only accepts objects and lists
+    if isinstance(json_data, str):
+        response = _request(
+                'POST',
+                stage,
+                'store',
+                params = { 'format': 'plain' },
+                body = json_data.encode('utf-8')
+            )
+        id_ = response.text
+    else:
+        id_ = _decode(_request('POST', stage, 'store', data = json_data))
+
+    log.debug(
+            'stored to stage-%d' % (
+                stage,
+                )
+            )
+
+    return id_
+
+def load(stage, filter_, delete):
+    """Load an entry from the database.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        filter_: The filter JSON object, as accepted by Mongo find_one.
+        delete: Delete the matching objects.
+
+    Returns: the requested entry document, with its _id and its data, None if not found.
+    """
+
+    params = { 'filter': json.dumps(filter_, default = str), 'document': 'true' }
+    if delete:
+        params['delete'] = 'true'
+
+    result = _decode(_request('GET', stage, 'load', params = params))
+
+    # The API answers an empty object when nothing matches
+    if not result:
+        result = None
+
+    log.debug(
+            'loaded%s from stage-%d %d/1' % (
+                ' and deleted' if delete else '',
+                stage,
+                1 if result is not None else 0
+                )
+            )
+
+    return result
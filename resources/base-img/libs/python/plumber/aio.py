@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+from plumber import (
+        PLUMBER_URL, CONNECT_TIMEOUT, READ_TIMEOUT, RETRIES, RETRY_BACKOFF,
+        FORMAT, CONTENT_TYPES, _encode, _decode_body
+    )
+import aiohttp
+import asyncio
+import os
+import logging
+import json
+
+# Most connections to the API shared by all the tasks of a process
+POOL_SIZE = int(os.getenv('PLUMBER_AIO_POOL_SIZE', 100))
+
+session = None
+session_loop = None
+
+log = logging.getLogger('app')
+
+def _lazy_connect():
+    global session, session_loop
+
+    # Sessions are bound to the event loop they are created in
+    loop = asyncio.get_event_loop()
+
+    if not session or session.closed or session_loop is not loop:
+        session_loop = loop
+        session = aiohttp.ClientSession(
+                connector = aiohttp.TCPConnector(limit = POOL_SIZE),
+                timeout = aiohttp.ClientTimeout(
+                    total = None,
+                    sock_connect = CONNECT_TIMEOUT,
+                    sock_read = READ_TIMEOUT
+                )
+            )
+
+async def close():
+    """Close the shared session and its connections."""
+
+    global session
+
+    if session and not session.closed:
+        await session.close()
+
+    session = None
+
+async def _request(method, stage, endpoint, params = None, data = None, body = None):
+    """Send a request to a stage endpoint of the HTTP API.
+
+    Parameters:
+
+        method: The HTTP method.
+        stage: The number of the stage queue.
+        endpoint: The endpoint name.
+        params: The query parameters.
+        data: The body object, encoded in the configured format.
+        body: The raw body, if no body object.
+
+    Returns: the response headers and body, raising aiohttp.ClientResponseError on error statuses.
+    """
+
+    _lazy_connect()
+
+    headers = { 'Accept': CONTENT_TYPES[FORMAT] }
+
+    if data is not None:
+        body, body_headers = _encode(data)
+        headers.update(body_headers)
+
+    # Only the connection errors are retried. The requests which have
+    # reached the API are not, as pops and pushes are not idempotent.
+    for attempt in range(RETRIES + 1):
+        try:
+            async with session.request(
+                    method,
+                    '%s/%d/%s' % (PLUMBER_URL, stage, endpoint),
+                    params = params,
+                    data = body,
+                    headers = headers
+                    ) as response:
+
+                response.raise_for_status()
+                return response.headers, await response.read()
+
+        except aiohttp.ClientConnectorError:
+            if attempt >= RETRIES:
+                raise
+
+        await asyncio.sleep(RETRY_BACKOFF * 2**attempt)
+
+async def _decoded_request(*args, **kwargs):
+
+    headers, body = await _request(*args, **kwargs)
+
+    return _decode_body(body, headers.get('Content-Type', ''))
+
+async def depth(stage):
+    """Count the entries waiting in a stage queue.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+
+    Returns: the number of unconsumed entries.
+    """
+
+    return await _decoded_request('GET', stage, 'depth')
+
+async def stats(stage):
+    """Get the statistics of a stage queue.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+
+    Returns: the ready, in-flight and consumed entries, the age of the oldest ready entry and the push and pop rates.
+    """
+
+    return await _decoded_request('GET', stage, 'stats')
+
+async def flush(stage):
+    """
+    Flush stage queue.
+    """
+
+    await _request('POST', stage, 'flush')
+
+    log.debug('stage-%d delete' % (stage))
+
+async def pop(stage, quantity = 1, lease = None, wait = 0):
+    """Pop entries from a stage queue.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        quantity: The number of entries to retrieve. Default is 1.
+        lease: Lease the entries for a number of seconds, after which they are returned to the queue if not acknowledged. Default is the LEASE_TIMEOUT setting of the API, 0 (disabled).
+        wait: Wait up to a number of seconds for entries to be pushed, if the queue is empty. Default is 0 (disabled).
+
+    Returns the data objects.
+    """
+
+    token, results = await claim(stage, quantity, lease, wait)
+
+    return results
+
+async def claim(stage, quantity = 1, lease = None, wait = 0):
+    """Pop entries from a stage queue, along with their claim token.
+
+    Parameters are the same of pop.
+
+    Returns: the claim token and the data objects.
+    """
+
+    token, results, leased = await _claim(stage, quantity, lease, wait)
+
+    return token, results
+
+async def _claim(stage, quantity, lease, wait):
+    """Pop entries from a stage queue, along with their claim token and their lease.
+
+    Returns: the claim token, the data objects and the lease in seconds, 0 if not leased.
+    """
+
+    params = { 'quantity': quantity, 'wait': wait }
+    if lease is not None:
+        params['lease'] = lease
+
+    headers, body = await _request('GET', stage, 'pop', params = params)
+
+    results = _decode_body(body, headers.get('Content-Type', ''))
+
+    log.debug(
+            'stage-%d pops %d/%d' % (
+                stage,
+                len(results),
+                quantity
+                )
+            )
+    return (
+            headers.get('X-Plumber-Claim'), 
+            results, 
+            int(headers.get('X-Plumber-Lease', 0))
+        )
+
+async def consume(stage, batch = 100, prefetch = 1, lease = None, wait = 0):
+    """Iterate the entries of a stage queue, popping the next batches in background.
+
+    A background task keeps popping batches of entries while the caller is
+    processing the current one, up to a number of batches ahead. The iteration
+    ends when the queue stays empty for the wait time. The leased batches are
+    acknowledged once the caller moves past their last entry. When the caller
+    stops iterating early, the prefetched entries are dropped: lease them to
+    get them back to the queue.
+
+    Parameters are the same of plumber.consume.
+
+    Returns: an asynchronous generator of the data objects.
+    """
+
+    # Holds the popped batches, bounding the prefetched entries
+    batches = asyncio.Queue(maxsize = max(prefetch, 1))
+
+    async def fetch():
+
+        try:
+            while True:
+                token, results, leased = await _claim(stage, batch, lease, wait)
+                await batches.put((token, results, leased))
+
+                if not results:
+                    return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await batches.put((None, e, 0))
+
+    fetcher = asyncio.ensure_future(fetch())
+
+    try:
+        while True:
+            token, results, leased = await batches.get()
+
+            if isinstance(results, Exception):
+                raise results
+            if not results:
+                return
+
+            for entry in results:
+                yield entry
+
+            # Nothing to acknowledge without a lease
+            if leased:
+                await ack(stage, [ token ])
+
+    finally:
+        fetcher.cancel()
+
+async def ack(stage, claims):
+    """Acknowledge the processing of leased entries.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        claims: List of claim tokens of the leased entries.
+
+    Returns: the number of acknowledged entries.
+    """
+
+    acked = await _decoded_request('POST', stage, 'ack', data = list(claims))
+
+    log.debug(
+            'stage-%d acks %d' % (
+                stage,
+                acked
+                )
+            )
+    return acked
+
+async def push(stage, entry_list, push_if_new = False, push_if_older_than = 0):
+    """Push entries to a stage queue.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        entry_list: List of objects.
+        push_if_new: Push only the entries which haven't been previously pushed. Default is false.
+        push_if_older_than: Push only the entries which haven't been previously pushed or that have been older than a number of seconds. Default is 0 (disabled).
+
+    Returns: the number of pushed entries.
+    """
+
+    # Silently exit on empty lists
+    if not entry_list:
+        return []
+
+    params = {}
+    if push_if_new:
+        params['push_if_new'] = 'true'
+    if push_if_older_than:
+        params['push_if_older_than'] = push_if_older_than
+
+    pushed = await _decoded_request('POST', stage, 'push', params = params, data = list(entry_list))
+
+    log.debug(
+            'pushed to stage-%d %d/%d' % (
+                stage,
+                pushed,
+                len(entry_list)
+                )
+            )
+    return pushed
+
+async def store(stage, json_data):
+    """Store an entry to the database.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        json_data: The entry object.
+
+    Returns the Mongo ObjectID of the insterted object in string format.
+    """
+
+    # Text entries are stored as plain text, the API only accepts objects and lists
+    if isinstance(json_data, str):
+        headers, body = await _request(
+                'POST',
+                stage,
+                'store',
+                params = { 'format': 'plain' },
+                body = json_data.encode('utf-8')
+            )
+        id_ = body.decode('utf-8')
+    else:
+        id_ = await _decoded_request('POST', stage, 'store', data = json_data)
+
+    log.debug(
+            'stored to stage-%d' % (
+                stage,
+                )
+            )
+
+    return id_
+
+async def load(stage, filter_, delete):
+    """Load an entry from the database.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        filter_: The filter JSON object, as accepted by Mongo find_one.
+        delete: Delete the matching objects.
+
+    Returns: the requested entry document, with its _id and its data, None if not found.
+    """
+
+    params = { 'filter': json.dumps(filter_, default = str), 'document': 'true' }
+    if delete:
+        params['delete'] = 'true'
+
+    result = await _decoded_request('GET', stage, 'load', params = params)
+
+    # The API answers an empty object when nothing matches
+    if not result:
+        result = None
+
+    log.debug(
+            'loaded%s from stage-%d %d/1' % (
+                ' and deleted' if delete else '',
+                stage,
+                1 if result is not None else 0
+                )
+            )
+
+    return result
@@ -0,0 +1,310 @@
+#!/usr/bin/env python3
+"""Long-running runner of the Python handler modules of a stage.
+
+The handler modules are the non executable *.py files of the scripts folder.
+They are loaded once and served with batches of entries popped from the stage
+queue, pushing their results to the next stage. Every module defines either:
+
+    handle(entry): Process an entry. Returns the list of entries to push to the
+        next stage, or None. It can be a coroutine function in asyncio mode.
+    handle_batch(entries): Process a list of entries. Returns the list of
+        entries to push to the next stage, or None.
+
+and optionally the PUSH_IF_NEW and PUSH_IF_OLDER_THAN options of the pushes.
+
+A batch is acknowledged once its results are pushed. When a handler fails,
+the batch is neither pushed nor acknowledged, and it is handled again once
+its lease expires, unless RUNNER_SKIP_FAILED drops the failed entries.
+"""
+import plumber
+import concurrent.futures.process
+import concurrent.futures
+import importlib
+import threading
+import asyncio
+import logging
+import signal
+import sys
+import os
+
+# Runner settings
+
+SCRIPTS_DIR = os.getenv('SCRIPTS_DIR', '/plumber/scripts/')
+STAGE = int(os.getenv('STAGE', 1))
+NEXT_STAGE = int(os.getenv('NEXT_STAGE', STAGE + 1))
+RUNNER_MODE = os.getenv('RUNNER_MODE', 'threads').lower()  # Concurrency of the handlers: threads, processes or asyncio
+RUNNER_CONCURRENCY = int(os.getenv('RUNNER_CONCURRENCY', os.getenv('CONCURRENT_SCRIPTS') or 4))  # Entries or batch slices handled at once
+RUNNER_BATCH = int(os.getenv('RUNNER_BATCH', 100))  # Most entries popped at once
+RUNNER_LEASE = int(os.getenv('RUNNER_LEASE', 300))  # Lease of the popped entries until handled, in seconds
+RUNNER_SKIP_FAILED = os.getenv('RUNNER_SKIP_FAILED', 'false').lower() == 'true'  # Acknowledge the batches with failed entries, dropping them
+RUNNER_WAIT = 30  # Longest wait of a pop on an empty queue, in seconds
+RUNNER_RETRY = 5  # Time between attempts after a failing batch, in seconds
+
+# Logging settings
+
+log = logging.getLogger('app')
+log.setLevel(logging.DEBUG)
+
+f = logging.Formatter(
+        '[{levelname[0]}] [{asctime}] {message}',
+        datefmt = '%d-%m-%Y %H:%M:%S',
+        style = '{'
+        )
+ch = logging.StreamHandler()
+ch.setLevel(logging.DEBUG)
+ch.setFormatter(f)
+log.addHandler(ch)
+
+# Set on SIGTERM, the runners stop after their current batch
+stopping = threading.Event()
+
+def find_handlers(scripts_dir):
+    """List the names of the handler modules of a scripts folder.
+
+    Parameters:
+
+        scripts_dir: The scripts folder.
+
+    Returns: the sorted module names, as the file names without extension.
+    """
+
+    return sorted(
+            name[:-3] for name in os.listdir(scripts_dir)
+            if name.endswith('.py')
+            and os.path.isfile(os.path.join(scripts_dir, name))
+            and not os.access(os.path.join(scripts_dir, name), os.X_OK)
+        )
+
+def _handle_entries(handle, entries):
+    """Handle the entries one by one, skipping the failing ones.
+
+    Returns: the results and the number of failed entries.
+    """
+
+    results = []
+    failed = 0
+
+    for entry in entries:
+        try:
+            results += handle(entry) or []
+        except Exception:
+            log.exception('handler failed on entry %s' % str(entry)[:100])
+            failed += 1
+
+    return results, failed
+
+def _handle_slice(module, entries):
+    """Handle a slice of a batch with the module handler, in a worker.
+
+    Returns: the results and the number of failed entries.
+    """
+
+    if hasattr(module, 'handle_batch'):
+        try:
+            return module.handle_batch(entries) or [], 0
+        except Exception:
+            log.exception('batch handler failed on %d entries' % len(entries))
+            return [], len(entries)
+
+    return _handle_entries(module.handle, entries)
+
+def _handle_module_slice(name, entries):
+    """Handle a slice of a batch in a worker process, importing the module by name."""
+
+    return _handle_slice(importlib.import_module(name), entries)
+
+async def _handle_async(module, entries, concurrency):
+    """Handle the entries with a coroutine handler, a number at a time.
+
+    Returns: the results and the number of failed entries.
+    """
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handle(entry):
+        async with semaphore:
+            try:
+                return await module.handle(entry) or [], 0
+            except Exception:
+                log.exception('handler failed on entry %s' % str(entry)[:100])
+                return [], 1
+
+    results = []
+    failed = 0
+    for entry_results, entry_failed in await asyncio.gather(*[ handle(entry) for entry in entries ]):
+        results += entry_results
+        failed += entry_failed
+
+    return results, failed
+
+class Runner:
+    """Serve a handler module with the entries of the stage queue.
+
+    Parameters:
+
+        name: The handler module name.
+        mode: The concurrency of the handlers, threads, processes or asyncio.
+        concurrency: The number of entries or batch slices handled at once.
+    """
+
+    def __init__(self, name, mode = RUNNER_MODE, concurrency = RUNNER_CONCURRENCY):
+
+        self.name = name
+        self.mode = mode
+        self.concurrency = max(concurrency, 1)
+        self.module = importlib.import_module(name)
+
+        if not hasattr(self.module, 'handle') and not hasattr(self.module, 'handle_batch'):
+            raise ValueError('handler module %s defines neither handle nor handle_batch' % name)
+
+        if mode == 'asyncio':
+            self.loop = asyncio.new_event_loop()
+        elif mode in ('processes', 'threads'):
+            self.executor = self._new_executor()
+        else:
+            raise ValueError('wrong runner mode %s' % mode)
+
+        self.pusher = plumber.Pusher(
+                NEXT_STAGE,
+                getattr(self.module, 'PUSH_IF_NEW', False),
+                getattr(self.module, 'PUSH_IF_OLDER_THAN', 0)
+            )
+
+    def _new_executor(self):
+
+        if self.mode == 'processes':
+            return concurrent.futures.ProcessPoolExecutor(self.concurrency)
+
+        return concurrent.futures.ThreadPoolExecutor(self.concurrency)
+
+    def process(self, entries):
+        """Handle a batch of entries.
+
+        Parameters:
+
+            entries: List of entries.
+
+        Returns: the list of entries to push to the next stage, and the number of failed entries.
+        """
+
+        if self.mode == 'asyncio' and asyncio.iscoroutinefunction(getattr(self.module, 'handle', None)):
+            return self.loop.run_until_complete(
+                    _handle_async(self.module, entries, self.concurrency)
+                )
+        elif self.mode == 'asyncio':
+            return _handle_slice(self.module, entries)
+
+        # Split the entries in slices, one per worker
+        size = -(-len(entries) // self.concurrency)
+        slices = [ entries[i:i + size] for i in range(0, len(entries), size) ]
+
+        results = []
+        failed = 0
+
+        try:
+            if self.mode == 'processes':
+                futures = [ self.executor.submit(_handle_module_slice, self.name, entries_slice) for entries_slice in slices ]
+            else:
+                futures = [ self.executor.submit(_handle_slice, self.module, entries_slice) for entries_slice in slices ]
+
+            for future in futures:
+                slice_results, slice_failed = future.result()
+                results += slice_results
+                failed += slice_failed
+
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker process died, e.g. killed when out of memory, and the
+            # pool refuses any further work: start a new one for the next batches
+            log.warning('stage-%d runner %s worker processes died, restarting them' % (STAGE, self.name))
+            self.executor.shutdown(wait = False)
+            self.executor = self._new_executor()
+            raise
+
+        return results, failed
+
+    def run_batch(self):
+        """Pop, handle and push a batch of entries."""
+
+        token, entries = plumber.claim(STAGE, RUNNER_BATCH, RUNNER_LEASE, RUNNER_WAIT)
+        if not entries:
+            return
+
+        results, failed = self.process(entries)
+
+        # Leave the whole batch leased, to be handled again once the lease
+        # expires, rather than pushing the results of a part of it
+        if failed and not RUNNER_SKIP_FAILED:
+            raise RuntimeError('%d/%d entries failed' % (failed, len(entries)))
+
+        # Acknowledge once the results are pushed, so that no entry is lost 
+        # if the runner dies in the meanwhile
+        try:
+            for result in results:
+                self.pusher.push(result)
+
+            self.pusher.flush()
+        except Exception:
+            # The batch will be handled again, with its results
+            self.pusher.clear()
+            raise
+
+        if RUNNER_LEASE:
+            plumber.ack(STAGE, [ token ])
+
+        log.debug(
+                'stage-%d runner %s handled %d entries' % (
+                    STAGE,
+                    self.name,
+                    len(entries)
+                    )
+                )
+
+    def run(self):
+        """Pop, handle and push batches of entries until stopped."""
+
+        log.debug('stage-%d runner %s started' % (STAGE, self.name))
+
+        try:
+            while not stopping.is_set():
+                try:
+                    self.run_batch()
+                except Exception:
+                    # The leased entries of the batch are returned to the queue
+                    log.exception('stage-%d runner %s batch failed' % (STAGE, self.name))
+                    stopping.wait(RUNNER_RETRY)
+        finally:
+            self.close()
+
+    def close(self):
+        """Push the buffered results and stop the workers."""
+
+        self.pusher.close()
+
+        if self.mode == 'asyncio':
+            self.loop.close()
+        else:
+            self.executor.shutdown()
+
+def main():
+
+    # The handler modules are imported by name, also by the worker processes
+    sys.path.insert(0, SCRIPTS_DIR)
+
+    runners = [ Runner(name) for name in find_handlers(SCRIPTS_DIR) ]
+    if not runners:
+        log.warning('no handler modules in %s' % SCRIPTS_DIR)
+        return
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    threads = [ threading.Thread(target = runner.run) for runner in runners ]
+    for thread in threads:
+        thread.start()
+
+    # Wake up regularly to catch the signals
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(1)
+
+if __name__ == '__main__':
+    main()
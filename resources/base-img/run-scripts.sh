@@ -2,13 +2,103 @@
 
 export NEXT_STAGE=$((STAGE+1))
 
-while :; do
+# Adaptive scheduling settings
+ADAPTIVE=${ADAPTIVE:-false}
+MIN_CONCURRENT_SCRIPTS=${MIN_CONCURRENT_SCRIPTS:-1}
+MAX_CONCURRENT_SCRIPTS=${MAX_CONCURRENT_SCRIPTS:-$CONCURRENT_SCRIPTS}
+PLUMBER_URL=${PLUMBER_URL:-http://plumber}
+
+# Python handler modules (non executable *.py files) are loaded once and
+# served by the long-running runner, the executable scripts are run every cycle
+HANDLERS=$(find /plumber/scripts/ -maxdepth 1 -type f -name '*.py' ! -executable)
+SCRIPTS=$(find /plumber/scripts/ -maxdepth 1 -type f -executable)
+
+if [ -n "$HANDLERS" ] && [ -z "$SCRIPTS" ]; then
+    exec python3 -m plumber.runner
+elif [ -n "$HANDLERS" ]; then
+    python3 -m plumber.runner &
+fi
+
+# Run every script once, or a number of instances of every script at once
+function run_scripts() {
     find /plumber/scripts/ \
     -maxdepth 1 \
     -type f \
     -executable | \
     sort -k 3 | \
-    parallel -I{} --jobs ${CONCURRENT_SCRIPTS} \
+    awk -v instances=${1:-1} '{ for (i = 0; i < instances; i++) print }' | \
+    parallel -I{} --jobs ${JOBS} \
       "echo [$(date '+%d-%m-%Y %H:%M:%S')] $(hostname) $(basename '{}'); exec '{}'"
-    sleep ${IDLE}
+}
+
+function queue_depth() {
+    curl -s -f "${PLUMBER_URL}/${STAGE}/depth" 2>/dev/null
+}
+
+JOBS=${CONCURRENT_SCRIPTS}
+
+if [ "$ADAPTIVE" != "true" ]; then
+    while :; do
+        run_scripts
+        sleep ${IDLE}
+    done
+fi
+
+# Re-run right away while the queue has a backlog, backing off exponentially
+# up to IDLE while it is empty. Every script runs as JOBS instances at once,
+# so that single-script stages scale too. With a backlog, the instances climb
+# up or down by one a cycle, turning back when the throughput of the last 
+# cycle (the entries drained per second) falls by more than a tenth. The 
+# scripts don't report their per-entry latency, the throughput stands for 
+# it: at a given concurrency, it falls when the latency grows faster than 
+# the concurrency.
+DELAY=0
+DEPTH=$(queue_depth)
+THROUGHPUT=0
+STEP=1
+JOBS=$(( JOBS < MIN_CONCURRENT_SCRIPTS ? MIN_CONCURRENT_SCRIPTS : JOBS ))
+JOBS=$(( JOBS > MAX_CONCURRENT_SCRIPTS ? MAX_CONCURRENT_SCRIPTS : JOBS ))
+
+while :; do
+    START=$(date +%s%3N)
+    run_scripts ${JOBS}
+    ELAPSED=$(( $(date +%s%3N) - START + 1 ))
+
+    PREVIOUS_DEPTH=${DEPTH:-0}
+    DEPTH=$(queue_depth)
+
+    # Fall back to the fixed schedule while the API can't be reached
+    if ! [[ "$DEPTH" =~ ^[0-9]+$ ]]; then
+        DEPTH=0
+        sleep ${IDLE}
+        continue
+    fi
+
+    if [ "$DEPTH" -gt 0 ]; then
+        DELAY=0
+
+        # Entries drained per thousand seconds, net of the pushes of the cycle
+        DRAINED=$(( PREVIOUS_DEPTH > DEPTH ? PREVIOUS_DEPTH - DEPTH : 0 ))
+        CURRENT=$(( DRAINED * 1000000 / ELAPSED ))
+
+        if [ $(( CURRENT * 10 )) -lt $(( THROUGHPUT * 9 )) ]; then
+            STEP=$(( -STEP ))
+        fi
+        THROUGHPUT=$CURRENT
+
+        JOBS=$(( JOBS + STEP ))
+    else
+        DELAY=$(( DELAY ? DELAY * 2 : 1 ))
+        DELAY=$(( DELAY > IDLE ? IDLE : DELAY ))
+
+        # Release the concurrency while idle
+        JOBS=$(( JOBS - 1 ))
+        THROUGHPUT=0
+        STEP=1
+
+        sleep ${DELAY}
+    fi
+
+    JOBS=$(( JOBS < MIN_CONCURRENT_SCRIPTS ? MIN_CONCURRENT_SCRIPTS : JOBS ))
+    JOBS=$(( JOBS > MAX_CONCURRENT_SCRIPTS ? MAX_CONCURRENT_SCRIPTS : JOBS ))
 done
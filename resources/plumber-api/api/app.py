@@ -1,18 +1,33 @@
 #!/usr/bin/env python3
-import plumber as api
+import engines
+import formats
+import metrics
 from aiohttp import web
-from bson import objectid
 import asyncio
 import logging
-import socket
+import signal
 import os
-import json
 
 # Application settings
 
 API_HOST="0.0.0.0"
 API_PORT=80
 STAGES_QTY=int(os.getenv("STAGES_QTY", 0))
+PLUMBER_ENGINE=os.getenv("PLUMBER_ENGINE", "mongo").lower()  # Storage engine of the queues: mongo, memory or sqlite
+POP_WAIT_MAX=int(os.getenv("POP_WAIT_MAX", 60))  # Longest wait of a pop, in seconds
+WATCH_CHANGES=os.getenv("WATCH_CHANGES", "false").lower() == "true"  # Wake pops on pushes to other API instances
+WATCH_RETRY=5  # Time between attempts to open a change stream, in seconds
+LEASE_TIMEOUT=int(os.getenv("LEASE_TIMEOUT", 0))  # Default lease of the popped entries, in seconds
+REAP_INTERVAL=int(os.getenv("REAP_INTERVAL", 5))  # Time between returns of the expired leases to the queues, in seconds
+COMPACT_INTERVAL=int(os.getenv("COMPACT_INTERVAL", 60))  # Time between compactions of the consumed entries, in seconds, 0 to disable
+STATS_INTERVAL=int(os.getenv("STATS_INTERVAL", 10))  # Time between reconciliations of the queue statistics with the database, in seconds
+PUSH_CHUNK_SIZE=int(os.getenv("PUSH_CHUNK_SIZE", 1000))  # Most entries of a streamed push inserted at once
+STREAM_BATCH=100  # Most entries claimed at once by a streamed pop
+COMPRESS_MIN_SIZE=int(os.getenv("COMPRESS_MIN_SIZE", 1024))  # Smallest pop or load response body compressed, in bytes
+WS_BATCH=100  # Most entries sent in a single WebSocket message
+WS_POLL_INTERVAL=5  # Time between pops of a WebSocket session waiting for entries, in seconds
+WS_HEARTBEAT=30  # Time between WebSocket pings, in seconds
+LOOP_LAG_INTERVAL=1  # Time between measures of the event loop lag, in seconds
 
 # Logging settings
 
@@ -29,11 +44,165 @@ ch.setLevel(logging.DEBUG)
 ch.setFormatter(f)
 log.addHandler(ch)
 
+# Storage engine of the queues
+api = engines.load(PLUMBER_ENGINE)
+
+# Events set by the next push to a stage, by stage number
+pushed_events = {}
+
+# Tasks running in background for the whole server lifetime
+background_tasks = []
+
+def pushed_event(stage):
+    """Get the event set by the next push to a stage queue."""
+
+    if stage not in pushed_events:
+        pushed_events[stage] = asyncio.Event()
+
+    return pushed_events[stage]
+
+def notify_push(stage):
+    """Wake up the pops waiting for entries on a stage queue."""
+
+    event = pushed_events.pop(stage, None)
+    if event:
+        event.set()
+
+async def iter_lines(request):
+    """Iterate the non blank lines of a request body, without reading it whole.
+
+    A line holds a single entry, so it is bounded by the BODY_MAX_SIZE bytes
+    of a whole body.
+    """
+
+    pending = bytearray()
+
+    async for chunk in formats.iter_body(request):
+
+        pending.extend(chunk)
+
+        end = pending.rfind(b'\n')
+        if end >= 0:
+            lines = bytes(pending[:end]).split(b'\n')
+            del pending[:end + 1]
+
+            for line in lines:
+                if line.strip():
+                    yield line.rstrip(b'\r')
+
+        if len(pending) > formats.BODY_MAX_SIZE:
+            raise web.HTTPRequestEntityTooLarge(
+                    max_size = formats.BODY_MAX_SIZE, 
+                    actual_size = len(pending)
+                    )
+
+    if pending.strip():
+        yield bytes(pending).rstrip(b'\r')
+
+async def reap_leases():
+    """Periodically return the entries with an expired lease to their queue."""
+
+    while True:
+        await asyncio.sleep(REAP_INTERVAL)
+
+        for stage in range(1, STAGES_QTY + 1):
+            try:
+                if await api.reap(stage):
+                    notify_push(stage)
+            except Exception as e:
+                log.warning('stage-%d reap error: %s' % (stage, str(e)))
+
+async def watch_pushes(stage):
+    """Wake up the waiting pops on the entries pushed by any API instance."""
+
+    while True:
+        try:
+            async for _ in api.watch(stage):
+                notify_push(stage)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning('stage-%d change stream error: %s' % (stage, str(e)))
+
+        # The stream is closed by errors and by the collection drop on flush
+        await asyncio.sleep(WATCH_RETRY)
+
+async def compact_queues():
+    """Periodically move the consumed entries out of their queue."""
+
+    while True:
+        await asyncio.sleep(COMPACT_INTERVAL)
+
+        for stage in range(1, STAGES_QTY + 1):
+            try:
+                await api.compact(stage)
+            except Exception as e:
+                log.warning('stage-%d compaction error: %s' % (stage, str(e)))
+
+@web.middleware
+async def measure_requests(request, handler):
+    """Count and time the requests by route, stage and method."""
+
+    route = getattr(request.match_info.route.resource, 'canonical', None) or 'unmatched'
+    stage = request.match_info.get('stage', '')
+
+    # Bound the label values, whatever the requested stages
+    if stage and not 1 <= int(stage) <= STAGES_QTY:
+        stage = 'invalid'
+
+    start = asyncio.get_event_loop().time()
+    status = 500
+
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        metrics.http_request_duration.observe(
+                asyncio.get_event_loop().time() - start,
+                route = route,
+                stage = stage,
+                method = request.method
+            )
+        metrics.http_requests.inc(
+                route = route,
+                stage = stage,
+                method = request.method,
+                status = status
+            )
+
+async def reconcile_stats():
+    """Periodically reconcile the queue statistics with the database."""
+
+    while True:
+        for stage in range(1, STAGES_QTY + 1):
+            try:
+                await api.reconcile_stats(stage)
+            except Exception as e:
+                log.warning('stage-%d statistics error: %s' % (stage, str(e)))
+
+        await asyncio.sleep(STATS_INTERVAL)
+
+async def warm_seen_caches():
+    """Warm the seen-set caches, if enabled, with the entries pushed so far."""
+
+    for stage in range(1, STAGES_QTY + 1):
+        try:
+            await api.warm_seen_cache(stage)
+        except Exception as e:
+            log.warning('stage-%d seen-set cache warm error: %s' % (stage, str(e)))
+
 async def shutdown(server, app, handler):
 
+    for task in background_tasks:
+        task.cancel()
+
     server.close()
     await server.wait_closed()
-    api.mdb.close()  # database connection close
+    api.stop()  # database connection close
     await app.shutdown()
     await app.cleanup()
 
@@ -53,10 +222,29 @@ async def flush(request):
         log.warning(text)
         return web.Response(status = 400, text = text)
 
-    api.flush(stage)
+    await api.flush(stage)
 
     return web.Response()
 
+@asyncio.coroutine
+async def compact(request):
+    """Compact the consumed entries of a stage queue right away, as done 
+    every COMPACT_INTERVAL seconds.
+
+    POST /<stage_number>/compact
+
+    Returns: 200 with the number of compacted entries.
+    """
+
+    # Validate stage number
+    stage = int(request.match_info['stage'])
+    if stage < 1 or stage > STAGES_QTY:
+        text = 'Error: wrong stage number'
+        log.warning(text)
+        return web.Response(status = 400, text = text)
+
+    return formats.response(await api.compact(stage))
+
 @asyncio.coroutine
 async def healthcheck(request):
     """Check API health.
@@ -68,6 +256,131 @@ async def healthcheck(request):
     
     return web.Response()
 
+@asyncio.coroutine
+async def indexes(request):
+    """List the indexes of the stage collections.
+
+    GET /<stage_number>/indexes
+
+    Returns: 200 with the JSON index information of every stage collection.
+    """
+
+    # Validate stage number
+    stage = int(request.match_info['stage'])
+    if stage < 1 or stage > STAGES_QTY:
+        text = 'Error: wrong stage number'
+        log.warning(text)
+        return web.Response(status = 400, text = text)
+
+    json_response = await api.indexes(stage)
+
+    return web.json_response(json_response)
+
+@asyncio.coroutine
+async def seen(request):
+    """Get the counters of the seen-set cache in front of push_if_new.
+
+    GET /<stage_number>/seen
+
+    Returns: 200 with the JSON counters and sizing of the cache, empty if disabled.
+    """
+
+    # Validate stage number
+    stage = int(request.match_info['stage'])
+    if stage < 1 or stage > STAGES_QTY:
+        text = 'Error: wrong stage number'
+        log.warning(text)
+        return web.Response(status = 400, text = text)
+
+    return web.json_response(api.seen_cache_stats(stage))
+
+@asyncio.coroutine
+async def warm_seen(request):
+    """Rebuild the seen-set cache in front of push_if_new from the database,
+    as done at startup, e.g. after pushing to the database directly.
+
+    POST /<stage_number>/seen
+
+    Returns: 200 with the JSON counters and sizing of the rebuilt cache, empty if disabled.
+    """
+
+    # Validate stage number
+    stage = int(request.match_info['stage'])
+    if stage < 1 or stage > STAGES_QTY:
+        text = 'Error: wrong stage number'
+        log.warning(text)
+        return web.Response(status = 400, text = text)
+
+    await api.warm_seen_cache(stage)
+
+    return web.json_response(api.seen_cache_stats(stage))
+
+@asyncio.coroutine
+async def depth(request):
+    """Count the entries waiting in a stage queue.
+
+    GET /<stage_number>/depth
+
+    Returns: 200 with the number of unconsumed entries.
+    """
+
+    # Validate stage number
+    stage = int(request.match_info['stage'])
+    if stage < 1 or stage > STAGES_QTY:
+        text = 'Error: wrong stage number'
+        log.warning(text)
+        return web.Response(status = 400, text = text)
+
+    return formats.response(await api.depth(stage))
+
+@asyncio.coroutine
+async def stats(request):
+    """Get the statistics of a stage queue.
+
+    The statistics come from counters maintained in memory by the pushes 
+    and the pops, and periodically reconciled with the database.
+
+    GET /<stage_number>/stats
+
+    Returns: 200 with the ready, in-flight and consumed entries, the age of the oldest ready entry in seconds, and the push and pop rates per second.
+    """
+
+    # Validate stage number
+    stage = int(request.match_info['stage'])
+    if stage < 1 or stage > STAGES_QTY:
+        text = 'Error: wrong stage number'
+        log.warning(text)
+        return web.Response(status = 400, text = text)
+
+    return formats.response(api.stats(stage))
+
+@asyncio.coroutine
+async def all_stats(request):
+    """Get the statistics of every stage queue.
+
+    GET /_stats
+
+    Returns: 200 with the statistics of every stage queue, by stage number.
+    """
+
+    return formats.response(
+            { str(stage): api.stats(stage) for stage in range(1, STAGES_QTY + 1) }
+        )
+
+@asyncio.coroutine
+async def metrics_(request):
+    """Get the metrics of the API in the Prometheus text format.
+
+    GET /_metrics
+
+    Returns: 200 with the request counts and latencies, the pushed, popped and deduplicated entries, the Mongo command latencies and the event loop lag.
+    """
+
+    return web.Response(
+            body = metrics.render().encode('utf-8'),
+            headers = { 'Content-Type': metrics.CONTENT_TYPE }
+        )
+
 @asyncio.coroutine
 async def pop(request):
     """Pop entries from a stage queue.
@@ -76,10 +389,14 @@ async def pop(request):
 
     Parameters:
         
-        format: The output format, can be json or plain. Default is json.
+        format: The output format, can be json, plain, ndjson or msgpack. Default is the Accept
+            header format, or json. The ndjson output is streamed, writing the entries as they are claimed.
         quantity: The number of entries to retrieve. Default is 1.
+        wait: Wait up to a number of seconds for entries to be pushed, if the queue is empty. Default is 0 (disabled).
+        lease: Lease the entries for a number of seconds, after which they are returned to the queue if not acknowledged. Default is the LEASE_TIMEOUT setting, 0 (disabled).
     
-    Returns: 200 with data in JSON or plain text, according to the format argument.
+    Returns: 200 with data in JSON, plain text or msgpack, according to the format argument, and the claim token of the entries in the X-Plumber-Claim header. 
+    Streamed and larger bodies are compressed as accepted by the Accept-Encoding header.
     """
 
     # Validate stage number
@@ -90,8 +407,8 @@ async def pop(request):
         return web.Response(status = 400, text = text)
 
     # Get format (default: json)
-    output_format = request.query.get('format', 'json').lower()
-    if output_format not in ('json', 'plain'):
+    output_format = formats.output_format(request)
+    if not formats.available(output_format):
         text = 'Error: wrong format parameter'
         log.warning(text)
         return web.Response(status = 400, text = text)
@@ -104,29 +421,173 @@ async def pop(request):
         return web.Response(status = 400, text = text)
     quantity = int(quantity)
 
-    json_response = api.pop(
-            stage, 
-            quantity
-            )
+    # Check if must wait for entries a number of seconds
+    wait = request.query.get('wait', '0')
+    if not wait.isdigit():
+        text = 'Error: wrong wait parameter'
+        log.warning(text)
+        return web.Response(status = 400, text = text)
+    wait = min(int(wait), POP_WAIT_MAX)
+
+    # Check if must lease the entries a number of seconds
+    lease = request.query.get('lease', str(LEASE_TIMEOUT))
+    if not lease.isdigit():
+        text = 'Error: wrong lease parameter'
+        log.warning(text)
+        return web.Response(status = 400, text = text)
+    lease = int(lease)
+
+    # Streamed pops claim the entries in batches, all with the same claim token
+    batch = min(quantity, STREAM_BATCH) if output_format == 'ndjson' else quantity
+
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + wait
 
-    if output_format == 'json':
-        return web.json_response(json_response)
+    while True:
+
+        # Get the event before popping, to not miss the pushes in between
+        pushed = pushed_event(stage)
+
+        token, json_response = await api.claim(
+                stage, 
+                batch,
+                lease
+                )
+
+        remaining = deadline - loop.time()
+        if json_response or remaining <= 0:
+            break
+
+        try:
+            await asyncio.wait_for(pushed.wait(), remaining)
+        except asyncio.TimeoutError:
+            pass
+
+    headers = { 'X-Plumber-Claim': token }
+    if lease:
+        headers['X-Plumber-Lease'] = str(lease)
+
+    if output_format == 'ndjson':
+        response = web.StreamResponse(headers = headers)
+        response.content_type = 'application/x-ndjson'
+        writer = formats.StreamWriter(request, response)
+        await response.prepare(request)
+
+        # Write every batch as soon as it is claimed, until the queue is empty
+        popped = 0
+        while json_response:
+
+            await writer.write(
+                    b''.join(formats.dumps(entry) + b'\n' for entry in json_response)
+                    )
+
+            popped += len(json_response)
+            if popped >= quantity:
+                break
+
+            token, json_response = await api.claim(
+                    stage, 
+                    min(quantity - popped, STREAM_BATCH),
+                    lease,
+                    token
+                    )
+
+        await writer.write_eof()
+        return response
+
+    elif output_format in ('json', 'msgpack'):
+        return formats.compress_response(
+                request,
+                formats.response(json_response, output_format, headers = headers),
+                COMPRESS_MIN_SIZE
+                )
     elif output_format == 'plain':
-        return web.Response(text = '\n'.join(json_response))
+        return formats.compress_response(
+                request,
+                web.Response(text = '\n'.join(json_response), headers = headers),
+                COMPRESS_MIN_SIZE
+                )
     else:
         # Never happens
         return web.Response()
 
+@asyncio.coroutine
+async def ack(request):
+    """Acknowledge the processing of leased entries.
+
+    POST /<stage_number>/ack
+
+    Body: JSON or msgpack list of claim tokens or text of lines, according to the format argument.
+    Parameters:
+        
+        format: The input format, can be json, plain or msgpack. Default is the Content-Type 
+            header format, or json.
+    
+    Returns: 200 with the number of acknowledged entries.
+    """
+
+    # Validate stage number
+    stage = int(request.match_info['stage'])
+    if stage < 1 or stage > STAGES_QTY:
+        text = 'Error: wrong stage number'
+        log.warning(text)
+        return web.Response(status = 400, text = text)
+
+    # Validate content encoding
+    if not formats.decodable(request):
+        text = 'Error: unsupported content encoding'
+        log.warning(text)
+        return web.Response(status = 415, text = text)
+
+    # Get format (default: json)
+    input_format = formats.input_format(request)
+
+    if input_format in ('json', 'msgpack') and formats.available(input_format):
+        # Validate JSON format
+        try:
+            claims = formats.decode(await formats.read_body(request), input_format)
+        except web.HTTPException:
+            # Oversized or corrupted compressed bodies
+            raise
+        except Exception as e:
+            text = 'Error: can\'t decode %s input' % input_format
+            log.warning('%s: %s' % (text, str(e)))
+            return web.Response(status = 400, text = text)
+
+        if not isinstance(claims, (list,)):
+            text = 'Error: JSON must be a list of claim tokens'
+            log.warning('%s: %s' % (text, claims))
+            return web.Response(status = 400, text = text)
+    elif input_format == 'plain': 
+        text_data = (await formats.read_body(request)).decode('utf-8')
+        claims = text_data.split("\n")
+
+    else:
+        # Error with an unknown format
+        text = 'Error: wrong format parameter'
+        log.warning(text)
+        return web.Response(status = 400, text = text)
+
+    json_response = await api.ack(
+            stage, 
+            [ claim.strip() for claim in claims if isinstance(claim, str) and claim.strip() ]
+            )
+
+    return formats.response(json_response)
+
 @asyncio.coroutine
 async def push(request):
     """Push entries to a stage queue.
 
     POST /<stage_number>/push
 
-    Body: JSON list of objects or text of lines, according to the format argument.
+    Body: JSON or msgpack list of objects, text of lines or JSON objects separated by newlines, 
+    according to the format argument, optionally compressed as by the Content-Encoding header. The plain and ndjson bodies are streamed and pushed in chunks, 
+    skipping the blank lines.
     Parameters:
         
-        format: The input format, can be json or plain. Default is json.
+        format: The input format, can be json, plain, ndjson or msgpack. Default is the 
+            Content-Type header format, or json.
         push_if_new: Push only the entries which haven't been previously pushed. Default is disabled.
         push_if_older_than: Push only the entries which haven't been previously pushed or that have been older than a number of seconds. Default is disabled.
     
@@ -140,8 +601,14 @@ async def push(request):
         log.warning(text)
         return web.Response(status = 400, text = text)
     
+    # Validate content encoding
+    if not formats.decodable(request):
+        text = 'Error: unsupported content encoding'
+        log.warning(text)
+        return web.Response(status = 415, text = text)
+
     # Get format (default: json)
-    input_format = request.query.get('format', 'json').lower()
+    input_format = formats.input_format(request)
 
     # Check if must be pushed if new
     push_if_new = bool(request.query.get('push_if_new', False))
@@ -154,12 +621,15 @@ async def push(request):
         return web.Response(status = 400, text = text)
     push_if_older_than = int(push_if_older_than)
 
-    if input_format == 'json':
+    if input_format in ('json', 'msgpack') and formats.available(input_format):
         # Validate JSON format
         try:
-            json_data = await request.json()
+            json_data = formats.decode(await formats.read_body(request), input_format)
+        except web.HTTPException:
+            # Oversized or corrupted compressed bodies
+            raise
         except Exception as e:
-            text = 'Error: can\'t decode JSON input'
+            text = 'Error: can\'t decode %s input' % input_format
             log.warning('%s: %s' % (text, str(e)))
             return web.Response(status = 400, text = text)
 
@@ -167,10 +637,32 @@ async def push(request):
             text = 'Error: JSON must be a list of object'
             log.warning('%s: %s' % (text, json_data))
             return web.Response(status = 400, text = text)
-    elif input_format == 'plain': 
-        # JSON-ify plain text format
-        text_data = await request.text()
-        json_data = text_data.split("\n") 
+    elif input_format in ('plain', 'ndjson'): 
+        # Stream the lines, pushing them in chunks as they are read
+        pushed = 0
+        json_data = []
+
+        try:
+            async for line in iter_lines(request):
+
+                if input_format == 'plain':
+                    json_data.append(line.decode('utf-8'))
+                else:
+                    json_data.append(formats.loads(line))
+
+                if len(json_data) >= PUSH_CHUNK_SIZE:
+                    pushed += await push_chunk(stage, json_data, push_if_new, push_if_older_than)
+                    json_data = []
+
+        except ValueError as e:
+            # The chunks read so far have been already pushed
+            text = 'Error: can\'t decode line %d' % (pushed + len(json_data) + 1)
+            log.warning('%s: %s' % (text, str(e)))
+            return web.Response(status = 400, text = text)
+
+        pushed += await push_chunk(stage, json_data, push_if_new, push_if_older_than)
+
+        return formats.response(pushed)
 
     else:
         # Error with an unknown format
@@ -178,14 +670,35 @@ async def push(request):
         log.warning(text)
         return web.Response(status = 400, text = text)
 
-    json_response = api.push(
+    json_response = await api.push(
+            stage, 
+            json_data, 
+            push_if_new, 
+            push_if_older_than
+            )
+
+    if json_response:
+        notify_push(stage)
+
+    return formats.response(json_response)
+
+async def push_chunk(stage, json_data, push_if_new, push_if_older_than):
+    """Push a chunk of a streamed push, waking up the waiting pops."""
+
+    if not json_data:
+        return 0
+
+    pushed = await api.push(
             stage, 
             json_data, 
             push_if_new, 
             push_if_older_than
             )
 
-    return web.json_response(json_response);
+    if pushed:
+        notify_push(stage)
+
+    return pushed
 
 @asyncio.coroutine
 async def store(request):
@@ -193,11 +706,13 @@ async def store(request):
 
     POST /<stage_number>/store
 
-    Body: JSON object or text, according to the format argument.
+    Body: JSON or msgpack object or text, according to the format argument, optionally compressed
+    as by the Content-Encoding header.
 
     Parameters:
         
-        format: The input and output format, can be json or plain. Default is json.
+        format: The input format, can be json, plain or msgpack. Default is the Content-Type 
+            header format, or json.
     
     Returns: 200 with the ID of the stored entry.
     """
@@ -209,15 +724,24 @@ async def store(request):
         log.warning(text)
         return web.Response(status = 400, text = text)
     
+    # Validate content encoding
+    if not formats.decodable(request):
+        text = 'Error: unsupported content encoding'
+        log.warning(text)
+        return web.Response(status = 415, text = text)
+
     # Get format (default: json)
-    input_format = request.query.get('format', 'json').lower()
+    input_format = formats.input_format(request)
 
-    if input_format == 'json':
+    if input_format in ('json', 'msgpack') and formats.available(input_format):
         # Validate JSON format
         try:
-            json_data = await request.json()
+            json_data = formats.decode(await formats.read_body(request), input_format)
+        except web.HTTPException:
+            # Oversized or corrupted compressed bodies
+            raise
         except Exception as e:
-            text = 'Error: can\'t decode JSON input'
+            text = 'Error: can\'t decode %s input' % input_format
             log.warning('%s: %s' % (text, str(e)))
             return web.Response(status = 400, text = text)
 
@@ -226,17 +750,17 @@ async def store(request):
             log.warning('%s: %s' % (text, json_data))
             return web.Response(status = 400, text = text)
 
-        id_response = api.store(
+        id_response = await api.store(
                 stage, 
                 json_data
                 )
-        return web.json_response(id_response);
+        return formats.response(id_response)
 
     elif input_format == 'plain': 
         # JSON-ify plain text format
-        text_data = await request.text()
+        text_data = (await formats.read_body(request)).decode('utf-8')
 
-        id_response = api.store(
+        id_response = await api.store(
                 stage, 
                 text_data
                 )
@@ -256,11 +780,15 @@ async def load(request):
 
     Parameters:
         
-        format: The input and output format, can be json or plain. Default is json.
+        format: The output format, can be json, plain, ndjson or msgpack. Default is the Accept
+            header format, or json. The ndjson output streams all the matching entries instead 
+            of the first one.
         filter: The filter JSON object, as accepted by Mongo find_one.
         delete: Delete the matching objects. Default is false.
+        document: Answer the whole stored document, with its _id and its data, in JSON or msgpack. Default is false.
     
-    Returns: 200 with data in JSON or plain text, according to the format argument.
+    Returns: 200 with data in JSON, plain text, JSON objects separated by newlines or msgpack, according to the format argument. 
+    Streamed and larger bodies are compressed as accepted by the Accept-Encoding header.
     """
 
     # Validate stage number
@@ -271,8 +799,8 @@ async def load(request):
         return web.Response(status = 400, text = text)
 
     # Get format (default: json)
-    output_format = request.query.get('format', 'json').lower()
-    if output_format not in ('json', 'plain'):
+    output_format = formats.output_format(request)
+    if not formats.available(output_format):
         text = 'Error: wrong format parameter'
         log.warning(text)
         return web.Response(status = 400, text = text)
@@ -280,6 +808,9 @@ async def load(request):
     # Check if must be pushed if new
     delete = bool(request.query.get('delete', False))
 
+    # Check if must answer the whole document
+    document = bool(request.query.get('document', False))
+
     # Validate JSON filter format
     filter_ = request.query.get('filter')
     if not filter_:
@@ -289,7 +820,7 @@ async def load(request):
         
     # Validate JSON filter format
     try:
-        filter_ = json.loads(filter_)
+        filter_ = formats.loads(filter_)
     except Exception as e:
         text = 'Error: can\'t decode JSON filter'
         log.warning('%s: %s' % (text, str(e)))
@@ -297,15 +828,42 @@ async def load(request):
 
     if not isinstance(filter_, (dict,)):
         text = 'Error: filter must be a JSON object'
-        log.warning('%s: %s' % (text, json_data))
+        log.warning('%s: %s' % (text, filter_))
         return web.Response(status = 400, text = text)
 
-    # Objectify _id in case has been searched by id
-    if '_id' in filter_:
-        filter_['_id'] = objectid.ObjectId(filter_['_id'])
+    if output_format == 'ndjson':
+        response = web.StreamResponse()
+        response.content_type = 'application/x-ndjson'
+        writer = formats.StreamWriter(request, response)
+
+        try:
+            async for json_response in api.load_many(
+                    stage, 
+                    filter_,
+                    delete
+                    ):
+
+                # Reply only once the filter has been accepted
+                if not response.prepared:
+                    await response.prepare(request)
+
+                await writer.write(formats.dumps(json_response['data']) + b'\n')
+
+        except Exception as e:
+            text = 'Error: exception on find'
+            log.warning('%s: %s' % (text, str(e)))
+            if response.prepared:
+                raise
+            return web.Response(status = 400, text = text)
+
+        if not response.prepared:
+            await response.prepare(request)
+
+        await writer.write_eof()
+        return response
 
     try:
-        json_response = api.load(
+        json_response = await api.load(
                 stage, 
                 filter_,
                 delete
@@ -315,15 +873,22 @@ async def load(request):
         log.warning('%s: %s' % (text, str(e)))
         return web.Response(status = 400, text = text)
 
-    if output_format == 'json':
+    if output_format in ('json', 'msgpack'):
 
         # Empty with no response
         if not json_response:
-            return web.json_response({})
+            return formats.response({}, output_format)
 
-        if '_id' in json_response:
-            del json_response['_id']
-        return web.json_response(json_response['data'])
+        if document:
+            json_response = { '_id': str(json_response['_id']), 'data': json_response['data'] }
+        else:
+            json_response = json_response['data']
+
+        return formats.compress_response(
+                request,
+                formats.response(json_response, output_format),
+                COMPRESS_MIN_SIZE
+                )
 
     elif output_format == 'plain':
 
@@ -333,22 +898,244 @@ async def load(request):
 
         if '_id' in json_response:
             del json_response['_id']
-        return web.Response(text = str(json_response['data']))
+        return formats.compress_response(
+                request,
+                web.Response(text = str(json_response['data'])),
+                COMPRESS_MIN_SIZE
+                )
     else:
         # Never happens
         return web.Response()
 
+@asyncio.coroutine
+async def ws(request):
+    """Stream entries to and from a stage queue over a WebSocket session.
+
+    GET /<stage_number>/ws
+
+    Messages are JSON objects with an op field, sent as text. Sessions whose client sends binary
+    msgpack messages instead are answered with binary msgpack messages.
+
+        {"op": "push", "entries": [...], "push_if_new": false, "push_if_older_than": 0}
+            Push entries, answered with {"op": "pushed", "count": <number of pushed entries>}.
+        {"op": "pop", "credit": <number>, "lease": <seconds>}
+            Allow the server to send a number of further entries, sent as soon as available 
+            as {"op": "entries", "claim": <claim token>, "entries": [...]}. The entries
+            sent from then on are leased for a number of seconds, by default the LEASE_TIMEOUT
+            setting.
+        {"op": "ack", "claims": [<claim token>, ...]}
+            Acknowledge the processing of the received entries, answered with 
+            {"op": "acked", "count": <number of acknowledged entries>}.
+
+    Wrong messages are answered with {"op": "error", "error": <text>}.
+    """
+
+    # Validate stage number
+    stage = int(request.match_info['stage'])
+    if stage < 1 or stage > STAGES_QTY:
+        text = 'Error: wrong stage number'
+        log.warning(text)
+        return web.Response(status = 400, text = text)
+
+    websocket = web.WebSocketResponse(heartbeat = WS_HEARTBEAT)
+    await websocket.prepare(request)
+
+    # Number of entries the client is still willing to receive, and their lease
+    credit = 0
+    lease = LEASE_TIMEOUT
+    credited = asyncio.Event()
+
+    # Number of sent entries not acknowledged yet, by claim token
+    unacked = {}
+
+    # Reply in msgpack once the client sends msgpack
+    binary = False
+
+    async def send(message):
+
+        if binary:
+            await websocket.send_bytes(formats.encode(message, 'msgpack'))
+        else:
+            await websocket.send_str(formats.dumps(message).decode('utf-8'))
+
+    async def send_entries():
+
+        try:
+            await send_entries_loop()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning('stage-%d websocket send error: %s' % (stage, str(e)))
+            await websocket.close()
+
+    async def send_entries_loop():
+        nonlocal credit
+
+        while True:
+
+            # Wait for the client to grant credit
+            await credited.wait()
+
+            # Get the event before popping, to not miss the pushes in between
+            pushed = pushed_event(stage)
+
+            token, entries = await api.claim(
+                    stage,
+                    min(credit, WS_BATCH),
+                    lease
+                    )
+
+            if entries:
+                credit -= len(entries)
+                if not credit:
+                    credited.clear()
+
+                unacked[token] = len(entries)
+                await send({ 
+                    'op': 'entries', 
+                    'claim': token, 
+                    'entries': entries 
+                    })
+            else:
+                # Wait for new entries, polling again in case they are pushed 
+                # without waking up this instance
+                try:
+                    await asyncio.wait_for(pushed.wait(), WS_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    sender = asyncio.ensure_future(send_entries())
+
+    log.debug('stage-%d websocket session open' % (stage))
+
+    try:
+        async for message in websocket:
+
+            if message.type == web.WSMsgType.BINARY and formats.available('msgpack'):
+                binary = True
+            elif message.type != web.WSMsgType.TEXT:
+                continue
+
+            try:
+                command = formats.decode(
+                        message.data, 
+                        'msgpack' if message.type == web.WSMsgType.BINARY else 'json'
+                        )
+                op = command['op']
+
+                if op == 'push':
+                    entries = command['entries']
+                    if not isinstance(entries, (list,)):
+                        raise ValueError('entries must be a list')
+
+                    push_if_older_than = int(command.get('push_if_older_than', 0))
+                    if push_if_older_than < 0:
+                        raise ValueError('wrong push_if_older_than')
+
+                    count = await api.push(
+                            stage, 
+                            entries, 
+                            bool(command.get('push_if_new', False)), 
+                            push_if_older_than
+                            )
+
+                    if count:
+                        notify_push(stage)
+
+                    await send({ 'op': 'pushed', 'count': count or 0 })
+
+                elif op == 'pop':
+                    added_credit = int(command.get('credit', 1))
+                    if added_credit < 0:
+                        raise ValueError('wrong credit')
+
+                    lease = int(command.get('lease', lease))
+                    if lease < 0:
+                        raise ValueError('wrong lease')
+
+                    credit += added_credit
+                    if credit:
+                        credited.set()
+
+                elif op == 'ack':
+                    claims = [ token for token in command['claims'] if token in unacked ]
+                    count = sum(unacked.pop(token) for token in claims)
+
+                    # Release the leases, if any
+                    await api.ack(stage, claims)
+
+                    await send({ 'op': 'acked', 'count': count })
+
+                else:
+                    raise ValueError('unknown op %s' % op)
+
+            except Exception as e:
+                text = 'Error: wrong message'
+                log.warning('%s: %s' % (text, str(e)))
+                await send({ 'op': 'error', 'error': '%s: %s' % (text, str(e)) })
+
+    finally:
+        sender.cancel()
+
+        # The leased entries will be returned to the queue on expiration
+        log.debug(
+                'stage-%d websocket session closed with %d unacknowledged entries' % (
+                    stage,
+                    sum(unacked.values())
+                    )
+                )
+
+    return websocket
+
 async def init(loop):
 
-    app = web.Application(loop=loop)
+    app = web.Application(loop=loop, middlewares=[measure_requests])
     app.router.add_route('POST', '/{stage:\d+}/push', push)
     app.router.add_route('GET', '/{stage:\d+}/pop', pop)
     app.router.add_route('POST', '/{stage:\d+}/store', store)
     app.router.add_route('GET', '/{stage:\d+}/load', load)
     app.router.add_route('POST', '/{stage:\d+}/flush', flush)
+    app.router.add_route('POST', '/{stage:\d+}/compact', compact)
+    app.router.add_route('POST', '/{stage:\d+}/ack', ack)
+    app.router.add_route('GET', '/{stage:\d+}/indexes', indexes)
+    app.router.add_route('GET', '/{stage:\d+}/ws', ws)
+    app.router.add_route('GET', '/{stage:\d+}/seen', seen)
+    app.router.add_route('POST', '/{stage:\d+}/seen', warm_seen)
+    app.router.add_route('GET', '/{stage:\d+}/depth', depth)
+    app.router.add_route('GET', '/{stage:\d+}/stats', stats)
+    app.router.add_route('GET', '/_stats', all_stats)
+    app.router.add_route('GET', '/_metrics', metrics_)
     app.router.add_route('GET', '/_healthcheck', healthcheck)
 
-    handler = app.make_handler()
+    await api.start()
+
+    # Provision the indexes of every stage
+    for stage in range(1, STAGES_QTY + 1):
+        await api.ensure_indexes(stage)
+
+    # Fill the seen-set caches in background, they are bypassed meanwhile
+    background_tasks.append(loop.create_task(warm_seen_caches()))
+
+    # Return the expired leases to the queues
+    background_tasks.append(loop.create_task(reap_leases()))
+
+    # Measure the delays of the event loop
+    background_tasks.append(loop.create_task(metrics.watch_event_loop(LOOP_LAG_INTERVAL)))
+
+    # Count the queue entries, then keep the counters in line with the database
+    background_tasks.append(loop.create_task(reconcile_stats()))
+
+    # Move the consumed entries to the history of the queues
+    if COMPACT_INTERVAL:
+        background_tasks.append(loop.create_task(compact_queues()))
+
+    # Wake up the waiting pops on pushes to other instances via change streams
+    if WATCH_CHANGES:
+        for stage in range(1, STAGES_QTY + 1):
+            background_tasks.append(loop.create_task(watch_pushes(stage)))
+
+    # Request bodies are decompressed by the handlers, streaming also zstd
+    handler = app.make_handler(auto_decompress = False)
 
     serv_generator = loop.create_server(handler, API_HOST, API_PORT)
     return serv_generator, handler, app
@@ -359,6 +1146,9 @@ serv_generator, handler, app = loop.run_until_complete(init(loop))
 serv = loop.run_until_complete(serv_generator)
 log.debug('Start server %s' % str(serv.sockets[0].getsockname()))
 
+# Shut down cleanly on docker stop too, e.g. for the engine to snapshot its state
+loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
 try:
     loop.run_forever()
 except KeyboardInterrupt:
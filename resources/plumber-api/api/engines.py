@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import importlib
+import hashlib
+import json
+
+# Modules of the storage engines, by engine name
+ENGINES = {
+    'mongo': 'plumber',
+    'memory': 'memory',
+    'sqlite': 'sqlite'
+}
+
+# Functions every engine module defines, with the signatures and the
+# semantics of the Mongo engine
+INTERFACE = (
+    'start',
+    'stop',
+    'ensure_indexes',
+    'indexes',
+    'depth',
+    'flush',
+    'pop',
+    'claim',
+    'ack',
+    'reap',
+    'compact',
+    'push',
+    'watch',
+    'store',
+    'load',
+    'load_many',
+    'stats',
+    'reconcile_stats',
+    'warm_seen_cache',
+    'seen_cache_stats'
+)
+
+def load(name):
+    """Import a storage engine.
+
+    Parameters:
+
+        name: The engine name, mongo, memory or sqlite.
+
+    Returns: the engine module.
+    """
+
+    if name not in ENGINES:
+        raise ValueError('wrong storage engine %s' % name)
+
+    engine = importlib.import_module(ENGINES[name])
+
+    missing = [ function for function in INTERFACE if not hasattr(engine, function) ]
+    if missing:
+        raise ValueError('storage engine %s misses %s' % (name, ', '.join(missing)))
+
+    return engine
+
+def entry_hash(entry):
+    """Compute the canonical content hash of an entry.
+
+    Parameters:
+
+        entry: The entry object.
+
+    Returns: the hexadecimal SHA-1 digest of the entry, serialized as JSON with sorted keys.
+    """
+
+    return hashlib.sha1(
+            json.dumps(
+                entry,
+                sort_keys = True,
+                separators = (',', ':'),
+                default = str
+            ).encode('utf-8')
+        ).hexdigest()
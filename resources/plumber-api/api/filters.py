@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""Evaluation of the Mongo query filters of the loads on plain documents,
+for the engines which don't run them in a database.
+"""
+
+def is_operator(condition):
+
+    return isinstance(condition, dict) and bool(condition) and all(
+            key.startswith('$') for key in condition
+        )
+
+def _values(document, path):
+    """Get the values at a dotted path of a document, expanding the lists as Mongo does."""
+
+    values = [ document ]
+
+    for key in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and key in value:
+                found.append(value[key])
+            elif isinstance(value, list):
+                if key.isdigit() and int(key) < len(value):
+                    found.append(value[int(key)])
+                else:
+                    found += [ item[key] for item in value if isinstance(item, dict) and key in item ]
+        values = found
+
+    return values
+
+def _equal(value, condition):
+
+    return value == condition or (isinstance(value, list) and condition in value)
+
+def _compare(values, condition, compare):
+
+    for value in values:
+        for item in (value if isinstance(value, list) else [ value ]):
+            try:
+                if compare(item, condition):
+                    return True
+            except TypeError:
+                pass
+
+    return False
+
+def _match_condition(values, condition):
+
+    if not is_operator(condition):
+        if not values:
+            return condition is None
+        return any(_equal(value, condition) for value in values)
+
+    for operator, argument in condition.items():
+        if operator == '$eq':
+            matched = _match_condition(values, argument)
+        elif operator == '$ne':
+            matched = not _match_condition(values, argument)
+        elif operator == '$in':
+            matched = any(_match_condition(values, item) for item in argument)
+        elif operator == '$nin':
+            matched = not any(_match_condition(values, item) for item in argument)
+        elif operator == '$exists':
+            matched = bool(values) == bool(argument)
+        elif operator == '$gt':
+            matched = _compare(values, argument, lambda a, b: a > b)
+        elif operator == '$gte':
+            matched = _compare(values, argument, lambda a, b: a >= b)
+        elif operator == '$lt':
+            matched = _compare(values, argument, lambda a, b: a < b)
+        elif operator == '$lte':
+            matched = _compare(values, argument, lambda a, b: a <= b)
+        elif operator == '$not':
+            matched = not _match_condition(values, argument)
+        else:
+            raise ValueError('unsupported filter operator %s' % operator)
+
+        if not matched:
+            return False
+
+    return True
+
+def match(document, filter_):
+    """Tell if a document matches a filter, supporting the Mongo equality,
+    comparison, $in, $exists and logical operators."""
+
+    for key, condition in filter_.items():
+        if key == '$and':
+            matched = all(match(document, item) for item in condition)
+        elif key == '$or':
+            matched = any(match(document, item) for item in condition)
+        elif key == '$nor':
+            matched = not any(match(document, item) for item in condition)
+        elif key.startswith('$'):
+            raise ValueError('unsupported filter operator %s' % key)
+        else:
+            matched = _match_condition(_values(document, key), condition)
+
+        if not matched:
+            return False
+
+    return True
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+from aiohttp import web
+import json
+import gzip
+import zlib
+
+# Optional fast JSON codec
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional binary msgpack codec
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Optional zstd content encoding
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Errors of the corrupted compressed bodies
+DECOMPRESSION_ERRORS = (zlib.error, zstandard.ZstdError) if zstandard else (zlib.error,)
+
+# Content types of the wire formats
+CONTENT_TYPES = {
+    'json': 'application/json',
+    'plain': 'text/plain',
+    'ndjson': 'application/x-ndjson',
+    'msgpack': 'application/msgpack'
+}
+
+# Wire formats by content type, aliases included
+FORMATS = { content_type: format_ for format_, content_type in CONTENT_TYPES.items() }
+FORMATS['application/x-msgpack'] = 'msgpack'
+
+# Content encodings of the responses, by preference
+ENCODINGS = ('zstd', 'gzip', 'deflate')
+
+# Largest decompressed body read whole, as the aiohttp default for plain bodies
+BODY_MAX_SIZE = 1024**2
+
+def available(format_):
+    """Tell if a wire format is known and its codec is installed."""
+
+    return format_ in CONTENT_TYPES and (format_ != 'msgpack' or msgpack is not None)
+
+def dumps(data):
+    """Encode an object to JSON bytes, with the fastest available codec."""
+
+    if orjson:
+        try:
+            return orjson.dumps(data)
+        except TypeError:
+            # Objects not supported by orjson, e.g. integers over 64 bits
+            pass
+
+    return json.dumps(data).encode('utf-8')
+
+def loads(data):
+    """Decode JSON bytes or text, with the fastest available codec."""
+
+    if orjson:
+        return orjson.loads(data)
+
+    return json.loads(data)
+
+def encode(data, format_):
+    """Encode an object to bytes in the json or msgpack wire format."""
+
+    if format_ == 'msgpack':
+        return msgpack.packb(data, use_bin_type = True)
+
+    return dumps(data)
+
+def decode(data, format_):
+    """Decode bytes in the json or msgpack wire format."""
+
+    if format_ == 'msgpack':
+        return msgpack.unpackb(data, raw = False)
+
+    return loads(data)
+
+def input_format(request, default = 'json'):
+    """Get the wire format of a request body, from the format argument or
+    the Content-Type header."""
+
+    format_ = request.query.get('format')
+    if format_:
+        return format_.lower()
+
+    return FORMATS.get(request.content_type, default)
+
+def output_format(request, default = 'json'):
+    """Get the wire format of a response body, from the format argument or
+    the Accept header."""
+
+    format_ = request.query.get('format')
+    if format_:
+        return format_.lower()
+
+    for accepted in request.headers.get('Accept', '').split(','):
+        content_type = accepted.split(';')[0].strip().lower()
+        if content_type in FORMATS:
+            return FORMATS[content_type]
+
+    return default
+
+def response(data, format_ = 'json', **kwargs):
+    """Build a response with an object encoded in the json or msgpack wire format."""
+
+    return web.Response(
+            body = encode(data, format_),
+            content_type = CONTENT_TYPES[format_],
+            **kwargs
+            )
+
+def decompressor(encoding):
+    """Get a streaming decompressor of a content encoding, None if not supported."""
+
+    if encoding in ('gzip', 'x-gzip'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif encoding == 'deflate':
+        return zlib.decompressobj()
+    elif encoding == 'zstd' and zstandard:
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    return None
+
+def request_encoding(request):
+    """Get the content encoding of a request body."""
+
+    return request.headers.get('Content-Encoding', 'identity').strip().lower()
+
+def decodable(request):
+    """Tell if the content encoding of a request body is supported."""
+
+    encoding = request_encoding(request)
+
+    return encoding == 'identity' or decompressor(encoding) is not None
+
+async def iter_body(request):
+    """Iterate the decompressed chunks of a request body, without reading it whole."""
+
+    encoding = request_encoding(request)
+
+    if encoding == 'identity':
+        async for chunk in request.content.iter_any():
+            yield chunk
+        return
+
+    decompressing = decompressor(encoding)
+
+    async for chunk in request.content.iter_any():
+        try:
+            data = decompressing.decompress(chunk)
+        except DECOMPRESSION_ERRORS as e:
+            raise _corrupted(encoding, str(e))
+        if data:
+            yield data
+
+    try:
+        data = decompressing.flush()
+    except DECOMPRESSION_ERRORS as e:
+        raise _corrupted(encoding, str(e))
+    if data:
+        yield data
+
+    if not getattr(decompressing, 'eof', True):
+        raise _corrupted(encoding, 'truncated body')
+
+def _corrupted(encoding, reason):
+
+    return web.HTTPBadRequest(
+            text = 'Error: can\'t decompress %s body: %s' % (encoding, reason)
+            )
+
+async def read_body(request):
+    """Read a whole decompressed request body, up to BODY_MAX_SIZE bytes."""
+
+    if request_encoding(request) == 'identity':
+        return await request.read()
+
+    body = bytearray()
+
+    async for chunk in iter_body(request):
+        body.extend(chunk)
+
+        if len(body) > BODY_MAX_SIZE:
+            raise web.HTTPRequestEntityTooLarge(
+                    max_size = BODY_MAX_SIZE, 
+                    actual_size = len(body)
+                    )
+
+    return bytes(body)
+
+def accepted_encoding(request):
+    """Get the preferred content encoding accepted by the client, None if any."""
+
+    accepted = set()
+
+    for coding in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = coding.partition(';')
+
+        # Skip the explicitly refused encodings
+        quality = params.replace(' ', '').lower()
+        if quality.startswith('q=') and not quality[2:].strip('0.'):
+            continue
+
+        accepted.add(name.strip().lower())
+
+    for encoding in ENCODINGS:
+        if encoding in accepted and (encoding != 'zstd' or zstandard):
+            return encoding
+
+    return None
+
+def compress(data, encoding):
+    """Compress bytes with a content encoding."""
+
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    elif encoding == 'gzip':
+        return gzip.compress(data)
+    else:
+        return zlib.compress(data)
+
+def compress_response(request, response, min_size):
+    """Compress a response body of at least min_size bytes, as accepted by the client."""
+
+    encoding = accepted_encoding(request)
+
+    if encoding and response.body is not None and len(response.body) >= min_size:
+        response.body = compress(response.body, encoding)
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+
+    return response
+
+class StreamWriter:
+    """Write the chunks of a stream response, compressed as accepted by the client.
+
+    Every chunk is flushed on its own, so that the client can decode it as soon as 
+    it is received. Create it before preparing the response.
+    """
+
+    def __init__(self, request, response):
+
+        self.response = response
+        self.compressor = None
+
+        encoding = accepted_encoding(request)
+        if not encoding:
+            return
+
+        response.headers['Content-Encoding'] = encoding
+        response.headers['Vary'] = 'Accept-Encoding'
+
+        if encoding == 'zstd':
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+            self.flush_mode = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+            self.finish_mode = zstandard.COMPRESSOBJ_FLUSH_FINISH
+        else:
+            wbits = 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS
+            self.compressor = zlib.compressobj(wbits = wbits)
+            self.flush_mode = zlib.Z_SYNC_FLUSH
+            self.finish_mode = zlib.Z_FINISH
+
+    async def write(self, data):
+
+        if self.compressor:
+            data = self.compressor.compress(data) + self.compressor.flush(self.flush_mode)
+
+        await self.response.write(data)
+
+    async def write_eof(self):
+
+        if self.compressor:
+            await self.response.write(self.compressor.flush(self.finish_mode))
+
+        await self.response.write_eof()
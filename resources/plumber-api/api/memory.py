@@ -0,0 +1,680 @@
+#!/usr/bin/env python3
+"""In-process storage engine, keeping the stage queues in memory.
+
+The unconsumed entries are kept in a deque in pop order, the leased ones by
+claim token, and the consumed ones only as the latest push time of their
+content hash, as the compacted history of the Mongo engine. The stored
+entries are indexed by id and by content hash. The state can be snapshotted
+to a file periodically and on stop, and restored on start.
+
+The state lives in the API process, so only a single API instance can
+serve the pipeline.
+"""
+import collections
+import datetime
+import asyncio
+import logging
+import secrets
+import pickle
+import heapq
+import uuid
+import os
+import queuestats
+import metrics
+import filters
+from engines import entry_hash
+
+# Seconds the hashes of the consumed entries are kept for push_if_new
+# and push_if_older_than. 0 keeps them forever.
+HISTORY_RETENTION = int(os.getenv('HISTORY_RETENTION', 0))
+
+# Snapshot file of the state, empty to disable the snapshots
+MEMORY_SNAPSHOT = os.getenv('MEMORY_SNAPSHOT', '')
+
+# Seconds between snapshots, 0 to only snapshot on stop
+MEMORY_SNAPSHOT_INTERVAL = int(os.getenv('MEMORY_SNAPSHOT_INTERVAL', 60))
+
+# Seconds over which the push and pop rates of the queue statistics are averaged
+STATS_RATE_WINDOW = 60
+
+# Queue entry, with its push sequence number giving the pop order
+Entry = collections.namedtuple('Entry', ('seq', 'time', 'hash', 'data'))
+
+class Queue:
+    """State of a stage queue."""
+
+    def __init__(self):
+
+        self.seq = 0
+
+        # Unconsumed entries, in pop order
+        self.ready = collections.deque()
+
+        # Leased entries as lists of [leased until, entries], by claim token
+        self.leases = {}
+        self.in_flight = 0
+
+        self.consumed = 0
+
+        # Latest push time, by content hash
+        self.pushed = {}
+
+        # Unconsumed entries, by content hash
+        self.queued = collections.Counter()
+
+    def insert(self, hash_, entry, now):
+
+        self.seq += 1
+        self.ready.append(Entry(self.seq, now, hash_, entry))
+        self.queued[hash_] += 1
+        self.pushed[hash_] = now
+
+    def consume(self, entries):
+
+        for entry in entries:
+            self.queued[entry.hash] -= 1
+            if not self.queued[entry.hash]:
+                del self.queued[entry.hash]
+
+        self.consumed += len(entries)
+
+    def known(self, hash_, now):
+        """Tell if a content hash has been pushed, and not yet forgotten by the retention."""
+
+        if hash_ in self.queued:
+            return True
+        if hash_ not in self.pushed:
+            return False
+
+        return not HISTORY_RETENTION or (
+                now - self.pushed[hash_] < datetime.timedelta(seconds = HISTORY_RETENTION)
+            )
+
+class Storage:
+    """Stored entries of a stage."""
+
+    def __init__(self):
+
+        # Stored entries, by id in insertion order
+        self.entries = {}
+
+        # Ids of the stored entries by content hash, and of the stored lists
+        # whose items can match a filter too
+        self.by_hash = collections.defaultdict(dict)
+        self.lists = {}
+
+    def insert(self, id_, entry):
+
+        self.entries[id_] = entry
+        self.by_hash[entry_hash(entry)][id_] = None
+        if isinstance(entry, list):
+            self.lists[id_] = None
+
+    def delete(self, id_):
+
+        entry = self.entries.pop(id_)
+
+        hash_ = entry_hash(entry)
+        del self.by_hash[hash_][id_]
+        if not self.by_hash[hash_]:
+            del self.by_hash[hash_]
+
+        self.lists.pop(id_, None)
+
+    def candidates(self, filter_):
+        """List the ids of the entries which can match a filter, by their indexes."""
+
+        id_ = filter_.get('_id')
+        if isinstance(id_, str):
+            return [ id_ ] if id_ in self.entries else []
+
+        if 'data' in filter_ and not filters.is_operator(filter_['data']):
+            equal_ids = self.by_hash.get(entry_hash(filter_['data']), {})
+            return list(equal_ids) + [ id_ for id_ in self.lists if id_ not in equal_ids ]
+
+        return list(self.entries)
+
+# State of the stage queues and of the stage storages, by stage number
+queues = {}
+storages = {}
+
+# Queue statistics, by stage number
+queue_stats = {}
+
+snapshot_task = None
+
+log = logging.getLogger('app')
+
+def _queue(stage):
+
+    if stage not in queues:
+        queues[stage] = Queue()
+
+    return queues[stage]
+
+def _storage(stage):
+
+    if stage not in storages:
+        storages[stage] = Storage()
+
+    return storages[stage]
+
+def _queue_stats(stage):
+
+    if stage not in queue_stats:
+        queue_stats[stage] = queuestats.QueueStats(STATS_RATE_WINDOW)
+
+    return queue_stats[stage]
+
+def _find(stage, filter_):
+    """List the ids of the stored entries matching a filter."""
+
+    storage = _storage(stage)
+
+    return [
+            id_ for id_ in storage.candidates(filter_)
+            if filters.match({ '_id': id_, 'data': storage.entries[id_] }, filter_)
+        ]
+
+def _write_snapshot(snapshot):
+
+    # Replace the previous snapshot only once the new one is complete
+    temporary = MEMORY_SNAPSHOT + '.tmp'
+    with open(temporary, 'wb') as snapshot_file:
+        snapshot_file.write(snapshot)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+
+    os.replace(temporary, MEMORY_SNAPSHOT)
+
+def _snapshot():
+
+    # Serialized in one go on the event loop, to be consistent
+    return pickle.dumps((queues, storages), protocol = pickle.HIGHEST_PROTOCOL)
+
+async def snapshot_periodically():
+    """Snapshot the state to the snapshot file every interval."""
+
+    loop = asyncio.get_event_loop()
+
+    while True:
+        await asyncio.sleep(MEMORY_SNAPSHOT_INTERVAL)
+
+        try:
+            await loop.run_in_executor(None, _write_snapshot, _snapshot())
+            log.debug('memory snapshot written to %s' % MEMORY_SNAPSHOT)
+        except Exception as e:
+            log.warning('memory snapshot error: %s' % str(e))
+
+async def start():
+    """Start the engine, restoring the state from the snapshot file, if any."""
+
+    global queues, storages, snapshot_task
+
+    if not MEMORY_SNAPSHOT:
+        return
+
+    if os.path.exists(MEMORY_SNAPSHOT):
+        with open(MEMORY_SNAPSHOT, 'rb') as snapshot_file:
+            queues, storages = pickle.load(snapshot_file)
+
+        log.debug('memory snapshot restored from %s' % MEMORY_SNAPSHOT)
+
+    if MEMORY_SNAPSHOT_INTERVAL:
+        snapshot_task = asyncio.ensure_future(snapshot_periodically())
+
+def stop():
+    """Stop the engine, snapshotting the state to the snapshot file, if enabled."""
+
+    if snapshot_task:
+        snapshot_task.cancel()
+
+    if MEMORY_SNAPSHOT:
+        _write_snapshot(_snapshot())
+        log.debug('memory snapshot written to %s' % MEMORY_SNAPSHOT)
+
+async def warm_seen_cache(stage):
+    """Every pushed content hash is already in memory, there is no cache to warm."""
+
+def seen_cache_stats(stage):
+    """Get the counters of the seen-set cache, always empty as there is no cache."""
+
+    return {}
+
+def stats(stage):
+    """Get the statistics of a stage queue, counted exactly.
+
+    Parameters:
+
+        stage: The number of stage queue.
+
+    Returns: the ready, in-flight and consumed entries, the age of the oldest ready entry in seconds, and the push and pop rates per second.
+    """
+
+    queue = _queue(stage)
+
+    counters = _queue_stats(stage)
+    counters.reconcile(
+            len(queue.ready),
+            queue.in_flight,
+            queue.consumed,
+            queue.ready[0].time if queue.ready else None
+        )
+
+    return counters.stats(datetime.datetime.utcnow())
+
+async def reconcile_stats(stage):
+    """Sample the push and pop rates of a stage queue, the counters are always exact.
+
+    Parameters:
+
+        stage: The number of stage queue.
+    """
+
+    _queue_stats(stage).sample()
+
+async def ensure_indexes(stage):
+    """Create the state of a stage, indexed from the start.
+
+    Parameters:
+
+        stage: The number of stage queue.
+    """
+
+    _queue(stage)
+    _storage(stage)
+
+def _structure(structure):
+
+    return { 'structure': type(structure).__name__, 'size': len(structure) }
+
+async def indexes(stage):
+    """List the in-memory lookup structures of a stage.
+
+    Parameters:
+
+        stage: The number of stage queue.
+
+    Returns: the type and the size of every structure, by the Mongo collection name it stands for.
+    """
+
+    queue = _queue(stage)
+    storage = _storage(stage)
+
+    return {
+        'incoming': {
+            'ready': _structure(queue.ready),
+            'leases': _structure(queue.leases),
+            'pushed': _structure(queue.pushed),
+            'queued': _structure(queue.queued)
+        },
+        'storage': {
+            'entries': _structure(storage.entries),
+            'by_hash': _structure(storage.by_hash),
+            'lists': _structure(storage.lists)
+        }
+    }
+
+async def depth(stage):
+    """Count the entries waiting in a stage queue.
+
+    Parameters:
+
+        stage: The number of stage queue.
+
+    Returns: the number of unconsumed entries.
+    """
+
+    return len(_queue(stage).ready)
+
+async def flush(stage):
+    """
+    Flush stage queue.
+    """
+
+    queues[stage] = Queue()
+    _queue_stats(stage).reset()
+
+    log.debug('stage-%d delete' % (stage))
+
+async def pop(stage, quantity = 1, lease = 0):
+    """Pop entries from a stage queue.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        quantity: The number of entries to retrieve. Default is 1.
+        lease: Lease the entries for a number of seconds, after which they are returned to the queue if not acknowledged. Default is 0 (disabled).
+
+    Returns the data objects.
+    """
+
+    token, results = await claim(stage, quantity, lease)
+
+    return results
+
+async def claim(stage, quantity = 1, lease = 0, token = None):
+    """Pop entries from a stage queue, along with their claim token.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        quantity: The number of entries to retrieve. Default is 1.
+        lease: Lease the entries for a number of seconds, after which they are returned to the queue if not acknowledged. Default is 0 (disabled).
+        token: The claim token of a previous claim to extend. Default is a new claim token.
+
+    Returns: the claim token and the data objects.
+    """
+
+    queue = _queue(stage)
+
+    token = token or uuid.uuid4().hex
+
+    entries = [ queue.ready.popleft() for i in range(min(quantity, len(queue.ready))) ]
+
+    if entries and lease:
+        leased_until = datetime.datetime.utcnow() + datetime.timedelta(seconds = lease)
+        queue.leases.setdefault(token, []).append([ leased_until, entries ])
+        queue.in_flight += len(entries)
+    else:
+        queue.consume(entries)
+
+    _queue_stats(stage).pop(len(entries), bool(lease))
+    metrics.entries_popped.inc(len(entries), stage = stage)
+
+    log.debug(
+            'stage-%d pops %d/%d' % (
+                stage,
+                len(entries),
+                quantity
+                )
+            )
+    return token, [ entry.data for entry in entries ]
+
+async def ack(stage, claims):
+    """Acknowledge the processing of leased entries.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        claims: List of claim tokens of the leased entries.
+
+    Returns: the number of acknowledged entries.
+    """
+
+    queue = _queue(stage)
+
+    # Entries whose lease has already expired and which have been
+    # returned to the queue have lost their claim token
+    acked = 0
+    for token in claims:
+        for leased_until, entries in queue.leases.pop(token, []):
+            queue.consume(entries)
+            acked += len(entries)
+
+    queue.in_flight -= acked
+    _queue_stats(stage).ack(acked)
+
+    log.debug(
+            'stage-%d acks %d' % (
+                stage,
+                acked
+                )
+            )
+    return acked
+
+async def reap(stage):
+    """Return the entries with an expired lease to the stage queue.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+
+    Returns: the number of returned entries.
+    """
+
+    queue = _queue(stage)
+    now = datetime.datetime.utcnow()
+
+    returned = []
+    for token in list(queue.leases):
+
+        leases = queue.leases[token]
+        returned += [ entry for leased_until, entries in leases if leased_until < now for entry in entries ]
+
+        leases[:] = [ lease for lease in leases if lease[0] >= now ]
+        if not leases:
+            del queue.leases[token]
+
+    if not returned:
+        return 0
+
+    # Back to their place in the pop order
+    returned.sort()
+    if queue.ready and returned[-1].seq > queue.ready[0].seq:
+        queue.ready = collections.deque(heapq.merge(returned, queue.ready))
+    else:
+        queue.ready.extendleft(reversed(returned))
+
+    queue.in_flight -= len(returned)
+    _queue_stats(stage).reap(len(returned))
+
+    log.debug(
+            'stage-%d reaps %d expired leases' % (
+                stage,
+                len(returned)
+                )
+            )
+    return len(returned)
+
+async def compact(stage):
+    """Forget the content hashes of the consumed entries older than the retention.
+
+    The consumed entries are dropped when consumed, keeping only the latest
+    push time of their content hash.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+
+    Returns: the number of forgotten hashes.
+    """
+
+    if not HISTORY_RETENTION:
+        return 0
+
+    queue = _queue(stage)
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds = HISTORY_RETENTION)
+
+    expired = [
+            hash_ for hash_, time in queue.pushed.items()
+            if time < cutoff and hash_ not in queue.queued
+        ]
+    for hash_ in expired:
+        del queue.pushed[hash_]
+
+    if expired:
+        log.debug(
+                'stage-%d compacts %d' % (
+                    stage,
+                    len(expired)
+                    )
+                )
+    return len(expired)
+
+async def push(stage, entry_list, push_if_new = False, push_if_older_than = 0):
+    """Push entries to a stage queue.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        entry_list: List of objects.
+        push_if_new: Push only the entries which haven't been previously pushed. Default is false.
+        push_if_older_than: Push only the entries which haven't been previously pushed or that have been older than a number of seconds. Default is 0 (disabled).
+
+    Returns: the number of pushed entries.
+    """
+
+    # Silently exit on empty lists
+    if not entry_list:
+        return []
+
+    queue = _queue(stage)
+    now = datetime.datetime.utcnow()
+
+    pushed = 0
+
+    if push_if_new:
+
+        for entry in entry_list:
+            hash_ = entry_hash(entry)
+
+            if not queue.known(hash_, now):
+                queue.insert(hash_, entry, now)
+                pushed += 1
+
+        mode = ' (if-new)'
+
+    elif push_if_older_than:
+
+        cutoff = now - datetime.timedelta(seconds = push_if_older_than)
+
+        # The entries repeated in the batch are pushed only once, as their
+        # push time is past the cutoff once pushed
+        for entry in entry_list:
+            hash_ = entry_hash(entry)
+
+            if queue.pushed.get(hash_, cutoff) <= cutoff:
+                queue.insert(hash_, entry, now)
+                pushed += 1
+
+        mode = ' (if-older-than %d)' % push_if_older_than
+
+    else:
+
+        for entry in entry_list:
+            queue.insert(entry_hash(entry), entry, now)
+
+        pushed = len(entry_list)
+        mode = ''
+
+    _queue_stats(stage).push(pushed, now)
+    metrics.entries_pushed.inc(pushed, stage = stage)
+    metrics.entries_deduplicated.inc(len(entry_list) - pushed, stage = stage)
+
+    log.debug(
+            'pushed to stage-%d%s %d/%d' % (
+                stage,
+                mode,
+                pushed,
+                len(entry_list)
+                )
+            )
+    return pushed
+
+async def watch(stage):
+    """Watch the entries pushed to a stage queue by other API instances.
+
+    Every push goes through this process, which wakes up the waiting pops
+    by itself, so there is never anything to watch.
+
+    Parameters:
+
+        stage: The number of stage queue.
+
+    Yields: never.
+    """
+
+    await asyncio.Future()
+    yield
+
+async def store(stage, json_data):
+    """Store an entry.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        json_data: The entry object.
+
+    Returns the id of the stored object, as 24 hexadecimal digits like the Mongo ObjectIDs.
+    """
+
+    id_ = secrets.token_hex(12)
+    _storage(stage).insert(id_, json_data)
+
+    log.debug(
+            'stored to stage-%d' % (
+                stage,
+                )
+            )
+
+    return id_
+
+async def load(stage, filter_, delete):
+    """Load an entry.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        filter_: The filter JSON object, as accepted by Mongo find_one.
+        delete: Delete the matching objects.
+
+    Returns: the requested entry object.
+    """
+
+    ids = _find(stage, filter_)[:1]
+
+    log.debug(
+            'loaded%s from stage-%d %d/1' % (
+                ' and deleted' if delete else '',
+                stage,
+                len(ids)
+                )
+            )
+
+    if not ids:
+        return None
+
+    result = { '_id': ids[0], 'data': _storage(stage).entries[ids[0]] }
+    if delete:
+        _storage(stage).delete(ids[0])
+
+    return result
+
+async def load_many(stage, filter_, delete):
+    """Load all the entries matching a filter.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        filter_: The filter JSON object, as accepted by Mongo find.
+        delete: Delete the matching objects, once loaded.
+
+    Yields: the requested entry objects.
+    """
+
+    storage = _storage(stage)
+
+    loaded = 0
+
+    for id_ in _find(stage, filter_):
+
+        # Skip the entries deleted by concurrent loads in the meanwhile
+        if id_ not in storage.entries:
+            continue
+
+        loaded += 1
+        result = { '_id': id_, 'data': storage.entries[id_] }
+
+        if delete:
+            storage.delete(id_)
+
+        yield result
+
+    log.debug(
+            'loaded%s from stage-%d %d' % (
+                ' and deleted' if delete else '',
+                stage,
+                loaded
+                )
+            )
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""Metrics of the API, exposed in the Prometheus text format.
+
+The metrics are updated by the request handlers on the event loop and by
+the Mongo command listener of the mongo engine on the driver threads, so
+every update holds the lock of its metric.
+"""
+import threading
+import asyncio
+import bisect
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Every metric, in exposition order
+registry = []
+
+def _escape(value):
+
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra = ()):
+
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+def _number(value):
+
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric:
+    """Base of the metrics, holding a value by tuple of label values.
+
+    Parameters:
+
+        name: The metric name.
+        documentation: The help text of the metric.
+        labels: The label names.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels = ()):
+
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+        registry.append(self)
+
+    def _key(self, labels):
+
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self):
+        """List the samples of the metric, as (name suffix, label values, extra labels, value)."""
+
+        with self.lock:
+            return [ ('', key, (), value) for key, value in sorted(self.values.items()) ]
+
+    def render(self):
+        """Render the metric in the Prometheus text format."""
+
+        lines = [
+            '# HELP %s %s' % (self.name, self.documentation),
+            '# TYPE %s %s' % (self.name, self.kind)
+        ]
+
+        for suffix, key, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (
+                    self.name,
+                    suffix,
+                    _labels(self.label_names, key, extra),
+                    _number(value)
+                ))
+
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    """Monotonic counter."""
+
+    kind = 'counter'
+
+    def inc(self, amount = 1, **labels):
+
+        if not amount:
+            return
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    """Value which can go up and down."""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    """Distribution of observed values in cumulative buckets.
+
+    Parameters are the ones of Metric, plus:
+
+        buckets: The sorted upper bounds of the buckets.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels = (), buckets = LATENCY_BUCKETS):
+
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def observe(self, value, **labels):
+
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self.lock:
+            if key not in self.values:
+                # Counts by bucket, then the sum of the observed values
+                self.values[key] = [ [0] * len(self.buckets), 0.0 ]
+
+            counts = self.values[key]
+            counts[0][index] += 1
+            counts[1] += value
+
+    def samples(self):
+
+        samples = []
+
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append(('_bucket', key, (('le', _number(bound)),), cumulative))
+
+                samples.append(('_sum', key, (), total))
+                samples.append(('_count', key, (), cumulative))
+
+        return samples
+
+def render():
+    """Render every metric in the Prometheus text format."""
+
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+# HTTP API metrics
+
+http_requests = Counter(
+        'plumber_http_requests_total',
+        'HTTP requests by route, stage, method and status.',
+        ('route', 'stage', 'method', 'status')
+    )
+http_request_duration = Histogram(
+        'plumber_http_request_duration_seconds',
+        'HTTP request latency by route, stage and method, in seconds.',
+        ('route', 'stage', 'method')
+    )
+
+# Queue metrics
+
+entries_pushed = Counter(
+        'plumber_entries_pushed_total',
+        'Entries pushed to the stage queues.',
+        ('stage',)
+    )
+entries_popped = Counter(
+        'plumber_entries_popped_total',
+        'Entries popped from the stage queues.',
+        ('stage',)
+    )
+entries_deduplicated = Counter(
+        'plumber_entries_deduplicated_total',
+        'Entries skipped by push_if_new and push_if_older_than.',
+        ('stage',)
+    )
+
+# Database metrics
+
+mongo_command_duration = Histogram(
+        'plumber_mongo_command_duration_seconds',
+        'Mongo command latency by command name, in seconds.',
+        ('command',)
+    )
+mongo_command_failures = Counter(
+        'plumber_mongo_command_failures_total',
+        'Failed Mongo commands by command name.',
+        ('command',)
+    )
+
+# Event loop metrics
+
+event_loop_lag = Gauge(
+        'plumber_event_loop_lag_seconds',
+        'Latest delay of the event loop in running a scheduled callback, in seconds.'
+    )
+event_loop_lag_duration = Histogram(
+        'plumber_event_loop_lag_duration_seconds',
+        'Delays of the event loop in running a scheduled callback, in seconds.'
+    )
+
+async def watch_event_loop(interval):
+    """Measure how late the event loop wakes up a sleeping task, forever.
+
+    Parameters:
+
+        interval: The time between measures, in seconds.
+    """
+
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+
+        lag = max(time.monotonic() - start - interval, 0)
+
+        event_loop_lag.set(lag)
+        event_loop_lag_duration.observe(lag)
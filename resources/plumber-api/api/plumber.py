@@ -1,59 +1,593 @@
 #!/usr/bin/env python3
+import motor.motor_asyncio
 import pymongo
+import pymongo.monitoring
 import os
 import datetime
 import sys
 import logging
+import uuid
+import seencache
+import queuestats
+import metrics
+import filters
+from engines import entry_hash
+from bson import objectid
 
 MONGO_HOST="mongodb://mongo:27017/"
 
 mdb =  None
 
+# Rounds of batch claiming a pop does when contending with other pops
+POP_CLAIM_ATTEMPTS = 3
+
+# Mongo error code of the unique index violations
+DUPLICATE_KEY_ERROR = 11000
+
+# Seconds the hashes of the consumed entries are kept for push_if_new 
+# and push_if_older_than, once compacted. 0 keeps them forever.
+HISTORY_RETENTION = int(os.getenv('HISTORY_RETENTION', 0))
+
+# Most consumed entries compacted in a single batch
+COMPACT_BATCH = 1000
+
+# Most loaded entries deleted in a single batch
+LOAD_DELETE_BATCH = 1000
+
+# Most entries hashed in a single batch, when backfilling the content 
+# hashes of the entries written by older versions
+BACKFILL_BATCH = 1000
+
+# Settings of the in-process seen-set cache in front of push_if_new. 
+# The cache is disabled with no memory.
+SEEN_CACHE_MEMORY = int(os.getenv('SEEN_CACHE_MB', 0)) * 2**20
+SEEN_CACHE_ERROR_RATE = float(os.getenv('SEEN_CACHE_ERROR_RATE', 0.001))
+SEEN_CACHE_RECENT = int(os.getenv('SEEN_CACHE_RECENT', 100000))
+
+# Seen-set caches, by stage number
+seen_caches = {}
+
+# Seconds over which the push and pop rates of the queue statistics are averaged
+STATS_RATE_WINDOW = 60
+
+# Queue statistics, by stage number
+queue_stats = {}
+
+# Indexes of the stage collections, as (name, keys, options)
+INDEXES = {
+    'incoming': [
+        # Queue of the unconsumed entries sorted in pop order, and consumed
+        # entries for the compaction. Keyed by the consumption first, as 
+        # Mongo refuses partial indexes on _id alone.
+        (
+            'ready', 
+            [('_consumed', 1), ('_id', 1)], 
+            {}
+        ),
+        # Leased entries, by lease expiration
+        (
+            'leased', 
+            [('_leased_until', 1)], 
+            { 'partialFilterExpression': { '_leased_until': { '$exists': True } } }
+        ),
+        # Lookup of previously pushed entries by push_if_new and push_if_older_than
+        (
+            'hash_time', 
+            [('_hash', 1), ('_time', 1)], 
+            {}
+        ),
+        # Uniqueness of the entries pushed by push_if_new. Plain pushes can
+        # legitimately repeat an entry, so they are left out of the index.
+        (
+            'hash_if_new', 
+            [('_hash', 1)], 
+            { 'unique': True, 'partialFilterExpression': { '_if_new': True } }
+        ),
+    ],
+    # Compacted consumed entries, by content hash
+    'history': [
+        # Expiration of the entries older than the retention
+        (
+            'expire', 
+            [('_time', 1)], 
+            { 'expireAfterSeconds': HISTORY_RETENTION }
+        ),
+    ] if HISTORY_RETENTION else [],
+    'storage': [
+        # Lookup of stored entries by content hash
+        (
+            'data_hash', 
+            [('_hash', 1)], 
+            {}
+        ),
+        # Stored lists, whose items match the equalities on the content too
+        (
+            'lists', 
+            [('_list', 1)], 
+            { 'partialFilterExpression': { '_list': True } }
+        ),
+    ]
+}
+
+# Errors of the indexes existing with other keys or options, which are
+# recreated: IndexOptionsConflict and IndexKeySpecsConflict
+INDEX_CONFLICTS = (85, 86)
+
+# Indexes of older versions, dropped at startup
+OBSOLETE_INDEXES = {
+    # Partial index of the consumed entries, merged in the ready index
+    'incoming': [ 'consumed' ],
+    # Index of the whole stored content, replaced by its hash
+    'storage': [ 'data' ]
+}
+
+# Internal fields of the stored entries, left out of the loads
+STORAGE_PROJECTION = { '_hash': False, '_list': False }
+
 log = logging.getLogger('app')
 
+class CommandListener(pymongo.monitoring.CommandListener):
+    """Time the Mongo commands, as sent on the wire (insert, update, find, ...)."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+
+        metrics.mongo_command_duration.observe(
+                event.duration_micros / 1e6,
+                command = event.command_name
+            )
+
+    def failed(self, event):
+
+        metrics.mongo_command_duration.observe(
+                event.duration_micros / 1e6,
+                command = event.command_name
+            )
+        metrics.mongo_command_failures.inc(command = event.command_name)
+
 def _lazy_connect():
     global mdb
 
     if not mdb:
-        mdb = pymongo.MongoClient(MONGO_HOST)
+        mdb = motor.motor_asyncio.AsyncIOMotorClient(
+                MONGO_HOST,
+                event_listeners = [ CommandListener() ]
+            )
+
+async def start():
+    """Start the engine, connecting to the database."""
+
+    _lazy_connect()
+
+def stop():
+    """Stop the engine, closing the database connection."""
+
+    if mdb:
+        mdb.close()
+
+def _objectify(filter_):
+
+    # Objectify _id in case has been searched by id
+    if isinstance(filter_.get('_id'), str):
+        filter_ = dict(filter_, _id = objectid.ObjectId(filter_['_id']))
+
+    return filter_
+
+def _storage_filter(filter_):
+
+    filter_ = _objectify(filter_)
+
+    # Look up the equalities on the content by hash. A stored list also
+    # matches the equality on one of its items, as Mongo does.
+    if 'data' in filter_ and not filters.is_operator(filter_['data']):
+        filter_ = { 
+            '$and': [ 
+                filter_, 
+                { '$or': [ 
+                    { '_hash': entry_hash(filter_['data']) }, 
+                    { '_list': True } 
+                ] } 
+            ] 
+        }
+
+    return filter_
+
+def _incoming_fields(data):
+
+    return { '_hash': entry_hash(data) }
+
+def _storage_fields(data):
+
+    return { '_hash': entry_hash(data), '_list': isinstance(data, list) }
+
+async def _backfill_hashes(collection, fields):
+    """Set the content hash fields of the entries written by older versions.
+
+    Parameters:
+        
+        collection: The Mongo collection.
+        fields: The function computing the fields to set from the entry data.
+    
+    Returns: the number of updated entries.
+    """
+
+    backfilled = 0
+
+    while True:
+
+        # A missing hash is indexed as null
+        documents = await collection.find(
+                filter = { '_hash': None },
+                projection = { '_id': True, 'data': True },
+                limit = BACKFILL_BATCH
+            ).to_list(None)
+
+        if not documents:
+            break
+
+        result = await collection.bulk_write(
+                [ 
+                    pymongo.UpdateOne(
+                        filter = { '_id': document['_id'] },
+                        update = { '$set': fields(document.get('data')) }
+                    ) for document in documents
+                ],
+                ordered = False
+            )
+
+        backfilled += result.modified_count
+
+    return backfilled
+
+def _new_seen_cache(stage):
+
+    seen_caches[stage] = seencache.SeenCache(
+            SEEN_CACHE_MEMORY,
+            SEEN_CACHE_ERROR_RATE,
+            SEEN_CACHE_RECENT,
+            HISTORY_RETENTION
+        )
+
+    return seen_caches[stage]
+
+async def warm_seen_cache(stage):
+    """Create the seen-set cache of a stage queue, if enabled, and warm it 
+    with the content hashes of the pushed entries.
+
+    Parameters:
+        
+        stage: The number of stage queue.
+    """
+
+    if not SEEN_CACHE_MEMORY:
+        return
+
+    _lazy_connect()
+
+    cache = _new_seen_cache(stage)
+
+    # Scan the queue before its history, to still find the entries 
+    # compacted in the meanwhile
+    async for document in mdb['stage-%d' % stage].incoming.find(
+            filter = { '_hash': { '$exists': True } },
+            projection = { '_id': False, '_hash': True }
+            ):
+        cache.warm(document['_hash'])
+
+    async for document in mdb['stage-%d' % stage].history.find(
+            projection = { '_id': True }
+            ):
+        cache.warm(document['_id'])
+
+    cache.ready = True
+
+    log.debug(
+            'stage-%d seen-set cache warmed with %d entries' % (
+                stage,
+                cache.bloom.count
+                )
+            )
+
+def seen_cache_stats(stage):
+    """Get the counters of the seen-set cache of a stage queue.
+
+    Parameters:
+        
+        stage: The number of stage queue.
+    
+    Returns: the counters and the sizing of the cache, empty if disabled.
+    """
+
+    if stage not in seen_caches:
+        return {}
+
+    return seen_caches[stage].stats()
+
+def _queue_stats(stage):
+
+    if stage not in queue_stats:
+        queue_stats[stage] = queuestats.QueueStats(STATS_RATE_WINDOW)
+
+    return queue_stats[stage]
+
+def stats(stage):
+    """Get the statistics of a stage queue, from the counters maintained by
+    the pushes and the pops, without querying the database.
+
+    Parameters:
+        
+        stage: The number of stage queue.
+    
+    Returns: the ready, in-flight and consumed entries, the age of the oldest ready entry in seconds, and the push and pop rates per second.
+    """
+
+    return _queue_stats(stage).stats(datetime.datetime.utcnow())
+
+async def reconcile_stats(stage):
+    """Reconcile the counters of the statistics of a stage queue with the 
+    database, and sample the push and pop rates.
+
+    The consumed entries compacted to the history are counted once per 
+    content hash.
+
+    Parameters:
+        
+        stage: The number of stage queue.
+    """
+
+    _lazy_connect()
+
+    incoming = mdb['stage-%d' % stage].incoming
+
+    # Covered by the ready and leased indexes, picked by the planner, the
+    # rest is read from the collection metadata rather than scanning the 
+    # consumed entries
+    ready = await incoming.count_documents({ '_consumed': False })
+    in_flight = await incoming.count_documents({ '_leased_until': { '$exists': True } })
+    total = await incoming.estimated_document_count()
+    compacted = await mdb['stage-%d' % stage].history.estimated_document_count()
+
+    oldest = await incoming.find_one(
+            filter = { '_consumed': False },
+            projection = { '_id': False, '_time': True },
+            sort = [('_id', 1)]
+        )
+
+    counters = _queue_stats(stage)
+    counters.reconcile(
+            ready,
+            in_flight,
+            max(total - ready - in_flight, 0) + compacted,
+            oldest['_time'] if oldest else None
+        )
+    counters.sample()
+
+def _record_seen(stage, formatted_entries):
+
+    cache = seen_caches.get(stage)
+
+    if cache:
+        for document in formatted_entries:
+            cache.add(document['_hash'], document['_time'])
+
+async def ensure_indexes(stage):
+    """Create the missing indexes of the stage collections.
+
+    Parameters:
+        
+        stage: The number of stage queue.
+    """
+
+    _lazy_connect()
+
+    for collection, collection_indexes in INDEXES.items():
+        for name, keys, options in collection_indexes:
+            try:
+                await mdb['stage-%d' % stage][collection].create_index(
+                        keys,
+                        name = name,
+                        **options
+                    )
+            except pymongo.errors.OperationFailure as e:
+                if e.code not in INDEX_CONFLICTS:
+                    log.error(
+                            'stage-%d %s index %s not created: %s' % (
+                                stage,
+                                collection,
+                                name,
+                                str(e)
+                                )
+                            )
+                    raise
+
+                # An index of an older version with the same name and other 
+                # keys or options, e.g. the expiration of a changed retention
+                log.warning(
+                        'stage-%d %s index %s recreated: %s' % (
+                            stage,
+                            collection,
+                            name,
+                            str(e)
+                            )
+                        )
+                await mdb['stage-%d' % stage][collection].drop_index(name)
+                await mdb['stage-%d' % stage][collection].create_index(
+                        keys,
+                        name = name,
+                        **options
+                    )
+
+    for collection, names in OBSOLETE_INDEXES.items():
+        existing = await mdb['stage-%d' % stage][collection].index_information()
+        for name in names:
+            if name in existing:
+                await mdb['stage-%d' % stage][collection].drop_index(name)
+
+    # The entries queued by older versions must be found by push_if_new 
+    # and push_if_older_than
+    backfilled = await _backfill_hashes(
+            mdb['stage-%d' % stage].incoming, 
+            _incoming_fields
+        )
+    if backfilled:
+        log.debug('stage-%d hashes %d queued entries' % (stage, backfilled))
 
-def flush(stage):
+    backfilled = await _backfill_hashes(
+            mdb['stage-%d' % stage].storage, 
+            _storage_fields
+        )
+    if backfilled:
+        log.debug('stage-%d hashes %d stored entries' % (stage, backfilled))
+
+    log.debug('stage-%d indexes ensured' % (stage))
+
+async def indexes(stage):
+    """List the indexes of the stage collections.
+
+    Parameters:
+        
+        stage: The number of stage queue.
+    
+    Returns: the index information of every collection, by collection name.
+    """
+
+    _lazy_connect()
+
+    results = {}
+
+    for collection in INDEXES:
+        results[collection] = await mdb['stage-%d' % stage][collection].index_information()
+
+    return results
+
+async def depth(stage):
+    """Count the entries waiting in a stage queue.
+
+    Parameters:
+        
+        stage: The number of stage queue.
+    
+    Returns: the number of unconsumed entries.
+    """
+
+    _lazy_connect()
+
+    # Covered by the ready index, picked by the planner
+    return await mdb['stage-%d' % stage].incoming.count_documents(
+            { '_consumed': False }
+        )
+
+async def flush(stage):
     """
     Flush stage queue.
     """
 
     _lazy_connect()
 
-    mdb['stage-%d' % stage].incoming.drop()
+    await mdb['stage-%d' % stage].incoming.drop()
+    await mdb['stage-%d' % stage].history.drop()
+
+    # Nothing has been pushed to the emptied queue
+    if stage in seen_caches:
+        _new_seen_cache(stage).ready = True
+
+    _queue_stats(stage).reset()
 
     log.debug('stage-%d delete' % (stage))
 
+    # Dropping the collection drops its indexes too
+    await ensure_indexes(stage)
 
-def pop(stage, quantity = 1):
+
+async def pop(stage, quantity = 1, lease = 0):
     """Pop entries from a stage queue.
 
     Parameters:
         
         stage: The number of the stage queue.
         quantity: The number of entries to retrieve. Default is 1.
+        lease: Lease the entries for a number of seconds, after which they are returned to the queue if not acknowledged. Default is 0 (disabled).
     
     Returns the data objects.
     """
 
+    token, results = await claim(stage, quantity, lease)
+
+    return results
+
+async def claim(stage, quantity = 1, lease = 0, token = None):
+    """Pop entries from a stage queue, along with their claim token.
+
+    Parameters:
+        
+        stage: The number of the stage queue.
+        quantity: The number of entries to retrieve. Default is 1.
+        lease: Lease the entries for a number of seconds, after which they are returned to the queue if not acknowledged. Default is 0 (disabled).
+        token: The claim token of a previous claim to extend. Default is a new claim token.
+    
+    Returns: the claim token and the data objects.
+    """
+
     _lazy_connect()
 
+    incoming = mdb['stage-%d' % stage].incoming
+
+    # Every pop marks its entries with a claim token, so that the entries
+    # it won can be told apart from the ones claimed by concurrent pops.
+    token = token or uuid.uuid4().hex
+
+    claimed_fields = { '_consumed': True, '_claim': token }
+    if lease:
+        claimed_fields['_leased_until'] = datetime.datetime.utcnow() + datetime.timedelta(
+                seconds = lease
+            )
+
     results = []
-    
-    for i in range(quantity):
-        
-        result = mdb['stage-%d' % stage].incoming.find_one_and_update(
+
+    for attempt in range(POP_CLAIM_ATTEMPTS):
+
+        if len(results) >= quantity:
+            break
+
+        # Pick the oldest unconsumed entries
+        candidates = await incoming.find(
                 filter = { '_consumed': False },
-                update = { '$set': { '_consumed': True } },
-                sort = [('_id', 1)]
+                sort = [('_id', 1)],
+                limit = quantity - len(results)
+            ).to_list(None)
+
+        if not candidates:
+            break
+
+        candidate_ids = [ candidate['_id'] for candidate in candidates ]
+
+        # Claim them all at once, skipping the ones consumed in the meanwhile
+        result = await incoming.update_many(
+                filter = { 
+                    '_id': { '$in': candidate_ids }, 
+                    '_consumed': False 
+                },
+                update = { '$set': claimed_fields }
             )
 
-        if result:
-            results.append(result['data'])
+        if result.modified_count == len(candidates):
+            results += [ candidate['data'] for candidate in candidates ]
+        else:
+            # Some candidates have been claimed by another pop, fetch back
+            # only the entries marked with this claim
+            claimed = await incoming.find(
+                    filter = { 
+                        '_id': { '$in': candidate_ids }, 
+                        '_claim': token 
+                    },
+                    sort = [('_id', 1)]
+                ).to_list(None)
+            results += [ entry['data'] for entry in claimed ]
+
+    _queue_stats(stage).pop(len(results), bool(lease))
+    metrics.entries_popped.inc(len(results), stage = stage)
 
     log.debug(
             'stage-%d pops %d/%d' % (
@@ -62,9 +596,141 @@ def pop(stage, quantity = 1):
                 quantity
                 )
             )
-    return results
+    return token, results
+
+async def ack(stage, claims):
+    """Acknowledge the processing of leased entries.
+
+    Parameters:
+        
+        stage: The number of the stage queue.
+        claims: List of claim tokens of the leased entries.
+    
+    Returns: the number of acknowledged entries.
+    """
+
+    _lazy_connect()
+
+    # Entries whose lease has already expired and which have been 
+    # returned to the queue have lost their claim token
+    result = await mdb['stage-%d' % stage].incoming.update_many(
+            filter = { 
+                '_claim': { '$in': claims }, 
+                '_leased_until': { '$exists': True } 
+            },
+            update = { '$unset': { '_leased_until': '' } }
+        )
+
+    _queue_stats(stage).ack(result.modified_count)
+
+    log.debug(
+            'stage-%d acks %d' % (
+                stage, 
+                result.modified_count
+                )
+            )
+    return result.modified_count
+
+async def reap(stage):
+    """Return the entries with an expired lease to the stage queue.
+
+    Parameters:
+        
+        stage: The number of the stage queue.
+    
+    Returns: the number of returned entries.
+    """
+
+    _lazy_connect()
+
+    result = await mdb['stage-%d' % stage].incoming.update_many(
+            filter = { '_leased_until': { '$lt': datetime.datetime.utcnow() } },
+            update = { 
+                '$set': { '_consumed': False },
+                '$unset': { '_leased_until': '', '_claim': '' } 
+            }
+        )
+
+    _queue_stats(stage).reap(result.modified_count)
 
-def push(stage, entry_list, push_if_new = False, push_if_older_than = 0):
+    if result.modified_count:
+        log.debug(
+                'stage-%d reaps %d expired leases' % (
+                    stage, 
+                    result.modified_count
+                    )
+                )
+    return result.modified_count
+
+async def compact(stage):
+    """Move the consumed entries of a stage queue to its history.
+
+    The history keeps only the content hash and the latest push time of the
+    consumed entries, as needed by push_if_new and push_if_older_than.
+
+    Parameters:
+        
+        stage: The number of the stage queue.
+    
+    Returns: the number of compacted entries.
+    """
+
+    _lazy_connect()
+
+    incoming = mdb['stage-%d' % stage].incoming
+    history = mdb['stage-%d' % stage].history
+
+    compacted = 0
+
+    while True:
+
+        # Consumed entries, except the leased ones which may be returned 
+        # to the queue
+        consumed = await incoming.find(
+                filter = { 
+                    '_consumed': True, 
+                    '_leased_until': { '$exists': False } 
+                },
+                projection = { '_id': True, '_hash': True, '_time': True, 'data': True },
+                limit = COMPACT_BATCH
+            ).to_list(None)
+
+        if not consumed:
+            break
+
+        # Latest push time by hash
+        latest = {}
+        for entry in consumed:
+            hash_ = entry.get('_hash') or entry_hash(entry['data'])
+            latest[hash_] = max(entry['_time'], latest.get(hash_, entry['_time']))
+
+        await history.bulk_write(
+                [ 
+                    pymongo.UpdateOne(
+                        filter = { '_id': hash_ },
+                        update = { '$max': { '_time': time } },
+                        upsert = True
+                    ) for hash_, time in latest.items()
+                ],
+                ordered = False
+            )
+
+        result = await incoming.delete_many(
+                filter = { '_id': { '$in': [ entry['_id'] for entry in consumed ] } }
+            )
+
+        compacted += result.deleted_count
+
+    if compacted:
+        log.debug(
+                'stage-%d compacts %d' % (
+                    stage, 
+                    compacted
+                    )
+                )
+    return compacted
+
+async def push(stage, entry_list, push_if_new = False, push_if_older_than = 0):
     """Push entries to a stage queue.
 
     Parameters:
@@ -86,24 +752,85 @@ def push(stage, entry_list, push_if_new = False, push_if_older_than = 0):
     # Manage push-if-new actions
     if push_if_new:
 
-        modified_or_inserted = 0
-        for entry in entry_list:
-            
-            filterdata = { 'data': entry }
+        now = datetime.datetime.utcnow()
 
-            newdata = { 
-                    '_time': datetime.datetime.utcnow(),
-                    '_consumed': False,
-                    'data': entry 
-                }
-            
-            result = mdb['stage-%d' % stage].incoming.update_one(
-                    filter = filterdata,
-                    update = { '$setOnInsert': newdata }, 
-                    upsert = True
+        hashed_entries = [ (entry_hash(entry), entry) for entry in entry_list ]
+
+        # Ask the seen-set cache first, if enabled: the known entries are 
+        # skipped, the new ones are inserted straight away, and the rest 
+        # is looked up in the database
+        cache = seen_caches.get(stage)
+
+        inserts = []
+        lookups = []
+        inserted_hashes = set()
+        for hash_, entry in hashed_entries:
+
+            answer = cache.check(hash_, now) if cache else seencache.MAYBE
+
+            if answer == seencache.MAYBE:
+                lookups.append((hash_, entry))
+            elif answer == seencache.NEW and hash_ not in inserted_hashes:
+                inserted_hashes.add(hash_)
+                inserts.append(
+                    pymongo.InsertOne({ 
+                        '_time': now,
+                        '_consumed': False,
+                        '_hash': hash_,
+                        '_if_new': True,
+                        'data': entry 
+                    })
                 )
 
-            modified_or_inserted += result.modified_count + int(bool(result.upserted_id))
+        # Skip the entries compacted to the history of the consumed entries
+        seen = set()
+        if lookups:
+            compacted = await mdb['stage-%d' % stage].history.find(
+                    filter = { '_id': { '$in': [ hash_ for hash_, entry in lookups ] } },
+                    projection = { '_id': True }
+                ).to_list(None)
+            seen.update(document['_id'] for document in compacted)
+
+        # Upsert every entry by content hash in a single unordered batch.
+        # The inserted entries are flagged to fall under the unique hash 
+        # index, which rejects the entries concurrently pushed if new by
+        # other requests.
+        upserts = [ 
+                pymongo.UpdateOne(
+                    filter = { '_hash': hash_ },
+                    update = { 
+                        '$setOnInsert': { 
+                            '_time': now,
+                            '_consumed': False,
+                            '_if_new': True,
+                            'data': entry 
+                        } 
+                    }, 
+                    upsert = True
+                ) for hash_, entry in lookups if hash_ not in seen
+            ]
+
+        modified_or_inserted = 0
+        try:
+            if inserts or upserts:
+                result = await mdb['stage-%d' % stage].incoming.bulk_write(
+                        inserts + upserts,
+                        ordered = False
+                    )
+                modified_or_inserted = result.inserted_count + result.upserted_count
+        except pymongo.errors.BulkWriteError as e:
+            # Only tolerate the duplicate key errors on the unique hash index
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+                raise
+            modified_or_inserted = e.details['nInserted'] + e.details['nUpserted']
+
+        if cache:
+            for hash_, entry in hashed_entries:
+                cache.add(hash_, now)
+
+        _queue_stats(stage).push(modified_or_inserted, now)
+        metrics.entries_pushed.inc(modified_or_inserted, stage = stage)
+        metrics.entries_deduplicated.inc(len(entry_list) - modified_or_inserted, stage = stage)
 
         log.debug(
                 'pushed to stage-%d (if-new) %d/%d' % (
@@ -117,36 +844,59 @@ def push(stage, entry_list, push_if_new = False, push_if_older_than = 0):
 
     elif push_if_older_than:
 
-        modified_or_inserted = 0
-        for entry in entry_list:
-
-            filterdata = {
-                '$and': [
-                    { 'data': entry },
-                    { '_time': { 
-                        # It's $gt because we want to match the newer data, and $setOnInsert
-                        # if it doesn't match.
-                        '$gt': datetime.datetime.utcnow() - datetime.timedelta(
-                            seconds = push_if_older_than
-                        ) 
-                        } 
-                    }
-                ]
-            }
+        # The whole batch is evaluated against the same cutoff
+        now = datetime.datetime.utcnow()
+        cutoff = now - datetime.timedelta(seconds = push_if_older_than)
+
+        hashed_entries = [ (entry_hash(entry), entry) for entry in entry_list ]
+
+        # Find which entries have been pushed after the cutoff with a 
+        # single query, covered by the hash and time index
+        recent = await mdb['stage-%d' % stage].incoming.find(
+                filter = { 
+                    '_hash': { '$in': [ hash_ for hash_, entry in hashed_entries ] },
+                    '_time': { '$gt': cutoff }
+                },
+                projection = { '_id': False, '_hash': True }
+            ).to_list(None)
+        seen = set(document['_hash'] for document in recent)
+
+        # Same with the history of the compacted consumed entries
+        compacted = await mdb['stage-%d' % stage].history.find(
+                filter = { 
+                    '_id': { '$in': [ hash_ for hash_, entry in hashed_entries ] },
+                    '_time': { '$gt': cutoff }
+                },
+                projection = { '_id': True }
+            ).to_list(None)
+        seen.update(document['_id'] for document in compacted)
 
-            newdata = { 
-                '_time': datetime.datetime.utcnow(),
+        # Push the stale or new entries, only once if repeated in the batch
+        formatted_entries = []
+        for hash_, entry in hashed_entries:
+
+            if hash_ in seen:
+                continue
+            seen.add(hash_)
+
+            formatted_entries.append({ 
+                '_time': now,
                 '_consumed': False,
+                '_hash': hash_,
                 'data': entry 
-            }
+            })
 
-            result = mdb['stage-%d' % stage].incoming.update_one(
-                    filter = filterdata,
-                    update = { '$setOnInsert': newdata }, 
-                    upsert = True
+        modified_or_inserted = 0
+        if formatted_entries:
+            result = await mdb['stage-%d' % stage].incoming.insert_many(
+                    formatted_entries
                 )
+            modified_or_inserted = len(result.inserted_ids)
 
-            modified_or_inserted += result.modified_count + int(bool(result.upserted_id))
+        _record_seen(stage, formatted_entries)
+        _queue_stats(stage).push(modified_or_inserted, now)
+        metrics.entries_pushed.inc(modified_or_inserted, stage = stage)
+        metrics.entries_deduplicated.inc(len(entry_list) - modified_or_inserted, stage = stage)
 
         log.debug(
                 'pushed to stage-%d (if-older-than %d) %d/%d' % (
@@ -164,14 +914,22 @@ def push(stage, entry_list, push_if_new = False, push_if_older_than = 0):
                 { 
                     '_time': datetime.datetime.utcnow(),
                     '_consumed': False,
+                    '_hash': entry_hash(entry),
                     'data': entry 
                 } for entry in entry_list 
             ]
         
-        result = mdb['stage-%d' % stage].incoming.insert_many(
+        result = await mdb['stage-%d' % stage].incoming.insert_many(
                 formatted_entries
                     )
 
+        _record_seen(stage, formatted_entries)
+        _queue_stats(stage).push(
+                len(result.inserted_ids), 
+                formatted_entries[0]['_time']
+            )
+        metrics.entries_pushed.inc(len(result.inserted_ids), stage = stage)
+
         log.debug(
                 'pushed to stage-%d %d/%d' % (
                     stage, 
@@ -182,7 +940,31 @@ def push(stage, entry_list, push_if_new = False, push_if_older_than = 0):
 
         return len(result.inserted_ids)
 
-def store(stage, json_data):
+async def watch(stage):
+    """Watch the entries pushed to a stage queue by any client.
+
+    Change streams are only available when Mongo runs as a replica set.
+    The stream ends when the stage queue is flushed.
+
+    Parameters:
+        
+        stage: The number of stage queue.
+    
+    Yields: None for every pushed entry.
+    """
+
+    _lazy_connect()
+
+    async with mdb['stage-%d' % stage].incoming.watch(
+            pipeline = [
+                { '$match': { 'operationType': 'insert' } },
+                { '$project': { 'fullDocument': False } }
+            ]
+        ) as stream:
+        async for change in stream:
+            yield
+
+async def store(stage, json_data):
     """Store an entry to the database.
 
     Parameters:
@@ -195,8 +977,8 @@ def store(stage, json_data):
 
     _lazy_connect()
             
-    result = mdb['stage-%d' % stage].storage.insert_one(
-            document = { 'data': json_data }
+    result = await mdb['stage-%d' % stage].storage.insert_one(
+            document = dict(_storage_fields(json_data), data = json_data)
         )
 
     log.debug(
@@ -207,7 +989,7 @@ def store(stage, json_data):
 
     return str(result.inserted_id)
 
-def load(stage, filter_, delete):
+async def load(stage, filter_, delete):
     """Load an entry from the database.
 
     Parameters:
@@ -220,14 +1002,18 @@ def load(stage, filter_, delete):
     """
 
     _lazy_connect()
+
+    filter_ = _storage_filter(filter_)
             
     if delete:
-        result = mdb['stage-%d' % stage].storage.find_one_and_delete(
-            filter = filter_
+        result = await mdb['stage-%d' % stage].storage.find_one_and_delete(
+            filter = filter_,
+            projection = STORAGE_PROJECTION
         )
     else:
-        result = mdb['stage-%d' % stage].storage.find_one(
-            filter = filter_
+        result = await mdb['stage-%d' % stage].storage.find_one(
+            filter = filter_,
+            projection = STORAGE_PROJECTION
         )
 
     deleted_text = ' and deleted' if delete else ''
@@ -249,3 +1035,50 @@ def load(stage, filter_, delete):
                     )
                 )
 
+async def load_many(stage, filter_, delete):
+    """Load all the entries matching a filter from the database.
+
+    Parameters:
+        
+        stage: The number of stage queue.
+        filter_: The filter JSON object, as accepted by Mongo find.
+        delete: Delete the matching objects, once loaded.
+    
+    Yields: the requested entry objects.
+    """
+
+    _lazy_connect()
+
+    storage = mdb['stage-%d' % stage].storage
+    filter_ = _storage_filter(filter_)
+
+    loaded = 0
+    loaded_ids = []
+
+    async for result in storage.find(
+            filter = filter_, 
+            projection = STORAGE_PROJECTION
+            ):
+
+        loaded += 1
+        loaded_ids.append(result['_id'])
+
+        result['_id'] = str(result['_id'])
+        yield result
+
+        # Delete in batches the entries already yielded
+        if delete and len(loaded_ids) >= LOAD_DELETE_BATCH:
+            await storage.delete_many({ '_id': { '$in': loaded_ids } })
+            loaded_ids = []
+
+    if delete and loaded_ids:
+        await storage.delete_many({ '_id': { '$in': loaded_ids } })
+
+    log.debug(
+            'loaded%s from stage-%d %d' % (
+                ' and deleted' if delete else '',
+                stage, 
+                loaded
+                )
+            )
+
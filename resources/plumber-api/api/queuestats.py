@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import collections
+import time
+
+class QueueStats:
+    """Counters of a stage queue, maintained by the pushes and the pops of
+    this process and periodically reconciled with the database.
+
+    The counters only see the entries pushed and popped through this
+    process, so between two reconciliations they drift when more API
+    instances serve the stage queue, and the rates only account for the
+    traffic of this process.
+
+    Parameters:
+
+        rate_window: Seconds over which the push and pop rates are averaged.
+    """
+
+    def __init__(self, rate_window):
+
+        # Unconsumed, leased and consumed entries
+        self.ready = 0
+        self.in_flight = 0
+        self.consumed = 0
+
+        # Push time of the oldest unconsumed entry, None if the queue is empty
+        self.oldest = None
+
+        # Entries pushed and popped since the start, to compute the rates
+        self.pushed = 0
+        self.popped = 0
+
+        self.rate_window = rate_window
+        self.samples = collections.deque([ (time.monotonic(), 0, 0) ])
+
+        # Time of the latest reconciliation, None before the first one
+        self.reconciled = None
+
+    def push(self, quantity, pushed_time):
+        """Record pushed entries."""
+
+        if not quantity:
+            return
+
+        if not self.ready:
+            self.oldest = pushed_time
+
+        self.ready += quantity
+        self.pushed += quantity
+
+    def pop(self, quantity, leased):
+        """Record popped entries, leased or consumed straight away."""
+
+        if not quantity:
+            return
+
+        self.ready = max(self.ready - quantity, 0)
+        if not self.ready:
+            self.oldest = None
+
+        if leased:
+            self.in_flight += quantity
+        else:
+            self.consumed += quantity
+
+        self.popped += quantity
+
+    def ack(self, quantity):
+        """Record acknowledged leased entries."""
+
+        self.in_flight = max(self.in_flight - quantity, 0)
+        self.consumed += quantity
+
+    def reap(self, quantity):
+        """Record leased entries returned to the queue."""
+
+        self.in_flight = max(self.in_flight - quantity, 0)
+        self.ready += quantity
+
+    def reset(self):
+        """Record the flush of the queue."""
+
+        self.ready = self.in_flight = self.consumed = 0
+        self.oldest = None
+
+    def reconcile(self, ready, in_flight, consumed, oldest):
+        """Replace the counters with the ones counted in the database."""
+
+        self.ready = ready
+        self.in_flight = in_flight
+        self.consumed = consumed
+        self.oldest = oldest
+
+        self.reconciled = time.monotonic()
+
+    def sample(self):
+        """Record the pushed and popped totals, dropping the samples out of the rate window."""
+
+        now = time.monotonic()
+
+        self.samples.append((now, self.pushed, self.popped))
+
+        # Keep the newest sample older than the window as the rate baseline
+        while len(self.samples) > 1 and now - self.samples[1][0] >= self.rate_window:
+            self.samples.popleft()
+
+    def stats(self, now):
+        """Get the counters, the oldest entry age and the rates per second.
+
+        Parameters:
+
+            now: The current UTC time, to compute the oldest entry age.
+        """
+
+        monotonic = time.monotonic()
+
+        # Rates since the oldest sample, about a window ago
+        sample_time, pushed, popped = self.samples[0]
+        elapsed = monotonic - sample_time
+
+        return {
+            'ready': self.ready,
+            'in_flight': self.in_flight,
+            'consumed': self.consumed,
+            'oldest_age': (now - self.oldest).total_seconds() if self.oldest else None,
+            'push_rate': (self.pushed - pushed) / elapsed if elapsed > 0 else 0.0,
+            'pop_rate': (self.popped - popped) / elapsed if elapsed > 0 else 0.0,
+            'reconciled_age': monotonic - self.reconciled if self.reconciled is not None else None
+        }
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+import collections
+import datetime
+import math
+
+# Answers of the seen-set cache
+KNOWN = 'known'  # Entry certainly pushed before
+NEW = 'new'      # Entry certainly never pushed before
+MAYBE = 'maybe'  # Entry to be looked up in the database
+
+class BloomFilter:
+    """Bloom filter of content hashes, sized by memory and false positive rate."""
+
+    def __init__(self, memory, error_rate):
+
+        self.size = max(memory * 8, 8)
+        self.bits = bytearray(self.size // 8)
+        self.hashes = max(int(round(-math.log2(error_rate))), 1)
+
+        # Number of entries that can be added before exceeding the error rate
+        self.capacity = int(-self.size * math.log(2) ** 2 / math.log(error_rate))
+
+        self.count = 0
+
+    def _positions(self, hash_):
+
+        # Double hashing over two 64 bits slices of the hexadecimal digest
+        first = int(hash_[:16], 16)
+        second = int(hash_[16:32], 16) | 1
+
+        return [ (first + i * second) % self.size for i in range(self.hashes) ]
+
+    def add(self, hash_):
+
+        for position in self._positions(hash_):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+        self.count += 1
+
+    def __contains__(self, hash_):
+
+        return all(
+                self.bits[position >> 3] & (1 << (position & 7))
+                for position in self._positions(hash_)
+            )
+
+class SeenCache:
+    """Seen-set of a stage queue, made of a Bloom filter of every pushed
+    content hash and a LRU of the recently pushed ones.
+
+    The cache only sees the entries pushed through this process, so it is
+    only accurate when a single API instance serves the stage queue.
+    """
+
+    def __init__(self, memory, error_rate, recent_size, retention):
+
+        self.bloom = BloomFilter(memory, error_rate)
+
+        # Latest push time of the recently pushed hashes, in LRU order
+        self.recent = collections.OrderedDict()
+        self.recent_size = recent_size
+
+        # Seconds the database remembers the pushed entries, 0 for ever
+        self.retention = retention
+
+        # Answers are MAYBE until the cache is warmed with the database content
+        self.ready = False
+
+        self.counters = {
+            KNOWN: 0,
+            NEW: 0,
+            MAYBE: 0
+        }
+
+    def add(self, hash_, time):
+        """Record a pushed content hash."""
+
+        if hash_ not in self.recent:
+            if hash_ not in self.bloom:
+                self.bloom.add(hash_)
+            if len(self.recent) >= self.recent_size:
+                self.recent.popitem(last = False)
+
+        self.recent[hash_] = time
+        self.recent.move_to_end(hash_)
+
+    def warm(self, hash_):
+        """Record a content hash already present in the database."""
+
+        if hash_ not in self.bloom:
+            self.bloom.add(hash_)
+
+    def check(self, hash_, now):
+        """Tell if a content hash has been pushed before.
+
+        Returns: KNOWN, NEW or MAYBE.
+        """
+
+        if not self.ready:
+            answer = MAYBE
+        elif hash_ in self.recent and (
+                not self.retention or
+                now - self.recent[hash_] < datetime.timedelta(seconds = self.retention)
+                ):
+            self.recent.move_to_end(hash_)
+            answer = KNOWN
+        elif hash_ not in self.bloom:
+            answer = NEW
+        else:
+            answer = MAYBE
+
+        self.counters[answer] += 1
+        return answer
+
+    def stats(self):
+        """Get the counters and the sizing of the cache."""
+
+        return {
+            'ready': self.ready,
+            'known': self.counters[KNOWN],
+            'new': self.counters[NEW],
+            'maybe': self.counters[MAYBE],
+            'recent': len(self.recent),
+            'recent_size': self.recent_size,
+            'bloom_entries': self.bloom.count,
+            'bloom_capacity': self.bloom.capacity,
+            'bloom_bytes': len(self.bloom.bits),
+            'bloom_hashes': self.bloom.hashes
+        }
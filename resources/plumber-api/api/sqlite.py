@@ -0,0 +1,816 @@
+#!/usr/bin/env python3
+"""SQLite storage engine, keeping the stage queues in a local database file.
+
+The database runs in WAL mode, so that readers don't block the writer and
+the commits append to the log instead of rewriting the pages. Every call
+runs as a single transaction on a dedicated thread owning the connection,
+which keeps the event loop free and serializes the writes. Pops claim their
+entries with a single UPDATE ... RETURNING statement where SQLite supports
+it (3.35 and later), and with a SELECT and an UPDATE in an immediate
+transaction otherwise.
+
+The statistics counts run on a second, read-only connection with its own
+thread, so that they don't hold up the pushes and the pops.
+
+More API instances on the same host can share the database file.
+"""
+import concurrent.futures
+import contextlib
+import datetime
+import asyncio
+import logging
+import secrets
+import sqlite3
+import time
+import uuid
+import os
+import queuestats
+import formats
+import metrics
+import filters
+from engines import entry_hash
+
+# Database file of the queues
+SQLITE_PATH = os.getenv('SQLITE_PATH', '/plumber/data/plumber.db')
+
+# Durability of the commits: FULL syncs every commit to disk, NORMAL only
+# the WAL checkpoints, which may lose the latest commits on power loss
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL').upper()
+
+# Milliseconds a write waits for the other processes sharing the database
+SQLITE_BUSY_TIMEOUT = 5000
+
+# Seconds the hashes of the consumed entries are kept for push_if_new
+# and push_if_older_than, once compacted. 0 keeps them forever.
+HISTORY_RETENTION = int(os.getenv('HISTORY_RETENTION', 0))
+
+# Most consumed entries compacted in a single transaction
+COMPACT_BATCH = 1000
+
+# Most stored entries loaded or deleted in a single transaction
+LOAD_BATCH = 1000
+
+# Most claim tokens acknowledged in a single statement, within the 999
+# variables of a statement before SQLite 3.32
+ACK_BATCH = 900
+
+# Seconds between the checks for entries pushed by other processes
+WATCH_INTERVAL = 1
+
+# Seconds over which the push and pop rates of the queue statistics are averaged
+STATS_RATE_WINDOW = 60
+
+# Claims in a single statement, from SQLite 3.35
+UPDATE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+TABLES = [
+    # Stage queues. The entries are consumed by their pop, and leased
+    # until acknowledged if popped with a lease.
+    '''CREATE TABLE IF NOT EXISTS incoming (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        stage INTEGER NOT NULL,
+        time REAL NOT NULL,
+        hash TEXT NOT NULL,
+        consumed INTEGER NOT NULL DEFAULT 0,
+        claim TEXT,
+        leased_until REAL,
+        data BLOB NOT NULL
+    )''',
+    # Compacted consumed entries, by content hash
+    '''CREATE TABLE IF NOT EXISTS history (
+        stage INTEGER NOT NULL,
+        hash TEXT NOT NULL,
+        time REAL NOT NULL,
+        PRIMARY KEY (stage, hash)
+    ) WITHOUT ROWID''',
+    # Stored entries
+    '''CREATE TABLE IF NOT EXISTS storage (
+        seq INTEGER PRIMARY KEY,
+        stage INTEGER NOT NULL,
+        id TEXT NOT NULL UNIQUE,
+        hash TEXT NOT NULL,
+        list INTEGER NOT NULL,
+        data BLOB NOT NULL
+    )'''
+]
+
+# Indexes of the tables, as (table, name, definition)
+INDEXES = [
+    # Queue of the unconsumed entries sorted in pop order, covering the
+    # depth and the statistics counts
+    ('incoming', 'ready', '(stage, consumed, id)'),
+    # Leased entries by lease expiration, covering the claim tokens of the
+    # acknowledgements, which scan only the entries in flight
+    ('incoming', 'leased', '(stage, leased_until, claim) WHERE leased_until IS NOT NULL'),
+    # Lookup of previously pushed entries by push_if_new and push_if_older_than,
+    # covered by the index
+    ('incoming', 'hash_time', '(stage, hash, time)'),
+    # Expiration of the history entries older than the retention
+    ('history', 'expire', '(stage, time)'),
+    # Lookup of stored entries by content, and of the stored lists whose
+    # items can match a filter too
+    ('storage', 'data', '(stage, hash, seq)'),
+    ('storage', 'lists', '(stage, list, seq)')
+]
+
+# Indexes of the previous versions, dropped by ensure_indexes
+OBSOLETE_INDEXES = [
+    # Duplicate of the prefix of hash_time
+    'hash_if_new'
+]
+
+db = None
+
+# Single thread owning the connection
+executor = concurrent.futures.ThreadPoolExecutor(1)
+
+# Read-only connection of the statistics counts, and its thread
+reader = None
+reader_executor = concurrent.futures.ThreadPoolExecutor(1)
+
+# Queue statistics, by stage number
+queue_stats = {}
+
+log = logging.getLogger('app')
+
+def _connect():
+    global db
+
+    if not db:
+        db = sqlite3.connect(SQLITE_PATH, isolation_level = None)
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = %s' % SQLITE_SYNCHRONOUS)
+        db.execute('PRAGMA busy_timeout = %d' % SQLITE_BUSY_TIMEOUT)
+
+        for table in TABLES:
+            db.execute(table)
+
+def _connect_reader():
+    global reader
+
+    if not reader:
+        # Opened once the database exists, WAL readers never block the writer
+        reader = sqlite3.connect('file:%s?mode=ro' % SQLITE_PATH, uri = True, isolation_level = None)
+        reader.execute('PRAGMA busy_timeout = %d' % SQLITE_BUSY_TIMEOUT)
+
+@contextlib.contextmanager
+def _transaction():
+
+    # Take the write lock upfront, so that the reads of the transaction
+    # see the state it writes on
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        yield db
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    else:
+        db.execute('COMMIT')
+
+async def _run(function, *args):
+    """Run a function on the database thread."""
+
+    return await asyncio.get_event_loop().run_in_executor(executor, function, *args)
+
+def _datetime(timestamp):
+
+    return datetime.datetime.utcfromtimestamp(timestamp)
+
+def _queue_stats(stage):
+
+    if stage not in queue_stats:
+        queue_stats[stage] = queuestats.QueueStats(STATS_RATE_WINDOW)
+
+    return queue_stats[stage]
+
+async def start():
+    """Start the engine, opening the database and creating its tables."""
+
+    await _run(_connect)
+    await asyncio.get_event_loop().run_in_executor(reader_executor, _connect_reader)
+
+def stop():
+    """Stop the engine, closing the database."""
+
+    if reader:
+        reader_executor.submit(reader.close).result()
+
+    if db:
+        executor.submit(db.close).result()
+
+    reader_executor.shutdown()
+    executor.shutdown()
+
+async def warm_seen_cache(stage):
+    """The pushed content hashes are looked up on their index, there is no cache to warm."""
+
+def seen_cache_stats(stage):
+    """Get the counters of the seen-set cache, always empty as there is no cache."""
+
+    return {}
+
+def stats(stage):
+    """Get the statistics of a stage queue, from the counters maintained by
+    the pushes and the pops, without querying the database.
+
+    Parameters:
+
+        stage: The number of stage queue.
+
+    Returns: the ready, in-flight and consumed entries, the age of the oldest ready entry in seconds, and the push and pop rates per second.
+    """
+
+    return _queue_stats(stage).stats(datetime.datetime.utcnow())
+
+def _count_stats(stage):
+
+    # A single read transaction, for the counts to be consistent
+    reader.execute('BEGIN')
+    try:
+        return _count(stage)
+    finally:
+        reader.execute('COMMIT')
+
+def _count(stage):
+
+    ready, consumed = 0, 0
+    for is_consumed, count in reader.execute(
+            'SELECT consumed, COUNT(*) FROM incoming WHERE stage = ? GROUP BY consumed',
+            (stage,)
+            ):
+        if is_consumed:
+            consumed = count
+        else:
+            ready = count
+
+    in_flight, = reader.execute(
+            'SELECT COUNT(*) FROM incoming WHERE stage = ? AND leased_until IS NOT NULL',
+            (stage,)
+        ).fetchone()
+    compacted, = reader.execute('SELECT COUNT(*) FROM history WHERE stage = ?', (stage,)).fetchone()
+
+    oldest = reader.execute(
+            'SELECT time FROM incoming WHERE stage = ? AND consumed = 0 ORDER BY id LIMIT 1',
+            (stage,)
+        ).fetchone()
+
+    return ready, in_flight, consumed - in_flight + compacted, _datetime(oldest[0]) if oldest else None
+
+async def reconcile_stats(stage):
+    """Reconcile the counters of the statistics of a stage queue with the
+    database, and sample the push and pop rates.
+
+    The consumed entries compacted to the history are counted once per
+    content hash.
+
+    Parameters:
+
+        stage: The number of stage queue.
+    """
+
+    counts = await asyncio.get_event_loop().run_in_executor(reader_executor, _count_stats, stage)
+
+    counters = _queue_stats(stage)
+    counters.reconcile(*counts)
+    counters.sample()
+
+def _ensure_indexes():
+
+    for name in OBSOLETE_INDEXES:
+        db.execute('DROP INDEX IF EXISTS %s' % name)
+
+    for table, name, definition in INDEXES:
+        db.execute('CREATE INDEX IF NOT EXISTS %s ON %s %s' % (name, table, definition))
+
+async def ensure_indexes(stage):
+    """Create the missing indexes of the tables, shared by every stage.
+
+    Parameters:
+
+        stage: The number of stage queue.
+    """
+
+    await _run(_ensure_indexes)
+
+    log.debug('stage-%d indexes ensured' % (stage))
+
+def _indexes():
+
+    results = {}
+
+    for table, name, sql in db.execute(
+            "SELECT tbl_name, name, sql FROM sqlite_master WHERE type = 'index' ORDER BY tbl_name, name"
+            ):
+        results.setdefault(table, {})[name] = { 'sql': sql }
+
+    return results
+
+async def indexes(stage):
+    """List the indexes of the tables, shared by every stage.
+
+    Parameters:
+
+        stage: The number of stage queue.
+
+    Returns: the index definitions of every table, by table name.
+    """
+
+    return await _run(_indexes)
+
+def _depth(stage):
+
+    return db.execute(
+            'SELECT COUNT(*) FROM incoming WHERE stage = ? AND consumed = 0',
+            (stage,)
+        ).fetchone()[0]
+
+async def depth(stage):
+    """Count the entries waiting in a stage queue.
+
+    Parameters:
+
+        stage: The number of stage queue.
+
+    Returns: the number of unconsumed entries.
+    """
+
+    # Covered by the index of the unconsumed entries
+    return await _run(_depth, stage)
+
+def _flush(stage):
+
+    with _transaction():
+        db.execute('DELETE FROM incoming WHERE stage = ?', (stage,))
+        db.execute('DELETE FROM history WHERE stage = ?', (stage,))
+
+async def flush(stage):
+    """
+    Flush stage queue.
+    """
+
+    await _run(_flush, stage)
+    _queue_stats(stage).reset()
+
+    log.debug('stage-%d delete' % (stage))
+
+async def pop(stage, quantity = 1, lease = 0):
+    """Pop entries from a stage queue.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        quantity: The number of entries to retrieve. Default is 1.
+        lease: Lease the entries for a number of seconds, after which they are returned to the queue if not acknowledged. Default is 0 (disabled).
+
+    Returns the data objects.
+    """
+
+    token, results = await claim(stage, quantity, lease)
+
+    return results
+
+def _claim(stage, quantity, leased_until, token):
+
+    with _transaction():
+
+        if UPDATE_RETURNING:
+            claimed = db.execute(
+                    '''UPDATE incoming SET consumed = 1, claim = ?, leased_until = ?
+                    WHERE id IN (
+                        SELECT id FROM incoming WHERE stage = ? AND consumed = 0 ORDER BY id LIMIT ?
+                    )
+                    RETURNING id, data''',
+                    (token, leased_until, stage, quantity)
+                ).fetchall()
+        else:
+            claimed = db.execute(
+                    'SELECT id, data FROM incoming WHERE stage = ? AND consumed = 0 ORDER BY id LIMIT ?',
+                    (stage, quantity)
+                ).fetchall()
+            db.executemany(
+                    'UPDATE incoming SET consumed = 1, claim = ?, leased_until = ? WHERE id = ?',
+                    [ (token, leased_until, id_) for id_, data in claimed ]
+                )
+
+    # The returned rows are in no particular order
+    return [ formats.loads(data) for id_, data in sorted(claimed) ]
+
+async def claim(stage, quantity = 1, lease = 0, token = None):
+    """Pop entries from a stage queue, along with their claim token.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        quantity: The number of entries to retrieve. Default is 1.
+        lease: Lease the entries for a number of seconds, after which they are returned to the queue if not acknowledged. Default is 0 (disabled).
+        token: The claim token of a previous claim to extend. Default is a new claim token.
+
+    Returns: the claim token and the data objects.
+    """
+
+    token = token or uuid.uuid4().hex
+
+    results = await _run(
+            _claim,
+            stage,
+            quantity,
+            time.time() + lease if lease else None,
+            token
+        )
+
+    _queue_stats(stage).pop(len(results), bool(lease))
+    metrics.entries_popped.inc(len(results), stage = stage)
+
+    log.debug(
+            'stage-%d pops %d/%d' % (
+                stage,
+                len(results),
+                quantity
+                )
+            )
+    return token, results
+
+def _ack(stage, claims):
+
+    claims = list(claims)
+    acked = 0
+
+    with _transaction():
+        for start in range(0, len(claims), ACK_BATCH):
+            batch = claims[start:start + ACK_BATCH]
+            acked += db.execute(
+                    '''UPDATE incoming SET leased_until = NULL
+                    WHERE stage = ? AND leased_until IS NOT NULL AND claim IN (%s)''' % ','.join('?' * len(batch)),
+                    [ stage ] + batch
+                ).rowcount
+
+    return acked
+
+async def ack(stage, claims):
+    """Acknowledge the processing of leased entries.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+        claims: List of claim tokens of the leased entries.
+
+    Returns: the number of acknowledged entries.
+    """
+
+    # Entries whose lease has already expired and which have been
+    # returned to the queue have lost their claim token
+    acked = await _run(_ack, stage, claims) if claims else 0
+
+    _queue_stats(stage).ack(acked)
+
+    log.debug(
+            'stage-%d acks %d' % (
+                stage,
+                acked
+                )
+            )
+    return acked
+
+def _reap(stage, now):
+
+    with _transaction():
+        return db.execute(
+                '''UPDATE incoming SET consumed = 0, claim = NULL, leased_until = NULL
+                WHERE stage = ? AND leased_until < ?''',
+                (stage, now)
+            ).rowcount
+
+async def reap(stage):
+    """Return the entries with an expired lease to the stage queue.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+
+    Returns: the number of returned entries.
+    """
+
+    reaped = await _run(_reap, stage, time.time())
+
+    _queue_stats(stage).reap(reaped)
+
+    if reaped:
+        log.debug(
+                'stage-%d reaps %d expired leases' % (
+                    stage,
+                    reaped
+                    )
+                )
+    return reaped
+
+def _compact(stage):
+
+    with _transaction():
+
+        # Consumed entries, except the leased ones which may be returned
+        # to the queue
+        consumed = db.execute(
+                '''SELECT id FROM incoming
+                WHERE stage = ? AND consumed = 1 AND leased_until IS NULL LIMIT ?''',
+                (stage, COMPACT_BATCH)
+            ).fetchall()
+
+        if not consumed:
+            return 0
+
+        ids = ','.join(str(id_) for id_, in consumed)
+
+        # Latest push time by hash
+        db.execute(
+                '''INSERT INTO history (stage, hash, time)
+                SELECT stage, hash, MAX(time) FROM incoming WHERE id IN (%s) GROUP BY hash
+                ON CONFLICT (stage, hash) DO UPDATE SET time = MAX(time, excluded.time)''' % ids
+            )
+
+        return db.execute('DELETE FROM incoming WHERE id IN (%s)' % ids).rowcount
+
+def _expire(stage, cutoff):
+
+    with _transaction():
+        return db.execute(
+                'DELETE FROM history WHERE stage = ? AND time < ?',
+                (stage, cutoff)
+            ).rowcount
+
+async def compact(stage):
+    """Move the consumed entries of a stage queue to its history.
+
+    The history keeps only the content hash and the latest push time of the
+    consumed entries, as needed by push_if_new and push_if_older_than, and
+    forgets the ones older than the retention.
+
+    Parameters:
+
+        stage: The number of the stage queue.
+
+    Returns: the number of compacted entries.
+    """
+
+    compacted = 0
+
+    while True:
+        batch = await _run(_compact, stage)
+        if not batch:
+            break
+
+        compacted += batch
+
+    if HISTORY_RETENTION:
+        await _run(_expire, stage, time.time() - HISTORY_RETENTION)
+
+    if compacted:
+        log.debug(
+                'stage-%d compacts %d' % (
+                    stage,
+                    compacted
+                    )
+                )
+    return compacted
+
+def _push(stage, rows, condition = None, condition_args = ()):
+
+    with _transaction():
+
+        if condition is None:
+            return db.executemany(
+                    'INSERT INTO incoming (stage, time, hash, data) VALUES (?, ?, ?, ?)',
+                    rows
+                ).rowcount
+
+        # Insert the entries without a previous push matching the condition,
+        # in the queue or in its history. The entries inserted earlier in
+        # the batch count as previous pushes.
+        return db.executemany(
+                '''INSERT INTO incoming (stage, time, hash, data)
+                SELECT ?, ?, ?, ? WHERE NOT EXISTS (
+                    SELECT 1 FROM incoming WHERE stage = ? AND hash = ? %(condition)s
+                ) AND NOT EXISTS (
+                    SELECT 1 FROM history WHERE stage = ? AND hash = ? %(condition)s
+                )''' % { 'condition': condition },
+                [
+                    row + (stage, row[2]) + condition_args + (stage, row[2]) + condition_args
+                    for row in rows
+                ]
+            ).rowcount
+
+async def push(stage, entry_list, push_if_new = False, push_if_older_than = 0):
+    """Push entries to a stage queue.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        entry_list: List of objects.
+        push_if_new: Push only the entries which haven't been previously pushed. Default is false.
+        push_if_older_than: Push only the entries which haven't been previously pushed or that have been older than a number of seconds. Default is 0 (disabled).
+
+    Returns: the number of pushed entries.
+    """
+
+    # Silently exit on empty lists
+    if not entry_list:
+        return []
+
+    now = time.time()
+
+    # The whole batch is inserted in a single transaction
+    rows = [
+            (stage, now, entry_hash(entry), formats.dumps(entry))
+            for entry in entry_list
+        ]
+
+    if push_if_new:
+        pushed = await _run(_push, stage, rows, '', ())
+        mode = ' (if-new)'
+    elif push_if_older_than:
+        pushed = await _run(_push, stage, rows, 'AND time > ?', (now - push_if_older_than,))
+        mode = ' (if-older-than %d)' % push_if_older_than
+    else:
+        pushed = await _run(_push, stage, rows)
+        mode = ''
+
+    _queue_stats(stage).push(pushed, _datetime(now))
+    metrics.entries_pushed.inc(pushed, stage = stage)
+    metrics.entries_deduplicated.inc(len(entry_list) - pushed, stage = stage)
+
+    log.debug(
+            'pushed to stage-%d%s %d/%d' % (
+                stage,
+                mode,
+                pushed,
+                len(entry_list)
+                )
+            )
+    return pushed
+
+def _last_id():
+
+    return db.execute('SELECT MAX(id) FROM incoming').fetchone()[0] or 0
+
+async def watch(stage):
+    """Watch the entries pushed to a stage queue by the other processes
+    sharing the database.
+
+    The whole database is polled, so a push to any stage wakes up all of
+    them.
+
+    Parameters:
+
+        stage: The number of stage queue.
+
+    Yields: None when entries have been pushed.
+    """
+
+    last_id = await _run(_last_id)
+
+    while True:
+        await asyncio.sleep(WATCH_INTERVAL)
+
+        pushed_id = await _run(_last_id)
+        if pushed_id > last_id:
+            last_id = pushed_id
+            yield
+
+def _store(stage, id_, json_data):
+
+    with _transaction():
+        db.execute(
+                'INSERT INTO storage (stage, id, hash, list, data) VALUES (?, ?, ?, ?, ?)',
+                (stage, id_, entry_hash(json_data), isinstance(json_data, list), formats.dumps(json_data))
+            )
+
+async def store(stage, json_data):
+    """Store an entry to the database.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        json_data: The entry object.
+
+    Returns the id of the stored object, as 24 hexadecimal digits like the Mongo ObjectIDs.
+    """
+
+    id_ = secrets.token_hex(12)
+    await _run(_store, stage, id_, json_data)
+
+    log.debug(
+            'stored to stage-%d' % (
+                stage,
+                )
+            )
+
+    return id_
+
+def _find(stage, filter_, after, delete, most = None):
+    """Find the stored entries matching a filter, in insertion order, in
+    a batch of candidates.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        filter_: The filter JSON object, as accepted by Mongo find.
+        after: The sequence number to resume the scan after.
+        delete: Delete the matching entries, in the same transaction.
+        most: The most entries to match. Default is all.
+
+    Returns: the sequence number to resume the scan after, None once done, and the matching entries.
+    """
+
+    # Narrow the candidates by id or by content on their indexes
+    id_ = filter_.get('_id')
+    if isinstance(id_, str):
+        condition, args = 'AND id = ?', (id_,)
+    elif 'data' in filter_ and not filters.is_operator(filter_['data']):
+        condition, args = 'AND (hash = ? OR list = 1)', (entry_hash(filter_['data']),)
+    else:
+        condition, args = '', ()
+
+    with _transaction() if delete else contextlib.nullcontext():
+
+        rows = db.execute(
+                'SELECT seq, id, data FROM storage WHERE stage = ? AND seq > ? %s ORDER BY seq LIMIT ?' % condition,
+                (stage, after) + args + (LOAD_BATCH,)
+            ).fetchall()
+
+        results = []
+        for seq, id_, data in rows:
+            document = { '_id': id_, 'data': formats.loads(data) }
+            if filters.match(document, filter_):
+                results.append(document)
+
+                if most and len(results) >= most:
+                    rows = []
+                    break
+
+        if delete and results:
+            db.executemany(
+                    'DELETE FROM storage WHERE id = ?',
+                    [ (result['_id'],) for result in results ]
+                )
+
+    return rows[-1][0] if len(rows) == LOAD_BATCH else None, results
+
+async def load(stage, filter_, delete):
+    """Load an entry from the database.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        filter_: The filter JSON object, as accepted by Mongo find_one.
+        delete: Delete the matching objects.
+
+    Returns: the requested entry object.
+    """
+
+    after, results = 0, []
+
+    while after is not None and not results:
+        after, results = await _run(_find, stage, filter_, after, delete, 1)
+
+    log.debug(
+            'loaded%s from stage-%d %d/1' % (
+                ' and deleted' if delete else '',
+                stage,
+                len(results)
+                )
+            )
+
+    if results:
+        return results[0]
+
+async def load_many(stage, filter_, delete):
+    """Load all the entries matching a filter from the database.
+
+    Parameters:
+
+        stage: The number of stage queue.
+        filter_: The filter JSON object, as accepted by Mongo find.
+        delete: Delete the matching objects, once loaded.
+
+    Yields: the requested entry objects.
+    """
+
+    loaded = 0
+    after = 0
+
+    while after is not None:
+
+        # The batches are deleted before being yielded, so that concurrent
+        # loads never hand out the same entry twice
+        after, results = await _run(_find, stage, filter_, after, delete)
+
+        for result in results:
+            loaded += 1
+            yield result
+
+    log.debug(
+            'loaded%s from stage-%d %d' % (
+                ' and deleted' if delete else '',
+                stage,
+                loaded
+                )
+            )